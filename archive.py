@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import struct
+import zlib
+import mmap
+import array
+import datetime
+
+# Columnar archive format for raw counter history. Each counter has one
+# file per (UTC) day. While a day is in progress, samples are appended to
+# an uncompressed ".open" file of fixed-size records (timestamp, value as
+# fixed-point integer). Once the day is over it is compacted into a ".col"
+# file that holds delta-encoded, zlib-compressed timestamp and value
+# columns.
+
+magic = b'PMA1'
+
+# Header of a compacted file: magic, scale, sample count, first timestamp,
+# first value, compressed sizes of the timestamp and value columns
+header_format = '<4sIIqqII'
+header_size = struct.calcsize(header_format)
+
+# Header of an open file: magic, scale, reserved; followed by records
+# of timestamp, value
+open_magic = b'PMO1'
+open_header_format = '<4sIq'
+open_header_size = struct.calcsize(open_header_format)
+record_format = '<qq'
+record_size = struct.calcsize(record_format)
+
+# Fixed-point scale per unit
+unit_scale = dict(kW=1000, kWh=1000, V=10, A=1000, m3=1000)
+
+def day_of(timestamp):
+    return int(timestamp) // 86400
+
+def day_name(day):
+    return (datetime.date(1970, 1, 1) + datetime.timedelta(days=day)).strftime('%Y%m%d')
+
+def counter_dir(archive_dir, table, meter_id=None):
+    if meter_id is not None:
+        return os.path.join(archive_dir, str(meter_id), table)
+
+    return os.path.join(archive_dir, table)
+
+def open_name(directory, day):
+    return os.path.join(directory, day_name(day) + '.open')
+
+def col_name(directory, day):
+    return os.path.join(directory, day_name(day) + '.col')
+
+def scale_of(unit):
+    return unit_scale.get(unit, 1000)
+
+def encode_open_header(scale):
+    return struct.pack(open_header_format, open_magic, scale, 0)
+
+def read_open_header(open_file):
+    with open(open_file, 'rb') as open_fd:
+        file_magic,scale,reserved = struct.unpack(open_header_format, open_fd.read(open_header_size))
+
+    if file_magic != open_magic:
+        raise Exception('{} is not a pymeter archive file'.format(open_file))
+
+    return scale
+
+def encode_record(timestamp, value, scale):
+    return struct.pack(record_format, int(timestamp), int(round(float(value) * scale)))
+
+def compact(open_file, col_file):
+    with open(open_file, 'rb') as open_fd:
+        header = open_fd.read(open_header_size)
+        data = open_fd.read()
+
+    if len(header) < open_header_size:
+        os.remove(open_file)
+        return
+
+    file_magic,scale,reserved = struct.unpack(open_header_format, header)
+
+    if file_magic != open_magic:
+        raise Exception('{} is not a pymeter archive file'.format(open_file))
+
+    # Ignore a partial record at the end of an interrupted write
+    count = len(data) // record_size
+    data = data[:count * record_size]
+
+    if count == 0:
+        os.remove(open_file)
+        return
+
+    records = array.array('q')
+    records.frombytes(data)
+
+    if sys.byteorder != 'little':
+        records.byteswap()
+
+    timestamps = records[0::2]
+    values = records[1::2]
+
+    # Delta-encode both columns; timestamp deltas fit in 32 bits, value
+    # deltas are kept at 64 bits as fixed-point readings can jump
+    ts_deltas = array.array('i', [timestamps[i] - timestamps[i - 1] for i in range(1, count)])
+    value_deltas = array.array('q', [values[i] - values[i - 1] for i in range(1, count)])
+
+    if sys.byteorder != 'little':
+        ts_deltas.byteswap()
+        value_deltas.byteswap()
+
+    ts_data = zlib.compress(ts_deltas.tobytes(), 9)
+    value_data = zlib.compress(value_deltas.tobytes(), 9)
+
+    tmp_file = col_file + '.tmp'
+
+    with open(tmp_file, 'wb') as col_fd:
+        col_fd.write(struct.pack(header_format, magic, scale, count, timestamps[0], values[0], len(ts_data), len(value_data)))
+        col_fd.write(ts_data)
+        col_fd.write(value_data)
+
+    os.replace(tmp_file, col_file)
+    os.remove(open_file)
+
+def load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise Exception('Reading the archive requires NumPy, install it with "pip install numpy"')
+
+    return numpy
+
+def read_day(archive_dir, table, day, meter_id=None):
+    # Returns (timestamps, values) as NumPy arrays, or None if there is no
+    # data for the day
+    np = load_numpy()
+    directory = counter_dir(archive_dir, table, meter_id)
+
+    if isinstance(day, datetime.date):
+        day = (day - datetime.date(1970, 1, 1)).days
+
+    col_file = col_name(directory, day)
+    open_file = open_name(directory, day)
+
+    if os.path.exists(col_file):
+        with open(col_file, 'rb') as col_fd:
+            with mmap.mmap(col_fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                file_magic,scale,count,first_ts,first_value,ts_len,value_len = struct.unpack_from(header_format, mapped, 0)
+
+                if file_magic != magic:
+                    raise Exception('{} is not a pymeter archive file'.format(col_file))
+
+                # Decompress straight from the mapped file; the decompressed
+                # buffers are wrapped by NumPy without further copies
+                ts_view = memoryview(mapped)[header_size:header_size + ts_len]
+                value_view = memoryview(mapped)[header_size + ts_len:header_size + ts_len + value_len]
+
+                ts_deltas = np.frombuffer(zlib.decompress(ts_view), dtype='<i4')
+                value_deltas = np.frombuffer(zlib.decompress(value_view), dtype='<i8')
+
+                ts_view.release()
+                value_view.release()
+
+        timestamps = np.empty(count, dtype=np.int64)
+        timestamps[0] = first_ts
+        np.cumsum(ts_deltas, out=timestamps[1:])
+        timestamps[1:] += first_ts
+
+        values = np.empty(count, dtype=np.int64)
+        values[0] = first_value
+        np.cumsum(value_deltas, out=values[1:])
+        values[1:] += first_value
+
+        return timestamps, values / scale
+
+    if os.path.exists(open_file) and os.path.getsize(open_file) >= open_header_size + record_size:
+        # The open file is mapped directly without copying
+        scale = read_open_header(open_file)
+        count = (os.path.getsize(open_file) - open_header_size) // record_size
+        records = np.memmap(open_file, dtype=[('timestamp', '<i8'), ('value', '<i8')], mode='r', offset=open_header_size, shape=(count,))
+
+        return records['timestamp'], records['value'] / scale
+
+    return None
+
+def read_range(archive_dir, table, start, end, meter_id=None):
+    # Returns (timestamps, values) for start <= timestamp < end
+    np = load_numpy()
+
+    timestamps = []
+    values = []
+
+    for day in range(day_of(start), day_of(end - 1) + 1):
+        result = read_day(archive_dir, table, day, meter_id)
+
+        if result is None:
+            continue
+
+        day_ts,day_values = result
+        mask = (day_ts >= start) & (day_ts < end)
+
+        timestamps.append(day_ts[mask])
+        values.append(day_values[mask])
+
+    if len(timestamps) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    return np.concatenate(timestamps), np.concatenate(values)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import logging
+import time
+import archive
+import schema
+
+logger = None
+
+# Directory in which the archive is stored
+archive_dir = None
+
+# Which counters to archive                         = {DSMR name: (table, scale)}
+archived = dict()
+
+# Open day files per (table, meter)                 = (day, file object)
+open_files = dict()
+
+# Is this sink active?
+active = False
+
+def compact_stale():
+    # Compact files of earlier days that were left open by a restart; the
+    # file for the current day is continued
+    today = archive.day_name(archive.day_of(time.time()))
+
+    for root,dirs,files in os.walk(archive_dir):
+        for name in files:
+            if not name.endswith('.open') or name[:-len('.open')] >= today:
+                continue
+
+            open_file = os.path.join(root, name)
+            col_file = open_file[:-len('.open')] + '.col'
+
+            try:
+                archive.compact(open_file, col_file)
+                logger.info('Compacted archive file {}'.format(open_file))
+            except Exception as e:
+                logger.error('Failed to compact archive file {} ({})'.format(open_file, e))
+
+def close_day(key):
+    day,fd = open_files.pop(key)
+
+    fd.close()
+
+    try:
+        archive.compact(fd.name, fd.name[:-len('.open')] + '.col')
+    except Exception as e:
+        logger.error('Failed to compact archive file {} ({})'.format(fd.name, e))
+
+def day_file(table, meter_id, day, scale):
+    key = (table, meter_id)
+
+    if key in open_files:
+        open_day,fd = open_files[key]
+
+        if open_day == day:
+            return fd
+
+        # Samples for an earlier day than the open one are dropped
+        if day < open_day:
+            return None
+
+        close_day(key)
+
+    directory = archive.counter_dir(archive_dir, table, meter_id)
+    os.makedirs(directory, exist_ok=True)
+
+    open_file = archive.open_name(directory, day)
+
+    if os.path.exists(archive.col_name(directory, day)):
+        logger.warning('Archive for {} on {} was already compacted, not adding more samples'.format(table, archive.day_name(day)))
+        return None
+
+    new_file = not os.path.exists(open_file) or os.path.getsize(open_file) < archive.open_header_size
+
+    fd = open(open_file, 'ab')
+
+    if new_file:
+        fd.truncate(0)
+        fd.write(archive.encode_open_header(scale))
+
+    open_files[key] = (day, fd)
+
+    return fd
+
+def process_telegram(timestamp, telegram, meter_id=None):
+    if not active:
+        return
+
+    day = archive.day_of(timestamp)
+
+    for attr,value in telegram:
+        if attr in archived:
+            table,scale = archived[attr]
+
+            try:
+                fd = day_file(table, meter_id, day, scale)
+
+                if fd is not None:
+                    fd.write(archive.encode_record(timestamp, value.value, scale))
+            except Exception as e:
+                logger.error('Failed to archive value for {} ({})'.format(table, e))
+
+def flush():
+    for day,fd in open_files.values():
+        fd.flush()
+
+def idle():
+    # Hand buffered samples to the OS while there is nothing else to do
+    flush()
+
+def enabled_fields():
+    return list(archived.keys())
+
+def close_sink():
+    global active
+
+    if not active:
+        return
+
+    logger.info('Closing archive sink')
+
+    # The current day stays open so that it can be continued after a restart
+    for day,fd in open_files.values():
+        fd.close()
+
+    open_files.clear()
+
+    active = False
+
+def configure(archive_config):
+    # By default, all raw counters are archived
+    counters = archive_config.get('counters', None)
+
+    archived.clear()
+
+    for key,(counter,table,unit) in schema.dsmr_map.items():
+        if (counters is None and table.startswith('RAW_')) or (counters is not None and counter in counters):
+            archived[key] = (table, archive.scale_of(unit))
+
+            logger.info('Archiving counter {} ({}) in {}'.format(counter, key, archive.counter_dir(archive_dir, table)))
+
+def reload_sink(in_config):
+    if not active:
+        return
+
+    logger.info('Reloading configuration of archive sink')
+
+    if in_config['archive'].get('archive_dir', None) != archive_dir:
+        logger.warning('Changing archive_dir in the archive section requires a restart, keeping the current setting')
+
+    # Files of counters that are no longer archived are closed (and
+    # compacted) when their day is over, or at the next restart
+    configure(in_config['archive'])
+
+def init_sink(in_config, in_logger):
+    global logger
+    global archive_dir
+    global active
+
+    config = in_config
+    logger = in_logger
+
+    logger.info('Initialising archive sink')
+
+    if 'archive' not in config:
+        logger.info('No configuration for archive sink found, disabling it')
+        return
+
+    if 'archive_dir' not in config['archive']:
+        logger.error('Missing mandatory "archive_dir" field in archive configuration section')
+        return
+
+    archive_dir = config['archive']['archive_dir']
+    os.makedirs(archive_dir, exist_ok=True)
+
+    configure(config['archive'])
+    compact_stale()
+
+    active = True
+    logger.info('Initialisation of archive sink complete')
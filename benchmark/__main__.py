@@ -0,0 +1,5 @@
+#!/usr/bin/env python3
+
+from benchmark.run import main
+
+main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import random
+import datetime
+import zoneinfo
+
+# Timezone in which DSMR meters report their timestamps
+meter_tz = zoneinfo.ZoneInfo('Europe/Amsterdam')
+
+def crc16(data):
+    # CRC16/ARC as used for DSMR P1 telegrams
+    crc = 0
+
+    for byte in data:
+        crc ^= byte
+
+        for i in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+
+    return crc
+
+def dsmr_timestamp(timestamp):
+    local = datetime.datetime.fromtimestamp(timestamp, meter_tz)
+    dst = 'S' if local.dst() else 'W'
+
+    return local.strftime('%y%m%d%H%M%S') + dst
+
+class TelegramGenerator:
+    def __init__(self, phases=3, gas=True, tariffs=2, production=True, start=None, interval=1, seed=None):
+        if phases not in [1, 3]:
+            raise Exception('Unsupported number of phases ({}), must be 1 or 3'.format(phases))
+
+        if tariffs < 1 or tariffs > 4:
+            raise Exception('Unsupported number of tariffs ({}), must be between 1 and 4'.format(tariffs))
+
+        self.phases = phases
+        self.gas = gas
+        self.tariffs = tariffs
+        self.production = production
+        self.interval = interval
+        self.random = random.Random(seed)
+
+        if start is None:
+            start = int(datetime.datetime.now().timestamp())
+
+        self.timestamp = start
+
+        # Cumulative counters (kWh and m3)
+        self.used = [self.random.uniform(1000, 10000) for i in range(tariffs)]
+        self.delivered = [self.random.uniform(0, 5000) if production else 0.0 for i in range(tariffs)]
+        self.gas_reading = self.random.uniform(100, 5000)
+
+        # Instantaneous values per phase
+        self.voltage = [230.0] * phases
+        self.power_pos = [self.random.uniform(0.05, 1.0) for i in range(phases)]
+        self.power_neg = [0.0] * phases
+
+    def step(self):
+        # Random walk for the instantaneous values
+        for phase in range(self.phases):
+            self.voltage[phase] = min(max(self.voltage[phase] + self.random.gauss(0, 0.3), 215.0), 245.0)
+            self.power_pos[phase] = min(max(self.power_pos[phase] + self.random.gauss(0, 0.05), 0.0), 5.0)
+
+            if self.production:
+                self.power_neg[phase] = min(max(self.power_neg[phase] + self.random.gauss(0, 0.05), 0.0), 3.0)
+
+        tariff = self.current_tariff()
+
+        self.used[tariff] += sum(self.power_pos) * self.interval / 3600.0
+        self.delivered[tariff] += sum(self.power_neg) * self.interval / 3600.0
+        self.gas_reading += self.random.uniform(0, 0.0005) * self.interval
+
+    def current_tariff(self):
+        if self.tariffs == 1:
+            return 0
+
+        # Low tariff at night, high tariff during the day
+        hour = datetime.datetime.fromtimestamp(self.timestamp, meter_tz).hour
+
+        return 0 if hour < 7 or hour >= 23 else 1
+
+    def telegram(self):
+        lines = []
+
+        lines.append('/ISK5\\2M550T-1012')
+        lines.append('')
+        lines.append('1-3:0.2.8(50)')
+        lines.append('0-0:1.0.0({})'.format(dsmr_timestamp(self.timestamp)))
+        lines.append('0-0:96.1.1(4530303434303037313331363530363137)')
+
+        for tariff in range(self.tariffs):
+            lines.append('1-0:1.8.{}({:010.3f}*kWh)'.format(tariff + 1, self.used[tariff]))
+
+        for tariff in range(self.tariffs):
+            lines.append('1-0:2.8.{}({:010.3f}*kWh)'.format(tariff + 1, self.delivered[tariff]))
+
+        lines.append('0-0:96.14.0({:04d})'.format(self.current_tariff() + 1))
+        lines.append('1-0:1.7.0({:06.3f}*kW)'.format(sum(self.power_pos)))
+        lines.append('1-0:2.7.0({:06.3f}*kW)'.format(sum(self.power_neg)))
+        lines.append('0-0:96.7.21(00010)')
+        lines.append('0-0:96.7.9(00003)')
+        lines.append('1-0:99.97.0(0)(0-0:96.7.19)')
+
+        for phase in range(self.phases):
+            lines.append('1-0:{}.32.0({:05d})'.format(32 + 20 * phase, 0))
+
+        for phase in range(self.phases):
+            lines.append('1-0:{}.7.0({:05.1f}*V)'.format(32 + 20 * phase, self.voltage[phase]))
+
+        for phase in range(self.phases):
+            current = int((self.power_pos[phase] + self.power_neg[phase]) * 1000 / self.voltage[phase])
+            lines.append('1-0:{}.7.0({:03d}*A)'.format(31 + 20 * phase, current))
+
+        for phase in range(self.phases):
+            lines.append('1-0:{}.7.0({:06.3f}*kW)'.format(21 + 20 * phase, self.power_pos[phase]))
+
+        for phase in range(self.phases):
+            lines.append('1-0:{}.7.0({:06.3f}*kW)'.format(22 + 20 * phase, self.power_neg[phase]))
+
+        if self.gas:
+            lines.append('0-1:24.1.0(003)')
+            lines.append('0-1:96.1.0(4730303339303031363532303530323136)')
+            lines.append('0-1:24.2.1({})({:09.3f}*m3)'.format(dsmr_timestamp(self.timestamp - self.timestamp % 300), self.gas_reading))
+
+        body = '\r\n'.join(lines) + '\r\n!'
+
+        return '{}{:04X}\r\n'.format(body, crc16(body.encode('ascii')))
+
+    def next(self):
+        telegram = self.telegram()
+
+        self.timestamp += self.interval
+        self.step()
+
+        return telegram
+
+    def __iter__(self):
+        while True:
+            yield self.next()
+
+def write_capture(filename, count, **kwargs):
+    generator = TelegramGenerator(**kwargs)
+
+    with open(filename, 'w', newline='') as capture:
+        for i in range(count):
+            capture.write(generator.next())
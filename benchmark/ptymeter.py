@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import pty
+import tty
+import time
+import threading
+
+class PtyMeter:
+    # Local stand-in for a smart meter on a serial port; telegrams are
+    # written to the master side of a pseudo-terminal, and pymeter reads
+    # them from the slave side as if it were a serial device. Writes are
+    # paced to the given bit rate (10 bits per byte on the wire), or are
+    # not paced at all if the bit rate is 0. If a link is given, the port
+    # is a symbolic link to the pseudo-terminal, so that the meter can be
+    # disconnected and reconnected under the same name.
+    def __init__(self, telegrams, baudrate=115200, link=None):
+        self.telegrams = telegrams
+        self.baudrate = baudrate
+        self.link = link
+        self.sent = 0
+        self.bytes = 0
+        self.running = False
+
+        self.open()
+
+        self.port = os.ttyname(self.slave) if link is None else link
+
+        self.thread = threading.Thread(target=self.run, name='pty-meter', daemon=True)
+
+    def open(self):
+        self.master,self.slave = pty.openpty()
+
+        tty.setraw(self.slave)
+
+        if self.link is not None:
+            tmp_link = self.link + '.tmp'
+
+            if os.path.lexists(tmp_link):
+                os.unlink(tmp_link)
+
+            os.symlink(os.ttyname(self.slave), tmp_link)
+            os.replace(tmp_link, self.link)
+
+    def disconnect(self, downtime):
+        # Simulates unplugging the meter for the given time (in seconds);
+        # must be called from the thread that writes the telegrams, e.g.
+        # from the telegram iterator
+        os.close(self.master)
+        os.close(self.slave)
+
+        if self.link is not None:
+            os.unlink(self.link)
+
+        time.sleep(downtime)
+
+        self.open()
+
+    def run(self):
+        start = time.perf_counter()
+
+        for telegram in self.telegrams:
+            if not self.running:
+                break
+
+            data = telegram.encode('ascii') if isinstance(telegram, str) else telegram
+            view = memoryview(data)
+
+            while len(view) > 0:
+                written = os.write(self.master, view)
+                view = view[written:]
+
+            self.sent += 1
+            self.bytes += len(data)
+
+            if self.baudrate > 0:
+                delay = start + self.bytes * 10.0 / self.baudrate - time.perf_counter()
+
+                if delay > 0:
+                    time.sleep(delay)
+
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def wait(self):
+        self.thread.join()
+
+    def stop(self):
+        self.running = False
+
+        if self.thread.is_alive():
+            self.thread.join()
+
+        os.close(self.master)
+        os.close(self.slave)
+
+        if self.link is not None and os.path.lexists(self.link):
+            os.unlink(self.link)
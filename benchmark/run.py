@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import sqlite3
+import subprocess
+import serial
+import sqlitesink
+import influxsink
+import fastparser
+import serialreader
+from dsmr_parser import telegram_specifications
+from dsmr_parser.parsers import TelegramParser
+from dsmr_parser.clients.telegram_buffer import TelegramBuffer
+from benchmark.generator import TelegramGenerator
+from benchmark.stubinflux import StubInfluxServer
+from benchmark.ptymeter import PtyMeter
+
+def summarise(latencies, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    if count == 0:
+        return dict(count=0)
+
+    return dict(count=count,
+                total_s=elapsed,
+                throughput_per_s=count / elapsed if elapsed > 0 else None,
+                mean_us=1e6 * sum(latencies) / count,
+                p50_us=1e6 * latencies[int(0.50 * (count - 1))],
+                p99_us=1e6 * latencies[int(0.99 * (count - 1))],
+                max_us=1e6 * latencies[-1])
+
+def timed(fn, items):
+    latencies = []
+    start = time.perf_counter()
+
+    for item in items:
+        mark = time.perf_counter()
+        fn(item)
+        latencies.append(time.perf_counter() - mark)
+
+    return latencies, time.perf_counter() - start
+
+def generate(count, args):
+    generator = TelegramGenerator(phases=args.phases, gas=not args.no_gas, tariffs=args.tariffs, start=args.start, seed=args.seed)
+
+    return [generator.next() for i in range(count)]
+
+def timestamp_of(telegram):
+    for attr,value in telegram:
+        if attr == 'P1_MESSAGE_TIMESTAMP':
+            return int(value.value.timestamp())
+
+    return None
+
+def bench_parse(telegrams):
+    parser = TelegramParser(telegram_specifications.V5, True)
+
+    latencies,elapsed = timed(parser.parse, telegrams)
+
+    return summarise(latencies, elapsed)
+
+def bench_parse_fast(telegrams):
+    # Extracts all counters the sinks know about, which is the most the
+    # fast-path parser is ever asked to do
+    parser = fastparser.FastParser(list(sqlitesink.dsmr_map.keys()) + list(influxsink.dsmr_map.keys()))
+
+    latencies,elapsed = timed(parser.parse, telegrams)
+
+    result = summarise(latencies, elapsed)
+    result['fallbacks'] = parser.fallbacks
+
+    return result
+
+def readline_telegrams(serial_handle):
+    # The line-by-line reading that pymeter used before, for comparison
+    telegram_buffer = TelegramBuffer()
+
+    while True:
+        data = serial_handle.readline()
+
+        if len(data) == 0:
+            yield None
+            continue
+
+        telegram_buffer.append(data.decode('ascii', errors='replace'))
+
+        yield from telegram_buffer.get_all()
+
+def bench_serial(telegrams, baudrate, readline=False):
+    # Reads telegrams from a pty-based stand-in for the meter, written at
+    # the given bit rate (0 for as fast as possible)
+    meter = PtyMeter(telegrams, baudrate)
+    serial_handle = serial.Serial(port=meter.port, baudrate=115200, timeout=1)
+
+    if readline:
+        source = readline_telegrams(serial_handle)
+    else:
+        reader = serialreader.SerialReader(serial_handle, 1)
+        source = reader.telegrams()
+
+    received = 0
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+
+    meter.start()
+
+    try:
+        for telegram_str in source:
+            if telegram_str is None:
+                if not meter.running:
+                    break
+
+                continue
+
+            received += 1
+
+            if received == len(telegrams):
+                break
+
+        elapsed = time.perf_counter() - start
+        cpu = time.thread_time() - cpu_start
+    finally:
+        meter.stop()
+        serial_handle.close()
+
+    return dict(count=received,
+                lost=meter.sent - received,
+                total_s=elapsed,
+                throughput_per_s=received / elapsed if elapsed > 0 else None,
+                bits_per_s=10.0 * meter.bytes / elapsed if elapsed > 0 else None,
+                cpu_s=cpu,
+                cpu_us_per_telegram=1e6 * cpu / received if received > 0 else None)
+
+# Run in a fresh interpreter: import pymeter and initialise the sinks and
+# the parser for the given configuration, then report time and memory
+startup_script = '''
+import sys, json, time, logging, resource
+start = time.perf_counter()
+import pymeter, sinks, monitor
+config = json.loads(sys.argv[1])
+logger = logging.getLogger('pymeter')
+sinks.init_sinks(config, logger)
+monitor.init_monitor(config, logger)
+monitor.make_parser(dict(parser=sys.argv[2]), None, ())
+elapsed = time.perf_counter() - start
+sinks.close_sinks()
+# ru_maxrss survives exec on Linux, so it would report the benchmark's own
+# peak; VmHWM is reset for the new program
+try:
+    with open('/proc/self/status') as status:
+        max_rss = [int(line.split()[1]) for line in status if line.startswith('VmHWM:')][0]
+except Exception:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps(dict(startup_s=elapsed, max_rss_kb=max_rss, modules=len(sys.modules))))
+'''
+
+def bench_startup():
+    results = dict()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    with tempfile.TemporaryDirectory(prefix='pymeter-bench-') as tmpdir:
+        sqlite_config = dict(raw_db=os.path.join(tmpdir, 'raw.db'), current_consumption_id='1.7.0')
+        influx_config = dict(token='benchmark', org='benchmark', url='http://127.0.0.1:1', bucket='benchmark')
+
+        for name,config,parser in [('sqlite_fast', dict(legacy_database=sqlite_config), 'fast'),
+                                   ('sqlite_full', dict(legacy_database=sqlite_config), 'full'),
+                                   ('sqlite_influx_full', dict(legacy_database=sqlite_config, influx=influx_config), 'full')]:
+            output = subprocess.check_output([sys.executable, '-c', startup_script, json.dumps(config), parser], cwd=root, stderr=subprocess.DEVNULL)
+            results[name] = json.loads(output)
+
+    return results
+
+def create_tables(filename):
+    db = sqlite3.connect(filename)
+
+    for counter,table,unit in sqlitesink.dsmr_map.values():
+        db.execute('CREATE TABLE IF NOT EXISTS {} (timestamp INTEGER, value REAL, unit TEXT, meter TEXT);'.format(table))
+
+    db.commit()
+    db.close()
+
+def bench_sqlite(parsed, logger):
+    with tempfile.TemporaryDirectory(prefix='pymeter-bench-') as tmpdir:
+        config = dict(legacy_database=dict(current_consumption_id='1.7.0',
+                                           current_production_id='2.7.0',
+                                           other_raw_counters=['32.7.0', '52.7.0', '72.7.0', '31.7.0', '51.7.0', '71.7.0', '21.7.0', '41.7.0', '61.7.0'],
+                                           consumption=dict(low=dict(description='Low In', id='1.8.1'), high=dict(description='High In', id='1.8.2'), gas=dict(description='Gas', id='24.2.1')),
+                                           production=dict(low=dict(description='Low Out', id='2.8.1'), high=dict(description='High Out', id='2.8.2'))))
+
+        for key,name in [('raw_db', 'raw.db'), ('fivemin_avg', '5min.db'), ('hourly_avg', 'hourly.db'), ('total_consumed', 'consumed.db')]:
+            filename = os.path.join(tmpdir, name)
+            create_tables(filename)
+            config['legacy_database'][key] = filename
+
+        sqlitesink.init_sink(config, logger)
+
+        latencies,elapsed = timed(lambda item: sqlitesink.process_telegram(*item), parsed)
+
+        mark = time.perf_counter()
+        sqlitesink.close_sink()
+        close_time = time.perf_counter() - mark
+
+        result = summarise(latencies, elapsed)
+        result['close_s'] = close_time
+        result['db_bytes'] = sum([os.path.getsize(os.path.join(tmpdir, name)) for name in os.listdir(tmpdir)])
+
+        return result
+
+def bench_influx(parsed, logger):
+    server = StubInfluxServer()
+    server.start()
+
+    try:
+        config = dict(influx=dict(token='benchmark', org='benchmark', url=server.url(), bucket='benchmark'))
+
+        influxsink.init_sink(config, logger)
+
+        latencies,elapsed = timed(lambda item: influxsink.process_telegram(*item), parsed)
+
+        mark = time.perf_counter()
+        influxsink.close_sink()
+        close_time = time.perf_counter() - mark
+
+        result = summarise(latencies, elapsed)
+        result['close_s'] = close_time
+        result['http_requests'] = server.requests
+        result['points'] = server.points
+
+        return result
+    finally:
+        server.stop()
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def main():
+    argparser = argparse.ArgumentParser(description = 'pymeter benchmark suite')
+
+    argparser.add_argument('-n, --telegrams', help='number of telegrams per benchmark', type=int, dest='count', default=10000)
+    argparser.add_argument('--phases', help='number of phases (1 or 3)', type=int, default=3)
+    argparser.add_argument('--tariffs', help='number of tariffs (1 to 4)', type=int, default=2)
+    argparser.add_argument('--no-gas', help='leave out the gas meter reading', action='store_true')
+    argparser.add_argument('--start', help='timestamp of the first telegram', type=int, default=1700000001)
+    argparser.add_argument('--seed', help='random seed for the telegram generator', type=int, default=1)
+    argparser.add_argument('--baudrate', help='bit rate of the pty stand-in for the serial benchmarks (0 for unpaced)', type=int, default=0)
+    argparser.add_argument('--only', help='only run these benchmarks', nargs='+', choices=['startup', 'parse', 'parse_fast', 'serial', 'serial_readline', 'sqlite', 'influx'], default=['startup', 'parse', 'parse_fast', 'serial', 'serial_readline', 'sqlite', 'influx'])
+    argparser.add_argument('-o, --output', help='write results to this JSON file instead of stdout', type=str, dest='output', default=None)
+
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s [%(levelname)s] %(message)s')
+    logger = logging.getLogger('pymeter')
+
+    telegrams = generate(args.count, args)
+
+    parser = TelegramParser(telegram_specifications.V5, False)
+    parsed = []
+
+    for telegram_str in telegrams:
+        telegram = parser.parse(telegram_str)
+        parsed.append((timestamp_of(telegram), telegram))
+
+    results = dict(version=git_version(),
+                   timestamp=int(time.time()),
+                   python=platform.python_version(),
+                   machine=platform.machine(),
+                   platform=platform.platform(),
+                   telegrams=args.count,
+                   phases=args.phases,
+                   tariffs=args.tariffs,
+                   gas=not args.no_gas,
+                   benchmarks=dict())
+
+    if 'startup' in args.only:
+        results['benchmarks']['startup'] = bench_startup()
+
+    if 'parse' in args.only:
+        results['benchmarks']['parse'] = bench_parse(telegrams)
+
+    if 'parse_fast' in args.only:
+        results['benchmarks']['parse_fast'] = bench_parse_fast(telegrams)
+
+        if 'parse' in results['benchmarks']:
+            results['benchmarks']['parse_fast']['speedup'] = results['benchmarks']['parse']['mean_us'] / results['benchmarks']['parse_fast']['mean_us']
+
+    if 'serial' in args.only:
+        results['benchmarks']['serial'] = bench_serial(telegrams, args.baudrate)
+
+    if 'serial_readline' in args.only:
+        results['benchmarks']['serial_readline'] = bench_serial(telegrams, args.baudrate, True)
+
+    if 'sqlite' in args.only:
+        results['benchmarks']['sqlite'] = bench_sqlite(parsed, logger)
+
+    if 'influx' in args.only:
+        results['benchmarks']['influx'] = bench_influx(parsed, logger)
+
+    output = json.dumps(results, indent=4)
+
+    if args.output is not None:
+        with open(args.output, 'w') as out_fd:
+            out_fd.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
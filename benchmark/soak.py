@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from benchmark.generator import TelegramGenerator
+from benchmark.stubinflux import StubInfluxServer
+from benchmark.ptymeter import PtyMeter
+from benchmark.run import git_version
+
+# Soak test of the complete daemon. pymeter is started against a pty
+# stand-in for the meter, with temporary sqlite3 databases, a stub
+# InfluxDB server and the broadcast sink enabled. Telegrams are sent at a
+# fixed rate, optionally with faults injected; a subscriber on the
+# broadcast socket measures the end-to-end latency (from writing the
+# telegram to the pty to receiving it from pymeter) and which telegrams
+# were lost. Memory use and database size are sampled during the run.
+
+# Telegram timestamps advance by one second per telegram whatever the
+# rate, so that every telegram can be identified by its timestamp
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+daemon_config = '''
+logging: {{ loglevel = 2; filelog = "{tmpdir}/pymeter.log"; }};
+meter: {{ port = "{port}"; speed = 115200; bits = 8; parity = "none"; rts_cts = false; xon_xoff = false; parser = "{parser}"; meter_interval = 1; }};
+metrics: {{ listen = "127.0.0.1"; port = {metrics_port}; }};
+legacy_database:
+{{
+    raw_db = "{tmpdir}/raw.db"; fivemin_avg = "{tmpdir}/5min.db"; hourly_avg = "{tmpdir}/hourly.db";
+    total_consumed = "{tmpdir}/consumed.db"; ledger_db = "{tmpdir}/ledger.db";
+    checkpoint_file = "{tmpdir}/sqlite.checkpoint";
+    current_consumption_id = "1.7.0"; current_production_id = "2.7.0";
+    other_raw_counters = [ "32.7.0", "52.7.0", "72.7.0", "31.7.0", "51.7.0", "71.7.0" ];
+    total_interval = 300;
+    consumption: {{ low: {{ description = "Low In"; id = "1.8.1"; }}; high: {{ description = "High In"; id = "1.8.2"; }}; gas: {{ description = "Gas"; id = "24.2.1"; }}; }};
+    production: {{ low: {{ description = "Low Out"; id = "2.8.1"; }}; high: {{ description = "High Out"; id = "2.8.2"; }}; }};
+}};
+influx: {{ token = "soak"; org = "soak"; url = "{influx_url}"; bucket = "soak"; }};
+broadcast: {{ socket = "{tmpdir}/telegrams.sock"; ring_size = 1; max_pending = 16777216; }};
+'''
+
+class Source:
+    # Iterates over the telegrams to send, pacing them and injecting faults
+    def __init__(self, args, rate, meter_fn):
+        self.generator = TelegramGenerator(phases=args.phases, tariffs=args.tariffs, start=args.start, seed=args.seed)
+        self.random = random.Random(args.seed)
+        self.args = args
+        self.rate = rate
+        self.meter_fn = meter_fn
+        self.sent = dict()
+        self.after_partial = set()
+        self.lock = threading.Lock()
+        self.crc_errors = 0
+        self.partial = 0
+        self.disconnects = 0
+        self.downtime = 0.0
+        self.valid = 0
+        self.stopped = False
+
+    def __iter__(self):
+        burst = max(1, self.args.burst)
+        period = burst / self.rate
+        next_send = time.perf_counter()
+        last_disconnect = next_send
+        previous_partial = False
+
+        while not self.stopped:
+            for i in range(burst):
+                timestamp = self.generator.timestamp
+                telegram = self.generator.next()
+                fault = self.random.random()
+                partial = False
+
+                if fault < self.args.crc_errors:
+                    # Damage a value, so that the CRC no longer matches
+                    pos = telegram.index(':1.7.0(') + 7
+                    telegram = telegram[:pos] + ('1' if telegram[pos] != '1' else '2') + telegram[pos + 1:]
+                    self.crc_errors += 1
+                elif fault < self.args.crc_errors + self.args.partial:
+                    # The meter stops halfway and starts the next telegram
+                    telegram = telegram[:len(telegram) // 2]
+                    self.partial += 1
+                    partial = True
+                else:
+                    # The telegram following a partial one may be read
+                    # together with it, and is then lost as well
+                    if previous_partial:
+                        self.after_partial.add(timestamp)
+
+                    with self.lock:
+                        self.sent[timestamp] = time.perf_counter()
+
+                    self.valid += 1
+
+                previous_partial = partial
+
+                yield telegram
+
+            next_send += period
+            delay = next_send - time.perf_counter()
+
+            if delay > 0:
+                time.sleep(delay)
+
+            if self.args.disconnect_every > 0 and time.perf_counter() - last_disconnect >= self.args.disconnect_every:
+                disconnected = time.perf_counter()
+                self.meter_fn().disconnect(self.args.disconnect_time)
+                self.disconnects += 1
+                self.downtime += time.perf_counter() - disconnected
+
+                # Catch up gradually rather than in one burst
+                next_send = last_disconnect = time.perf_counter()
+
+class Subscriber:
+    # Receives all telegrams from the broadcast socket and records latency
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+        self.received = 0
+        self.duplicates = 0
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='soak-subscriber', daemon=True)
+
+    def connect(self):
+        while True:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.path)
+                sock.sendall(b'json 1.7.0\n')
+                return sock
+            except OSError:
+                sock.close()
+                time.sleep(0.1)
+
+    def run(self):
+        sock = self.connect()
+        buf = b''
+
+        while True:
+            data = sock.recv(65536)
+
+            if len(data) == 0:
+                break
+
+            now = time.perf_counter()
+            lines = (buf + data).split(b'\n')
+            buf = lines.pop()
+
+            for line in lines:
+                timestamp = json.loads(line)['timestamp']
+
+                with self.source.lock:
+                    sent = self.source.sent.pop(timestamp, None)
+
+                with self.lock:
+                    if sent is None:
+                        self.duplicates += 1
+                    else:
+                        self.received += 1
+                        self.latencies.append(now - sent)
+
+    def start(self):
+        self.thread.start()
+
+    def take_latencies(self):
+        with self.lock:
+            latencies = self.latencies
+            self.latencies = []
+
+        return latencies
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def rss_kb(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            return [int(line.split()[1]) for line in status if line.startswith('VmRSS:')][0]
+    except Exception:
+        return None
+
+def db_bytes(tmpdir):
+    return sum([os.path.getsize(os.path.join(tmpdir, name)) for name in os.listdir(tmpdir) if '.db' in name])
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+
+    return values[int(fraction * (len(values) - 1))]
+
+def slope_per_hour(samples, key):
+    # Least-squares slope of a sampled value, per hour
+    points = [(sample['elapsed_s'], sample[key]) for sample in samples if sample[key] is not None]
+
+    if len(points) < 2:
+        return None
+
+    mean_t = sum([t for t,v in points]) / len(points)
+    mean_v = sum([v for t,v in points]) / len(points)
+    var_t = sum([(t - mean_t) ** 2 for t,v in points])
+
+    if var_t == 0:
+        return None
+
+    return 3600 * sum([(t - mean_t) * (v - mean_v) for t,v in points]) / var_t
+
+def read_metrics(port):
+    # Returns the counters from the metrics endpoint, summed over labels
+    totals = dict()
+
+    try:
+        text = urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(port), timeout=5).read().decode()
+    except Exception:
+        return totals
+
+    for line in text.splitlines():
+        if line.startswith('#') or not line.endswith(tuple('0123456789')):
+            continue
+
+        name,value = line.rsplit(' ', 1)
+        name = name.split('{')[0]
+
+        if name.endswith('_total'):
+            totals[name] = totals.get(name, 0) + float(value)
+
+    return totals
+
+def count_rows(filename, table):
+    db = sqlite3.connect(filename)
+
+    try:
+        return db.execute('SELECT COUNT(*) FROM {};'.format(table)).fetchone()[0]
+    finally:
+        db.close()
+
+def soak(args, rate):
+    with tempfile.TemporaryDirectory(prefix='pymeter-soak-') as tmpdir:
+        influx = StubInfluxServer(field='total_power_used')
+        influx.start()
+
+        meter = None
+        source = Source(args, rate, lambda: meter)
+        meter = PtyMeter(source, 0, os.path.join(tmpdir, 'ttyMETER'))
+        metrics_port = free_port()
+
+        config_file = os.path.join(tmpdir, 'pymeter.conf')
+
+        with open(config_file, 'w') as cfg_fd:
+            cfg_fd.write(daemon_config.format(tmpdir=tmpdir, port=meter.port, parser=args.parser, metrics_port=metrics_port, influx_url=influx.url()))
+
+        with open(os.path.join(tmpdir, 'stderr.log'), 'w') as stderr_fd:
+            daemon = subprocess.Popen([sys.executable, os.path.join(root, 'pymeter.py'), '-c', config_file], cwd=root, stdout=subprocess.DEVNULL, stderr=stderr_fd)
+
+        subscriber = Subscriber(os.path.join(tmpdir, 'telegrams.sock'), source)
+        subscriber.start()
+
+        # Give pymeter time to open the port before the first telegram
+        time.sleep(args.warmup)
+
+        samples = []
+        db_bytes_start = db_bytes(tmpdir)
+        start = time.perf_counter()
+
+        meter.start()
+
+        try:
+            while time.perf_counter() - start < args.duration and daemon.poll() is None:
+                time.sleep(args.sample_interval)
+
+                latencies = subscriber.take_latencies()
+                sample = dict(elapsed_s=round(time.perf_counter() - start, 1),
+                              sent=source.valid,
+                              received=subscriber.received,
+                              latency_p50_ms=None if len(latencies) == 0 else 1000 * percentile(latencies, 0.50),
+                              latency_p99_ms=None if len(latencies) == 0 else 1000 * percentile(latencies, 0.99),
+                              latency_max_ms=None if len(latencies) == 0 else 1000 * max(latencies),
+                              rss_kb=rss_kb(daemon.pid),
+                              db_bytes=db_bytes(tmpdir),
+                              influx_points=influx.points)
+                samples.append(sample)
+
+                if not args.quiet:
+                    sys.stderr.write('{:>4} Hz {:>7.1f}s: sent {} received {} p99 {} ms, RSS {} kB, databases {} kB\n'.format(rate, sample['elapsed_s'], sample['sent'], sample['received'], 'n/a' if sample['latency_p99_ms'] is None else '{:.1f}'.format(sample['latency_p99_ms']), sample['rss_kb'], sample['db_bytes'] // 1024))
+        finally:
+            source.stopped = True
+            elapsed = time.perf_counter() - start
+
+            # Telegrams still in flight get a moment to arrive
+            time.sleep(args.sample_interval)
+
+            counters = read_metrics(metrics_port)
+            crashed = daemon.poll() is not None
+
+            # Stop pymeter the way systemd does; it should commit all
+            # buffered rows before it exits
+            if not crashed:
+                daemon.send_signal(signal.SIGTERM)
+
+            try:
+                daemon.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                daemon.kill()
+                daemon.wait()
+
+            # The InfluxDB sink writes its last batch when it is closed
+            influx_saved = influx.field_points
+
+            meter.stop()
+            influx.stop()
+
+        raw_rows = count_rows(os.path.join(tmpdir, 'raw.db'), 'RAW_1_7_0')
+
+    # The meter sends nothing while it is disconnected
+    sending = elapsed - source.downtime
+
+    all_latencies = [sample['latency_p99_ms'] for sample in samples if sample['latency_p99_ms'] is not None]
+    lost_after_partial = len(source.after_partial & source.sent.keys())
+    lost = source.valid - subscriber.received - lost_after_partial
+
+    # Telegrams that pymeter processed, but that were not in the database
+    # after it stopped
+    unsaved = subscriber.received - raw_rows
+    unsent = subscriber.received - influx_saved
+
+    result = dict(rate_hz=rate,
+                  duration_s=elapsed,
+                  achieved_rate_hz=(source.valid + source.crc_errors + source.partial) / sending if sending > 0 else None,
+                  sent=source.valid,
+                  received=subscriber.received,
+                  lost=lost,
+                  lost_after_partial=lost_after_partial,
+                  duplicates=subscriber.duplicates,
+                  raw_rows=raw_rows,
+                  unsaved_rows=unsaved,
+                  unsent_points=unsent,
+                  exit_code=daemon.returncode,
+                  injected=dict(crc_errors=source.crc_errors, partial=source.partial, disconnects=source.disconnects, downtime_s=source.downtime),
+                  daemon_counters=counters,
+                  crashed=crashed,
+                  latency_p99_ms_worst=max(all_latencies) if len(all_latencies) > 0 else None,
+                  rss_kb_start=samples[0]['rss_kb'] if len(samples) > 0 else None,
+                  rss_kb_end=samples[-1]['rss_kb'] if len(samples) > 0 else None,
+                  rss_kb_per_hour=slope_per_hour(samples, 'rss_kb'),
+                  db_bytes_end=samples[-1]['db_bytes'] if len(samples) > 0 else None,
+                  db_bytes_per_hour=slope_per_hour(samples, 'db_bytes'),
+                  db_bytes_per_telegram=(samples[-1]['db_bytes'] - db_bytes_start) / source.valid if len(samples) > 0 and source.valid > 0 else None,
+                  influx_points=samples[-1]['influx_points'] if len(samples) > 0 else None,
+                  samples=samples)
+
+    # A rate is sustained if pymeter kept up: nothing lost other than what
+    # was in flight when the meter was disconnected (at most a second's
+    # worth each time), everything saved and sent at shutdown, and latency
+    # within bounds
+    result['sustained'] = (not crashed and unsaved <= 0 and unsent <= 0 and lost <= source.disconnects * max(args.burst, rate) and result['latency_p99_ms_worst'] is not None and result['latency_p99_ms_worst'] <= args.max_latency and result['achieved_rate_hz'] is not None and result['achieved_rate_hz'] >= 0.95 * rate)
+
+    return result
+
+def main():
+    argparser = argparse.ArgumentParser(description = 'pymeter soak test against a virtual meter')
+
+    argparser.add_argument('--rates', help='telegram rates to test, in telegrams per second', nargs='+', type=float, default=[1.0])
+    argparser.add_argument('--duration', help='duration of the run at each rate (in seconds)', type=float, default=60)
+    argparser.add_argument('--sample-interval', help='how often to sample memory use, database size and latency (in seconds)', type=float, dest='sample_interval', default=5)
+    argparser.add_argument('--warmup', help='time to give pymeter to start before sending telegrams (in seconds)', type=float, default=2)
+    argparser.add_argument('--parser', help='telegram parser to use in pymeter', choices=['full', 'fast'], default='fast')
+    argparser.add_argument('--phases', help='number of phases (1 or 3)', type=int, default=3)
+    argparser.add_argument('--tariffs', help='number of tariffs (1 to 4)', type=int, default=2)
+    argparser.add_argument('--start', help='timestamp of the first telegram', type=int, default=1700000001)
+    argparser.add_argument('--seed', help='random seed for the telegram generator and fault injection', type=int, default=1)
+    argparser.add_argument('--crc-errors', help='fraction of telegrams sent with a CRC error', type=float, dest='crc_errors', default=0.0)
+    argparser.add_argument('--partial', help='fraction of telegrams cut off halfway', type=float, default=0.0)
+    argparser.add_argument('--burst', help='send telegrams in bursts of this many, at the same average rate', type=int, default=1)
+    argparser.add_argument('--disconnect-every', help='disconnect the meter every this many seconds (0 for never)', type=float, dest='disconnect_every', default=0)
+    argparser.add_argument('--disconnect-time', help='how long the meter stays disconnected (in seconds)', type=float, dest='disconnect_time', default=2)
+    argparser.add_argument('--max-latency', help='highest 99th percentile latency (in ms) for a rate to count as sustained', type=float, dest='max_latency', default=1000)
+    argparser.add_argument('-q, --quiet', help='do not report progress', action='store_true', dest='quiet')
+    argparser.add_argument('-o, --output', help='write results to this JSON file instead of stdout', type=str, dest='output', default=None)
+
+    args = argparser.parse_args()
+
+    results = dict(version=git_version(),
+                   timestamp=int(time.time()),
+                   python=platform.python_version(),
+                   machine=platform.machine(),
+                   platform=platform.platform(),
+                   parser=args.parser,
+                   runs=[])
+
+    for rate in args.rates:
+        results['runs'].append(soak(args, rate))
+
+    sustained = [run['rate_hz'] for run in results['runs'] if run['sustained']]
+    results['max_sustained_rate_hz'] = max(sustained) if len(sustained) > 0 else None
+
+    output = json.dumps(results, indent=4)
+
+    if args.output is not None:
+        with open(args.output, 'w') as out_fd:
+            out_fd.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
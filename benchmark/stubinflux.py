@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import threading
+import http.server
+
+class StubInfluxHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+
+        if self.headers.get('Content-Encoding', None) == 'gzip':
+            data = gzip.decompress(data)
+
+        with self.server.stats_lock:
+            self.server.requests += 1
+            self.server.points += data.count(b'\n') + (0 if data.endswith(b'\n') or len(data) == 0 else 1)
+            self.server.bytes += len(data)
+
+            if self.server.field is not None:
+                self.server.field_points += data.count(self.server.field)
+
+        self.send_response(204)
+        self.end_headers()
+
+    def do_GET(self):
+        # Health checks and the like
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"status":"pass"}')
+
+    def log_message(self, format, *args):
+        pass
+
+class StubInfluxServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    # If a field is given, the points that carry it are counted as well
+    def __init__(self, port=0, field=None):
+        super().__init__(('127.0.0.1', port), StubInfluxHandler)
+
+        self.stats_lock = threading.Lock()
+        self.requests = 0
+        self.points = 0
+        self.bytes = 0
+        self.field = field.encode('ascii') + b'=' if field is not None else None
+        self.field_points = 0
+
+        self.thread = threading.Thread(target=self.serve_forever, name='stub-influx', daemon=True)
+
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import socket
+import logging
+import selectors
+import threading
+import collections
+import metrics
+import schema
+
+# Broadcast of telegrams to local subscribers over a Unix domain socket.
+# A subscriber connects and sends one line with the format it wants
+# ("json" or "msgpack") optionally followed by the OBIS codes it is
+# interested in, e.g. "json 1.7.0 2.7.0"; an empty line subscribes to all
+# values as JSON. It then receives the last telegrams from the ring buffer,
+# followed by each new telegram as it arrives. JSON messages are separated
+# by newlines, msgpack messages are self-delimiting.
+#
+# Messages are written by a separate thread using non-blocking sockets, so
+# that subscribers never hold up the sink; a subscriber that falls too far
+# behind is disconnected.
+
+logger = None
+
+# Path of the socket, and its permissions
+socket_path = None
+socket_mode = 0o660
+
+# Number of telegrams kept for new subscribers
+ring_size = 60
+
+# Number of bytes that may wait to be sent to a subscriber before it is
+# disconnected
+max_pending = 262144
+
+# Maximum length of a subscription line
+max_request = 4096
+
+# Number of telegrams that may wait to be sent out, in case the sending
+# thread cannot keep up
+max_queued = 10000
+
+# DSMR names and OBIS codes of the broadcast values
+obis_codes = dict()
+
+# Telegrams waiting to be sent out, and the telegrams sent out most
+# recently                                          = (timestamp, meter, {OBIS code: value})
+queued = collections.deque(maxlen=max_queued)
+ring = collections.deque(maxlen=ring_size)
+
+listener = None
+selector = None
+server_thread = None
+wake_r = None
+wake_w = None
+subscribers = dict()
+running = False
+
+msgpack = None
+
+# Is this sink active?
+active = False
+
+class Subscriber:
+    def __init__(self, sock):
+        self.sock = sock
+        self.request = bytearray()
+        self.out = bytearray()
+        self.encode = None
+        self.codes = None
+
+    def subscribe(self, line):
+        # Parses the subscription line; returns an error message, or None
+        fields = line.decode('ascii', errors='replace').split()
+        fmt = fields[0] if len(fields) > 0 else 'json'
+
+        if fmt == 'json':
+            self.encode = encode_json
+        elif fmt == 'msgpack':
+            if load_msgpack() is None:
+                return 'msgpack is not available'
+
+            self.encode = encode_msgpack
+        else:
+            return 'unknown format {}'.format(fmt)
+
+        if len(fields) > 1:
+            self.codes = set(fields[1:])
+
+        return None
+
+    def queue(self, entries):
+        for timestamp,meter_id,values in entries:
+            if self.codes is not None:
+                values = {code: value for code,value in values.items() if code in self.codes}
+
+                if len(values) == 0:
+                    continue
+
+            message = dict(timestamp=timestamp, values=values)
+
+            if meter_id is not None:
+                message['meter'] = meter_id
+
+            self.out += self.encode(message)
+
+def load_msgpack():
+    global msgpack
+
+    if msgpack is None:
+        try:
+            import msgpack as module
+            msgpack = module
+        except ImportError:
+            return None
+
+    return msgpack
+
+def encode_json(message):
+    return json.dumps(message, separators=(',', ':')).encode('ascii') + b'\n'
+
+def encode_msgpack(message):
+    return msgpack.packb(message)
+
+def process_telegram(timestamp, telegram, meter_id=None):
+    if not active:
+        return
+
+    values = dict()
+
+    for attr,value in telegram:
+        if attr in obis_codes:
+            values[obis_codes[attr]] = float(value.value)
+
+    queued.append((timestamp, meter_id, values))
+
+    wake()
+
+def wake():
+    try:
+        os.write(wake_w, b'\0')
+    except BlockingIOError:
+        # A wake up is already pending
+        pass
+
+def drop(subscriber, reason):
+    logger.info('Disconnecting broadcast subscriber ({})'.format(reason))
+
+    selector.unregister(subscriber.sock)
+    subscriber.sock.close()
+
+    del subscribers[subscriber.sock]
+
+def update_events(subscriber):
+    events = selectors.EVENT_READ
+
+    if len(subscriber.out) > 0:
+        events |= selectors.EVENT_WRITE
+
+    selector.modify(subscriber.sock, events, subscriber)
+
+def send(subscriber):
+    # Writes what the socket will take; returns False if the subscriber was
+    # disconnected
+    try:
+        sent = subscriber.sock.send(subscriber.out)
+        del subscriber.out[:sent]
+    except BlockingIOError:
+        pass
+    except OSError as e:
+        drop(subscriber, e)
+        return False
+
+    if len(subscriber.out) > max_pending:
+        metrics.inc('pymeter_broadcast_disconnected_total')
+        drop(subscriber, 'too far behind')
+        return False
+
+    update_events(subscriber)
+
+    return True
+
+def accept():
+    try:
+        sock,_ = listener.accept()
+    except BlockingIOError:
+        return
+
+    sock.setblocking(False)
+
+    subscriber = Subscriber(sock)
+    subscribers[sock] = subscriber
+
+    selector.register(sock, selectors.EVENT_READ, subscriber)
+
+def receive(subscriber):
+    try:
+        data = subscriber.sock.recv(max_request)
+    except BlockingIOError:
+        return
+    except OSError as e:
+        drop(subscriber, e)
+        return
+
+    if len(data) == 0:
+        drop(subscriber, 'closed by subscriber')
+        return
+
+    # Anything sent after the subscription line is ignored
+    if subscriber.encode is not None:
+        return
+
+    subscriber.request += data
+
+    if b'\n' not in subscriber.request:
+        if len(subscriber.request) > max_request:
+            drop(subscriber, 'subscription line too long')
+
+        return
+
+    error = subscriber.subscribe(subscriber.request[:subscriber.request.index(b'\n')])
+
+    if error is not None:
+        try:
+            subscriber.sock.send(encode_json(dict(error=error)))
+        except OSError:
+            pass
+
+        drop(subscriber, error)
+        return
+
+    logger.info('New broadcast subscriber for {}'.format('all values' if subscriber.codes is None else ', '.join(sorted(subscriber.codes))))
+
+    subscriber.queue(ring)
+    send(subscriber)
+
+def serve():
+    while running:
+        for key,events in selector.select():
+            if key.fileobj is listener:
+                accept()
+            elif key.fileobj == wake_r:
+                os.read(wake_r, 4096)
+
+                # Only this thread takes telegrams from the queue and adds
+                # them to the ring, so new subscribers get each telegram
+                # either from the ring or as it is sent out, never twice
+                entries = []
+
+                while len(queued) > 0:
+                    entries.append(queued.popleft())
+
+                ring.extend(entries)
+
+                for subscriber in list(subscribers.values()):
+                    if subscriber.encode is not None:
+                        subscriber.queue(entries)
+                        send(subscriber)
+            elif key.data.sock in subscribers:
+                if events & selectors.EVENT_READ:
+                    receive(key.data)
+
+                if events & selectors.EVENT_WRITE and key.data.sock in subscribers:
+                    send(key.data)
+
+def enabled_fields():
+    return list(obis_codes.keys())
+
+def flush():
+    pass
+
+def close_sink():
+    global running
+    global active
+
+    if not active:
+        return
+
+    logger.info('Closing broadcast sink')
+
+    active = False
+    running = False
+
+    wake()
+    server_thread.join()
+
+    for sock in list(subscribers.keys()):
+        sock.close()
+
+    subscribers.clear()
+
+    selector.close()
+    listener.close()
+    os.close(wake_r)
+    os.close(wake_w)
+
+    try:
+        os.unlink(socket_path)
+    except OSError:
+        pass
+
+def init_sink(in_config, in_logger):
+    global logger
+    global socket_path
+    global socket_mode
+    global ring_size
+    global max_pending
+    global ring
+    global listener
+    global selector
+    global server_thread
+    global wake_r
+    global wake_w
+    global running
+    global active
+
+    config = in_config
+    logger = in_logger
+
+    logger.info('Initialising broadcast sink')
+
+    if 'broadcast' not in config:
+        logger.info('No configuration for broadcast sink found, disabling it')
+        return
+
+    if 'socket' not in config['broadcast']:
+        logger.error('Missing mandatory "socket" field in broadcast configuration section')
+        return
+
+    socket_path = config['broadcast']['socket']
+    socket_mode = int(str(config['broadcast'].get('socket_mode', '0660')), 8)
+    ring_size = config['broadcast'].get('ring_size', ring_size)
+    max_pending = config['broadcast'].get('max_pending', max_pending)
+    ring = collections.deque(maxlen=ring_size)
+
+    # By default, all values are broadcast
+    counters = config['broadcast'].get('counters', None)
+
+    for key,(counter,table,unit) in schema.dsmr_map.items():
+        if counters is None or counter in counters:
+            obis_codes[key] = counter
+
+    # Remove a socket left behind by an earlier run
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    os.chmod(socket_path, socket_mode)
+    listener.listen(16)
+    listener.setblocking(False)
+
+    wake_r,wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    selector.register(wake_r, selectors.EVENT_READ)
+
+    metrics.add_gauge('pymeter_broadcast_subscribers', lambda: len(subscribers))
+
+    running = True
+    server_thread = threading.Thread(target=serve, name='broadcast', daemon=True)
+    server_thread.start()
+
+    logger.info('Broadcasting {} values on {} to subscribers, keeping the last {} telegrams for new subscribers'.format(len(obis_codes), socket_path, ring_size))
+
+    active = True
+    logger.info('Initialisation of broadcast sink complete')
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+
+# Checkpoints of in-memory state that should survive a restart. A
+# checkpoint is a JSON document that is written to a temporary file and
+# then renamed over the previous one, so that a crash while writing never
+# leaves a damaged checkpoint behind.
+
+version = 1
+
+def save(filename, state):
+    document = dict(version=version, written=int(time.time()), state=state)
+    tmp_file = filename + '.tmp'
+
+    with open(tmp_file, 'w') as checkpoint_fd:
+        json.dump(document, checkpoint_fd, separators=(',', ':'))
+        checkpoint_fd.flush()
+        os.fsync(checkpoint_fd.fileno())
+
+    os.replace(tmp_file, filename)
+
+def load(filename):
+    # Returns the saved state and the time it was written, or (None, None)
+    # if there is no usable checkpoint
+    if not os.path.exists(filename):
+        return None, None
+
+    with open(filename, 'r') as checkpoint_fd:
+        document = json.load(checkpoint_fd)
+
+    if document.get('version', None) != version:
+        return None, None
+
+    return document['state'], document['written']
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import logging
+import metrics
+import schema
+
+logger = None
+
+# Supported compression methods
+methods = ['exact', 'deadband', 'percent', 'swinging-door']
+
+# Default maximum interval (in seconds) between stored values
+default_max_gap = 300
+
+# Compression rules per DSMR field name             = (method, deviation, max gap)
+rules = dict()
+
+# Filter state per (sink, meter, DSMR field name)
+filters = dict()
+
+class ExactFilter:
+    # Stores a value only when it differs from the last stored value
+    def __init__(self, deviation, max_gap):
+        self.max_gap = max_gap
+        self.last = None
+
+    def changed(self, value):
+        return value != self.last[1]
+
+    def add(self, timestamp, value):
+        if self.last is None or self.changed(value) or timestamp - self.last[0] >= self.max_gap:
+            self.last = (timestamp, value)
+            return [self.last]
+
+        return []
+
+    def flush(self):
+        return []
+
+class DeadbandFilter(ExactFilter):
+    # Stores a value when it is more than the deviation away from the last
+    # stored value
+    def __init__(self, deviation, max_gap):
+        super().__init__(deviation, max_gap)
+        self.deviation = deviation
+
+    def changed(self, value):
+        return abs(value - self.last[1]) > self.deviation
+
+class PercentFilter(DeadbandFilter):
+    # Like the deadband filter, with the deviation as a percentage of the
+    # last stored value
+    def changed(self, value):
+        return abs(value - self.last[1]) > abs(self.last[1]) * self.deviation / 100.0
+
+class SwingingDoorFilter:
+    # Swinging door trending; stores the points needed to reconstruct the
+    # signal by linear interpolation within the deviation. As the decision
+    # to store a point is made when the next point arrives, stored points
+    # lag one sample behind.
+    def __init__(self, deviation, max_gap):
+        self.deviation = deviation
+        self.max_gap = max_gap
+        self.archived = None
+        self.last = None
+        self.upper = None
+        self.lower = None
+
+    def open_door(self, timestamp, value):
+        dt = timestamp - self.archived[0]
+
+        self.upper = (value + self.deviation - self.archived[1]) / dt
+        self.lower = (value - self.deviation - self.archived[1]) / dt
+
+    def add(self, timestamp, value):
+        if self.archived is None:
+            self.archived = (timestamp, value)
+            self.last = None
+            return [self.archived]
+
+        if timestamp <= self.archived[0]:
+            return []
+
+        if self.last is None:
+            self.open_door(timestamp, value)
+            self.last = (timestamp, value)
+            return []
+
+        dt = timestamp - self.archived[0]
+        slope = (value - self.archived[1]) / dt
+
+        if slope > self.upper or slope < self.lower or dt > self.max_gap:
+            # The line to this point leaves the corridor of the points in
+            # between (or the gap is too long); store the previous point
+            # and open a new door from there
+            self.archived = self.last
+            self.open_door(timestamp, value)
+            self.last = (timestamp, value)
+            return [self.archived]
+
+        self.upper = min(self.upper, (value + self.deviation - self.archived[1]) / dt)
+        self.lower = max(self.lower, (value - self.deviation - self.archived[1]) / dt)
+        self.last = (timestamp, value)
+
+        return []
+
+    def flush(self):
+        # Store the last point that is still held back
+        if self.last is None:
+            return []
+
+        self.archived = self.last
+        self.last = None
+
+        return [self.archived]
+
+filter_classes = {'exact': ExactFilter, 'deadband': DeadbandFilter, 'percent': PercentFilter, 'swinging-door': SwingingDoorFilter}
+
+def filter_value(sink, meter_id, attr, timestamp, value):
+    # Returns the list of (timestamp, value) pairs that the sink should store
+    if attr not in rules:
+        return [(timestamp, value)]
+
+    key = (sink, meter_id, attr)
+    value_filter = filters.get(key, None)
+
+    if value_filter is None:
+        method,deviation,max_gap = rules[attr]
+        value_filter = filter_classes[method](deviation, max_gap)
+        filters[key] = value_filter
+
+    result = value_filter.add(timestamp, float(value))
+
+    if len(result) == 0:
+        metrics.inc('pymeter_sink_compressed_total', labels=(('sink', sink),))
+
+    return result
+
+def flush(sink):
+    # Returns the held back values for a sink as (meter, DSMR field name,
+    # timestamp, value), e.g. at shutdown
+    result = []
+
+    for (filter_sink,meter_id,attr),value_filter in filters.items():
+        if filter_sink == sink:
+            for timestamp,value in value_filter.flush():
+                result.append((meter_id, attr, timestamp, value))
+
+    return result
+
+def init_compression(in_config, in_logger):
+    global logger
+
+    config = in_config
+    logger = in_logger
+
+    rules.clear()
+    filters.clear()
+
+    if 'compression' not in config:
+        return
+
+    for rule in config['compression']:
+        method = rule.get('method', 'exact')
+        deviation = float(rule.get('deviation', 0))
+        max_gap = rule.get('max_gap', default_max_gap)
+
+        if method not in methods:
+            raise Exception('Unsupported compression method "{}" specified in the configuration'.format(method))
+
+        for counter in rule.get('counters', []):
+            names = [key for key,val in schema.dsmr_map.items() if val[0] == counter]
+
+            if len(names) == 0:
+                logger.warning('No mapping for counter {}, not compressing it'.format(counter))
+                continue
+
+            for name in names:
+                rules[name] = (method, deviation, max_gap)
+
+            logger.info('Compressing counter {} using {} (deviation {}, storing at least every {}s)'.format(counter, method, deviation, max_gap))
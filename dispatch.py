@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import logging
+import threading
+import queue
+import pickle
+import struct
+import time
+import metrics
+
+logger = None
+
+# Workers for the active sinks
+workers = []
+
+# Default queue size and overflow policy for a sink
+default_queue_size = 600
+default_overflow = 'drop-oldest'
+
+# Supported overflow policies
+overflow_policies = ['block', 'drop-oldest', 'spill']
+
+# Maximum number of spilled telegrams to read back in one go
+spill_chunk = 100
+
+# Maximum number of telegrams waiting to be written to a spill file; the
+# file is written by a separate thread, so that a slow disk does not hold
+# up reading the meter
+max_spill_buffer = 10000
+
+# How often to check for newly spilled telegrams (in seconds)
+spill_poll = 0.05
+
+# How long to wait for a sink to apply a new configuration (in seconds)
+reload_timeout = 10
+
+class SinkWorker:
+    def __init__(self, name, sink, queue_size, overflow, spill_file):
+        self.name = name
+        self.sink = sink
+        self.overflow = overflow
+        self.spill_file = spill_file
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.labels = (('sink', name),)
+
+        # Spill state; once we start spilling, new telegrams keep going to
+        # the spill file until it has been drained to preserve ordering.
+        # Telegrams to spill are buffered in memory and written to the file
+        # by the spill thread; only the spill thread appends to the file,
+        # and it is only truncated when nothing is waiting to be written
+        self.spill_lock = threading.Lock()
+        self.spill_wanted = threading.Condition(self.spill_lock)
+        self.spilling = False
+        self.spill_buffer = []
+        self.spill_writing = False
+        self.spill_size = 0
+        self.spill_read_pos = 0
+        self.spill_backlog = False
+        self.spill_thread = None
+        self.stopping = False
+
+        # Configuration to apply in the worker thread
+        self.new_config = None
+        self.reloaded = threading.Event()
+
+        if self.overflow == 'spill' and os.path.exists(self.spill_file) and os.path.getsize(self.spill_file) > 0:
+            logger.info('Found spilled telegrams for sink {} in {}, will process these first'.format(self.name, self.spill_file))
+            self.spill_size = self.trim_spill_file()
+            self.spilling = True
+
+        self.thread = threading.Thread(target=self.run, name='sink-{}'.format(name), daemon=True)
+
+        if self.overflow == 'spill':
+            self.spill_thread = threading.Thread(target=self.write_spilled, name='spill-{}'.format(name), daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+        if self.spill_thread is not None:
+            self.spill_thread.start()
+
+    def put(self, item):
+        if self.overflow == 'block':
+            self.queue.put(item)
+        elif self.overflow == 'drop-oldest':
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.dropped += 1
+                        metrics.inc('pymeter_sink_dropped_total', labels=self.labels)
+
+                        if self.dropped % 100 == 1:
+                            logger.warning('Queue for sink {} is full, dropped {} telegram(s) so far'.format(self.name, self.dropped))
+                    except queue.Empty:
+                        pass
+        else:
+            with self.spill_lock:
+                if not self.spilling:
+                    try:
+                        self.queue.put_nowait(item)
+                        return
+                    except queue.Full:
+                        logger.warning('Queue for sink {} is full, spilling telegrams to {}'.format(self.name, self.spill_file))
+                        self.spilling = True
+
+                if len(self.spill_buffer) >= max_spill_buffer:
+                    self.dropped += 1
+                    metrics.inc('pymeter_sink_dropped_total', labels=self.labels)
+
+                    if self.dropped % 100 == 1:
+                        logger.warning('Cannot spill telegrams for sink {} fast enough, dropped {} telegram(s) so far'.format(self.name, self.dropped))
+
+                    return
+
+                self.spill_buffer.append(item)
+                self.spill_wanted.notify()
+
+    def write_spilled(self):
+        # Runs in the spill thread; the file is written without holding the
+        # lock, so that the reader thread never waits for the disk
+        while True:
+            with self.spill_lock:
+                while len(self.spill_buffer) == 0 and not self.stopping:
+                    self.spill_wanted.wait()
+
+                if len(self.spill_buffer) == 0:
+                    break
+
+                items = self.spill_buffer
+                self.spill_buffer = []
+                self.spill_writing = True
+
+            written = self.spill(items)
+
+            with self.spill_lock:
+                self.spill_size += written
+                self.spill_writing = False
+
+    def spill(self, items):
+        # Appends the items to the spill file; returns the number of bytes
+        # written
+        data = bytearray()
+
+        for item in items:
+            record = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+            data += struct.pack('<I', len(record))
+            data += record
+
+        try:
+            with open(self.spill_file, 'ab') as spill_fd:
+                size = spill_fd.tell()
+
+                try:
+                    spill_fd.write(data)
+                    spill_fd.flush()
+                except Exception:
+                    # Do not leave a partly written record behind
+                    spill_fd.truncate(size)
+                    raise
+
+            metrics.inc('pymeter_sink_spilled_total', len(items), labels=self.labels)
+
+            return len(data)
+        except Exception as e:
+            self.dropped += len(items)
+            metrics.inc('pymeter_sink_dropped_total', len(items), labels=self.labels)
+            logger.error('Failed to spill {} telegram(s) for sink {} ({})'.format(len(items), self.name, e))
+
+            return 0
+
+    def trim_spill_file(self):
+        # A crash while spilling can leave a partly written record at the
+        # end of the file; cut it off, so that the telegrams spilled from
+        # now on are not appended behind it
+        with open(self.spill_file, 'r+b') as spill_fd:
+            size = os.fstat(spill_fd.fileno()).st_size
+            pos = 0
+
+            while True:
+                header = spill_fd.read(4)
+
+                if len(header) < 4 or pos + 4 + struct.unpack('<I', header)[0] > size:
+                    break
+
+                pos = spill_fd.seek(struct.unpack('<I', header)[0], os.SEEK_CUR)
+
+            if pos < size:
+                logger.warning('Removing a partly written telegram from the end of {}'.format(self.spill_file))
+                spill_fd.truncate(pos)
+
+        return pos
+
+    def read_spilled(self):
+        # Runs in the worker thread. The spill thread may be appending to
+        # the file meanwhile, so a record that is not complete yet is left
+        # for the next read
+        items = []
+
+        try:
+            # The spill thread may not have created the file yet
+            if os.path.exists(self.spill_file):
+                with open(self.spill_file, 'rb') as spill_fd:
+                    spill_fd.seek(self.spill_read_pos)
+
+                    while len(items) < spill_chunk:
+                        header = spill_fd.read(4)
+
+                        if len(header) < 4:
+                            break
+
+                        length = struct.unpack('<I', header)[0]
+                        data = spill_fd.read(length)
+
+                        if len(data) < length:
+                            break
+
+                        items.append(pickle.loads(data))
+                        self.spill_read_pos = spill_fd.tell()
+
+            self.spill_backlog = len(items) == spill_chunk
+
+            if not self.spill_backlog:
+                with self.spill_lock:
+                    # Fully drained once nothing is waiting to be written,
+                    # return to normal operation
+                    if len(self.spill_buffer) == 0 and not self.spill_writing and self.spill_read_pos >= self.spill_size:
+                        if os.path.exists(self.spill_file):
+                            os.truncate(self.spill_file, 0)
+
+                        self.spill_size = 0
+                        self.spill_read_pos = 0
+                        self.spilling = False
+
+                        logger.info('Drained spilled telegrams for sink {}'.format(self.name))
+        except Exception as e:
+            # The telegrams read so far are still processed
+            logger.error('Failed to read spilled telegrams for sink {}, discarding the rest of them ({})'.format(self.name, e))
+
+            with self.spill_lock:
+                if self.spill_writing:
+                    # Skip what has been written so far, the spill thread
+                    # is still appending to the file
+                    self.spill_read_pos = self.spill_size
+                else:
+                    if os.path.exists(self.spill_file):
+                        os.truncate(self.spill_file, 0)
+
+                    self.spill_size = 0
+                    self.spill_read_pos = 0
+                    self.spilling = len(self.spill_buffer) > 0
+
+            self.spill_backlog = False
+
+        return items
+
+    def process(self, item):
+        timestamp,telegram,meter_id = item
+
+        mark = time.perf_counter()
+
+        try:
+            self.sink.process_telegram(timestamp, telegram, meter_id)
+        except Exception as e:
+            metrics.inc('pymeter_sink_errors_total', labels=self.labels)
+            logger.error('Sink {} failed to process telegram ({})'.format(self.name, e))
+
+        metrics.observe('pymeter_sink_process_seconds', time.perf_counter() - mark, self.labels)
+        metrics.observe('pymeter_sink_delay_seconds', time.time() - timestamp, self.labels)
+
+    def run(self):
+        while True:
+            # Spilled telegrams are read back chunk after chunk, checking
+            # the queue for the shutdown sentinel and new configurations
+            # in between
+            try:
+                if self.spill_backlog:
+                    item = self.queue.get_nowait()
+                else:
+                    item = self.queue.get(timeout=spill_poll if self.spilling else 1)
+            except queue.Empty:
+                item = False
+
+            if item is None:
+                # Write what the sink has buffered before it is closed
+                self.flush()
+                break
+
+            if self.new_config is not None:
+                self.reload()
+
+            if item is not False:
+                self.process(item)
+
+            # Process spilled telegrams once the in-memory queue is empty
+            if self.overflow == 'spill' and self.spilling and self.queue.empty():
+                for spilled in self.read_spilled():
+                    self.process(spilled)
+
+            # Let the sink do housekeeping while there is nothing to do
+            if self.queue.empty() and not self.spill_backlog and hasattr(self.sink, 'idle'):
+                try:
+                    self.sink.idle()
+                except Exception as e:
+                    logger.error('Sink {} failed to run idle tasks ({})'.format(self.name, e))
+
+    def reload(self):
+        config = self.new_config
+        self.new_config = None
+
+        if not hasattr(self.sink, 'reload_sink'):
+            logger.info('Sink {} does not support reloading its configuration, changes take effect after a restart'.format(self.name))
+        else:
+            try:
+                self.sink.reload_sink(config)
+            except Exception as e:
+                logger.error('Sink {} failed to reload its configuration ({})'.format(self.name, e))
+
+        self.reloaded.set()
+
+    def flush(self):
+        if not hasattr(self.sink, 'flush'):
+            return
+
+        try:
+            self.sink.flush()
+        except Exception as e:
+            metrics.inc('pymeter_sink_errors_total', labels=self.labels)
+            logger.error('Sink {} failed to flush ({})'.format(self.name, e))
+
+    def stop(self):
+        # The sentinel must always get through, even if the queue is full
+        self.queue.put(None)
+        self.thread.join()
+
+        # Telegrams still waiting to be spilled are written out, and are
+        # processed after the next start
+        if self.spill_thread is not None:
+            with self.spill_lock:
+                self.stopping = True
+                self.spill_wanted.notify()
+
+            self.spill_thread.join()
+
+def dispatch(timestamp, telegram, meter_id=None):
+    # The list of workers is replaced rather than changed when sinks are
+    # added or removed, so it can be used here without a lock
+    for worker in workers:
+        worker.put((timestamp, telegram, meter_id))
+
+def add_sink(name, sink, sink_config):
+    global workers
+
+    queue_size = default_queue_size
+    overflow = default_overflow
+    spill_file = None
+
+    if sink_config is not None:
+        queue_size = sink_config.get('queue_size', default_queue_size)
+        overflow = sink_config.get('overflow', default_overflow)
+        spill_file = sink_config.get('spill_file', None)
+
+    if overflow not in overflow_policies:
+        raise Exception('Unsupported overflow policy "{}" for sink {} specified in the configuration'.format(overflow, name))
+
+    if overflow == 'spill' and spill_file is None:
+        raise Exception('Overflow policy "spill" for sink {} requires a "spill_file" in the configuration'.format(name))
+
+    worker = SinkWorker(name, sink, queue_size, overflow, spill_file)
+    workers = workers + [worker]
+
+    metrics.add_gauge('pymeter_sink_queue_depth', worker.queue.qsize, worker.labels)
+
+    logger.info('Dispatching telegrams to sink {} through a queue of {} telegrams (overflow policy {})'.format(name, queue_size, overflow))
+
+    worker.start()
+
+def remove_sink(name):
+    # Stops the worker of a sink once it has processed its queue
+    global workers
+
+    for worker in workers:
+        if worker.name == name:
+            workers = [other for other in workers if other is not worker]
+
+            logger.info('Stopping worker for sink {}'.format(name))
+
+            worker.stop()
+            metrics.remove_gauge('pymeter_sink_queue_depth', worker.labels)
+
+def reload_sink(name, config):
+    # The sink applies the new configuration from its worker thread,
+    # between telegrams; waits until it has done so
+    for worker in workers:
+        if worker.name == name:
+            worker.reloaded.clear()
+            worker.new_config = config
+
+            if not worker.reloaded.wait(reload_timeout):
+                logger.warning('Sink {} has not applied the new configuration after {}s, it will do so once it catches up'.format(name, reload_timeout))
+
+def close_dispatch():
+    global workers
+
+    if len(workers) == 0:
+        return
+
+    logger.info('Stopping sink workers')
+
+    for worker in workers:
+        worker.stop()
+
+    workers = []
+
+def init_dispatch(in_config, in_logger):
+    global logger
+
+    logger = in_logger
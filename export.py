@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import time
+import sqlite3
+import urllib.parse
+import schema
+
+# Bulk export of the sqlite3 databases. Rows are streamed from the database
+# with chunked cursors and written out as they are read, so exports of any
+# size run in constant memory. Rows can be written as CSV, Parquet or
+# InfluxDB line protocol, or be pushed to InfluxDB to fill it with the
+# history from the sqlite3 databases.
+
+# Number of rows fetched from a cursor at a time
+chunk_size = 10000
+
+# Number of rows per Parquet row group
+row_group_size = 100000
+
+# Number of lines per (gzip-compressed) InfluxDB write
+backfill_batch_size = 50000
+
+# Timeout for a write (in milliseconds); large batches take a while for
+# the server to process
+backfill_timeout = 120000
+
+columns = ['table', 'timestamp', 'value', 'unit', 'meter']
+
+# Line protocol series and field per table         = {table: (series, field)}
+line_map = dict()
+
+# Databases that can be written as line protocol; these hold the same
+# values as the InfluxDB sink writes. Averages would end up in the same
+# series as the raw values and cannot be told apart from them
+line_databases = ['raw_db', 'total_consumed']
+
+def tables_in(db):
+    # Returns the counter tables present in a database
+    return [table for counter,table,unit in schema.dsmr_map.values() if len(schema.table_columns(db, table)) > 0]
+
+def export_rows(filename, tables=None, start=None, end=None, meter=None):
+    # Yields (table, timestamp, value, unit, meter) for the rows in the
+    # given tables (all counter tables by default), ordered by table and
+    # time
+    db = sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(filename)), uri=True)
+
+    try:
+        if tables is None:
+            tables = tables_in(db)
+
+        for table in tables:
+            # Databases that have not been migrated have no meter column;
+            # their rows belong to no particular meter
+            has_meter = 'meter' in schema.table_columns(db, table)
+
+            if meter is not None and not has_meter:
+                continue
+
+            where = []
+            params = []
+
+            if start is not None:
+                where.append('timestamp >= ?')
+                params.append(start)
+
+            if end is not None:
+                where.append('timestamp < ?')
+                params.append(end)
+
+            if meter is not None:
+                where.append('meter = ?')
+                params.append(meter)
+
+            query = 'SELECT ?, timestamp, value, unit, {} FROM {}{} ORDER BY timestamp;'.format('meter' if has_meter else 'NULL AS meter', table, ' WHERE ' + ' AND '.join(where) if len(where) > 0 else '')
+            cur = db.execute(query, [table] + params)
+
+            while True:
+                rows = cur.fetchmany(chunk_size)
+
+                if len(rows) == 0:
+                    break
+
+                yield from rows
+    finally:
+        db.close()
+
+def write_csv(rows, out):
+    writer = csv.writer(out)
+    writer.writerow(columns)
+
+    count = 0
+
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+
+    return count
+
+def load_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception('Exporting to Parquet requires PyArrow, install it with "pip install pyarrow"')
+
+    return pyarrow
+
+def write_parquet(rows, filename):
+    pyarrow = load_pyarrow()
+
+    arrow_schema = pyarrow.schema([('table', pyarrow.string()), ('timestamp', pyarrow.int64()), ('value', pyarrow.float64()), ('unit', pyarrow.string()), ('meter', pyarrow.string())])
+    writer = pyarrow.parquet.ParquetWriter(filename, arrow_schema, compression='zstd')
+    group = []
+    count = 0
+
+    def write_group():
+        writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type) for column,field in zip(zip(*group), arrow_schema)], schema=arrow_schema))
+        group.clear()
+
+    try:
+        for row in rows:
+            group.append(row)
+            count += 1
+
+            if len(group) >= row_group_size:
+                write_group()
+
+        if len(group) > 0:
+            write_group()
+    finally:
+        writer.close()
+
+    return count
+
+def escape_tag(value):
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+def line_series(table):
+    # Uses the same measurement, tags and fields as the InfluxDB sink
+    if table not in line_map:
+        import influxsink
+
+        for key,(counter,counter_table,unit) in schema.dsmr_map.items():
+            if counter_table == table and key in influxsink.dsmr_map:
+                field,tags = influxsink.dsmr_map[key]
+                line_map[table] = ('smart_meter' + ''.join([',{}={}'.format(tag, escape_tag(val)) for tag,val in tags]), field)
+                break
+        else:
+            raise Exception('No InfluxDB mapping for table {}'.format(table))
+
+    return line_map[table]
+
+def to_line(row):
+    # Timestamps are in whole seconds (some are stored as REAL), so writes
+    # must use second precision
+    table,timestamp,value,unit,meter = row
+    series,field = line_series(table)
+
+    if meter is not None:
+        series += ',meter=' + escape_tag(meter)
+
+    return '{} {}={} {}'.format(series, field, float(value), int(timestamp))
+
+def write_lines(rows, out):
+    count = 0
+
+    for row in rows:
+        out.write(to_line(row))
+        out.write('\n')
+        count += 1
+
+    return count
+
+def backfill(rows, influx_config, logger, batch_size=backfill_batch_size):
+    # Writes the rows to InfluxDB in large, gzip-compressed batches
+    from influxdb_client import InfluxDBClient, WritePrecision
+    from influxdb_client.client.write_api import SYNCHRONOUS
+
+    for key in ['url', 'token', 'org', 'bucket']:
+        if key not in influx_config:
+            raise Exception('Missing mandatory "{}" field in InfluxDB configuration section'.format(key))
+
+    client = InfluxDBClient(url=influx_config['url'], token=influx_config['token'], org=influx_config['org'], enable_gzip=True, timeout=backfill_timeout)
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+    batch = []
+    count = 0
+    mark = time.perf_counter()
+
+    def write_batch():
+        write_api.write(bucket=influx_config['bucket'], org=influx_config['org'], record='\n'.join(batch).encode('utf-8'), write_precision=WritePrecision.S)
+        batch.clear()
+
+        elapsed = time.perf_counter() - mark
+        logger.info('Wrote {} points to InfluxDB ({:.0f} points/s)'.format(count, count / elapsed if elapsed > 0 else 0))
+
+    try:
+        for row in rows:
+            batch.append(to_line(row))
+            count += 1
+
+            if len(batch) >= batch_size:
+                write_batch()
+
+        if len(batch) > 0:
+            write_batch()
+    finally:
+        write_api.close()
+        client.close()
+
+    return count
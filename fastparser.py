@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import re
+import array
+import metrics
+import sinks
+import schema
+from dsmr_parser.value_types import timestamp as dsmr_timestamp
+from dsmr_parser.exceptions import InvalidChecksumError, ParseError
+
+# Fast-path parser for DSMR telegrams. Rather than matching every object
+# in the telegram specification, only the lines for the counters that the
+# sinks actually use are extracted, straight into floats. Anything the
+# fast path does not expect is handed to the full dsmr_parser parser.
+
+# The message timestamp is always extracted
+timestamp_name = 'P1_MESSAGE_TIMESTAMP'
+timestamp_counter = '1.0.0'
+
+# CRC16 (as used by DSMR) lookup tables for one and for two bytes at a
+# time; the latter halves the number of iterations over the telegram. The
+# tables are built when the first parser is created.
+crc_table = array.array('H')
+crc_table16 = array.array('H')
+
+def init_crc_tables():
+    if len(crc_table16) > 0:
+        return
+
+    for byte in range(256):
+        crc = byte
+
+        for bit in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+
+        crc_table.append(crc)
+
+    # The CRC is linear, so the entry for two bytes is the combination of
+    # the entries for the low byte and for the high byte
+    low = [crc_table[crc_table[byte] & 0xFF] ^ (crc_table[byte] >> 8) for byte in range(256)]
+    high = [crc_table[byte] for byte in range(256)]
+
+    for byte in range(256):
+        crc = high[byte]
+        crc_table16.extend([crc ^ entry for entry in low])
+
+def crc16(data):
+    crc = 0
+    words = array.array('H')
+    words.frombytes(data[:len(data) & ~1])
+
+    if sys.byteorder != 'little':
+        words.byteswap()
+
+    for word in words:
+        crc = crc_table16[crc ^ word]
+
+    if len(data) & 1:
+        crc = (crc >> 8) ^ crc_table[(crc ^ data[-1]) & 0xFF]
+
+    return crc
+
+class FastValue:
+    # Compatible with the values of dsmr_parser telegrams as used by the
+    # sinks (value and unit)
+    __slots__ = ('value', 'unit')
+
+    def __init__(self, value, unit):
+        self.value = value
+        self.unit = unit
+
+class FastTelegram:
+    # Iterates over (DSMR name, value) like a dsmr_parser telegram
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+def enabled_names():
+    # Returns the DSMR names of the counters used by the active sinks; if a
+    # sink does not say which it uses, all known counters are extracted
+    names = sinks.enabled_fields()
+
+    if names is None:
+        names = schema.dsmr_map.keys()
+
+    return names
+
+class FastParser:
+    def __init__(self, names, labels=(), apply_checksum=True):
+        init_crc_tables()
+
+        counters = dict()
+
+        for name in names:
+            if name in schema.dsmr_map:
+                counters[schema.dsmr_map[name][0]] = name
+
+        counters[timestamp_counter] = timestamp_name
+
+        self.counters = counters
+        self.names = sorted(counters.values())
+
+        # One expression for all counters; the value is the last group on
+        # the line (the gas reading is preceded by its own timestamp)
+        codes = '|'.join([re.escape(counter) for counter in counters.keys()])
+        self.line_re = re.compile(r'^\d+-\d+:({})(?:\([^)\r\n]*\))*\(([^)\r\n]*)\)\r?$'.format(codes), re.MULTILINE)
+        self.crc_re = re.compile(r'!([0-9A-Fa-f]{4})\r?\n?$')
+
+        self.full_parser = None
+        self.apply_checksum = apply_checksum
+        self.labels = labels
+        self.fallbacks = 0
+
+    def fallback(self, telegram_str):
+        self.fallbacks += 1
+        metrics.inc('pymeter_telegrams_fallback_total', labels=self.labels)
+
+        # The full parser is only loaded when it is needed
+        if self.full_parser is None:
+            from dsmr_parser import telegram_specifications
+            from dsmr_parser.parsers import TelegramParser
+
+            self.full_parser = TelegramParser(telegram_specifications.V5, self.apply_checksum)
+
+        return self.full_parser.parse(telegram_str)
+
+    def parse(self, telegram_str):
+        start = telegram_str.find('/')
+        crc_match = self.crc_re.search(telegram_str)
+
+        if start < 0 or crc_match is None:
+            return self.fallback(telegram_str)
+
+        # The CRC covers everything from '/' up to and including '!'
+        if self.apply_checksum and crc16(telegram_str[start:crc_match.start() + 1].encode('ascii', errors='replace')) != int(crc_match.group(1), 16):
+            raise InvalidChecksumError('Invalid telegram, the CRC checksum does not match')
+
+        items = []
+        seen = set()
+
+        try:
+            for match in self.line_re.finditer(telegram_str, start, crc_match.start()):
+                name = self.counters[match.group(1)]
+
+                # Like the full parser, only the first occurrence is used
+                if name in seen:
+                    continue
+
+                seen.add(name)
+
+                if name == timestamp_name:
+                    value = dsmr_timestamp(match.group(2))
+
+                    if value is None:
+                        return self.fallback(telegram_str)
+
+                    items.append((name, FastValue(value, None)))
+                    continue
+
+                number,_,unit = match.group(2).partition('*')
+                items.append((name, FastValue(float(number), unit if unit else None)))
+        except ValueError:
+            return self.fallback(telegram_str)
+
+        if timestamp_name not in seen:
+            return self.fallback(telegram_str)
+
+        return FastTelegram(items)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import stat
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import hashlib
+import serialreader
+
+# File input for the monitor loop. A file can hold a snapshot of the last
+# telegram (rewritten by another process whenever a new telegram arrives)
+# or be tailed, in which case telegrams are appended to it (a log) or
+# written to it (a FIFO). The loop sleeps until the file changes, using
+# inotify where available and polling the file status otherwise.
+
+# How often to check the file status if inotify is not available (in seconds)
+poll_interval = 0.5
+
+# inotify event masks
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+inotify_event = struct.Struct('iIII')
+
+libc = None
+
+class Inotify:
+    # Watches the directory that holds the file, so that files that are
+    # replaced by renaming a new version over them are also noticed
+    def __init__(self, path, mask):
+        global libc
+
+        if libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+        self.name = os.fsencode(os.path.basename(path))
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        if libc.inotify_add_watch(self.fd, os.fsencode(os.path.dirname(os.path.abspath(path))), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed')
+
+    def wait(self):
+        while True:
+            select.select([self.fd], [], [])
+
+            data = os.read(self.fd, 4096)
+            pos = 0
+
+            while pos < len(data):
+                wd,mask,cookie,length = inotify_event.unpack_from(data, pos)
+                name = data[pos + inotify_event.size:pos + inotify_event.size + length].rstrip(b'\0')
+                pos += inotify_event.size + length
+
+                if name == self.name:
+                    return
+
+    def close(self):
+        os.close(self.fd)
+
+class StatWatcher:
+    def __init__(self, path):
+        self.path = path
+        self.signature = self.current()
+
+    def current(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def wait(self):
+        while True:
+            time.sleep(poll_interval)
+
+            signature = self.current()
+
+            if signature != self.signature:
+                self.signature = signature
+                return
+
+    def close(self):
+        pass
+
+def make_watcher(path, mask, logger):
+    try:
+        return Inotify(path, mask)
+    except Exception as e:
+        logger.info('Cannot use inotify to watch {}, polling it every {}s instead ({})'.format(path, poll_interval, e))
+
+    return StatWatcher(path)
+
+def normalise(data):
+    # Files are sometimes written with plain newlines, the CRC is computed
+    # over the telegram with CR/LF line endings
+    if b'\r\n' not in data:
+        data = b''.join([line.strip() + b'\r\n' for line in data.splitlines()])
+
+    return data.decode('ascii', errors='replace')
+
+def snapshot_telegrams(path, logger):
+    # Yields the telegram in the file each time its content changes
+    watcher = make_watcher(path, IN_CLOSE_WRITE | IN_MOVED_TO, logger)
+    last_digest = None
+
+    try:
+        while True:
+            try:
+                with open(path, 'rb') as p1_fd:
+                    data = p1_fd.read()
+            except FileNotFoundError:
+                data = b''
+
+            if len(data) > 0:
+                digest = hashlib.sha1(data).digest()
+
+                if digest != last_digest:
+                    last_digest = digest
+                    yield normalise(data)
+
+            watcher.wait()
+    finally:
+        watcher.close()
+
+def read_available(p1_fd, framer):
+    # Reads what is available into the framer; returns False at the end
+    # of the file
+    free = framer.free()
+    count = p1_fd.readinto(free)
+    free.release()
+
+    if not count:
+        return False
+
+    framer.commit(count)
+
+    return True
+
+def tail_fifo(path, logger):
+    framer = serialreader.TelegramFramer()
+
+    while True:
+        # Opening a FIFO blocks until a writer opens it, and reads block
+        # until data is written; the end of the file means the writer is
+        # gone, after which the FIFO is opened again
+        logger.debug('Waiting for a writer to open FIFO {}'.format(path))
+
+        with open(path, 'rb', buffering=0) as p1_fd:
+            while read_available(p1_fd, framer):
+                yield from framer.telegrams()
+
+def tail_log(path, logger):
+    # Yields telegrams appended to the file; telegrams already in the file
+    # when it is first opened are skipped, a file that is truncated or
+    # replaced (e.g. by log rotation) is read from the start
+    watcher = make_watcher(path, IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE, logger)
+    framer = serialreader.TelegramFramer()
+    p1_fd = None
+    inode = None
+    first = True
+
+    try:
+        while True:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                st = None
+
+            if p1_fd is not None and (st is None or st.st_ino != inode or st.st_size < p1_fd.tell()):
+                p1_fd.close()
+                p1_fd = None
+
+            if p1_fd is None and st is not None:
+                p1_fd = open(path, 'rb', buffering=0)
+                inode = os.fstat(p1_fd.fileno()).st_ino
+
+                if first:
+                    p1_fd.seek(0, os.SEEK_END)
+
+            first = False
+
+            if p1_fd is not None:
+                while read_available(p1_fd, framer):
+                    yield from framer.telegrams()
+
+            watcher.wait()
+    finally:
+        if p1_fd is not None:
+            p1_fd.close()
+
+        watcher.close()
+
+def is_fifo(path):
+    return os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode)
+
+def file_telegrams(path, mode, logger):
+    if is_fifo(path):
+        return tail_fifo(path, logger)
+
+    if mode == 'snapshot':
+        return snapshot_telegrams(path, logger)
+    elif mode == 'tail':
+        return tail_log(path, logger)
+
+    raise Exception('Unsupported file mode "{}" specified in the configuration'.format(mode))
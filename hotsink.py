@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import array
+import logging
+import threading
+import schema
+
+# In-memory hot tier of recent readings. The last hours of every counter
+# are kept at full resolution in preallocated ring buffers of 32-bit
+# timestamps and 64-bit floats (12 bytes per sample, about 1MB per counter
+# per day at one sample per second), so appending is O(1) and never
+# allocates. Range and aggregate reads are vectorised with NumPy over the
+# buffers. When pymeter serves queries itself (see the hot_tier section
+# of the configuration), query.py answers queries for recent data from
+# here instead of from the databases.
+
+logger = None
+
+# How many hours to keep, and the expected interval between samples (in
+# seconds); together they determine the size of the buffers
+hours = 24
+interval = 1
+
+# Extra time kept beyond the configured hours (in seconds), so that a
+# query for the last hours, with its start rounded down to a bucket,
+# can still be answered from memory
+headroom = 3600
+
+# Ring buffers                                      = {(meter, table): RingBuffer}
+series = dict()
+series_lock = threading.Lock()
+
+# Which counters to keep                            = {DSMR name: table}
+kept = dict()
+
+# Query server running inside pymeter, if configured
+server = None
+
+np = None
+
+# Is this sink active?
+active = False
+
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array.array('I', bytes(4 * capacity))
+        self.values = array.array('d', bytes(8 * capacity))
+        self.head = 0
+        self.count = 0
+        self.last = None
+        self.lock = threading.Lock()
+
+        # Views on the buffers for vectorised reads; these share memory
+        # with the arrays, nothing is copied
+        self.timestamp_view = np.frombuffer(self.timestamps, dtype=np.uint32)
+        self.value_view = np.frombuffer(self.values, dtype=np.float64)
+
+    def append(self, timestamp, value):
+        # Samples must arrive in time order, so that each segment of the
+        # buffer is sorted; timestamps are stored as whole seconds
+        timestamp = int(timestamp)
+
+        if self.last is not None and timestamp <= self.last:
+            return
+
+        with self.lock:
+            self.timestamps[self.head] = timestamp
+            self.values[self.head] = value
+            self.head = (self.head + 1) % self.capacity
+            self.last = timestamp
+
+            if self.count < self.capacity:
+                self.count += 1
+
+    def first(self):
+        # Returns the oldest timestamp in the buffer, or None if it is empty
+        with self.lock:
+            if self.count == 0:
+                return None
+
+            return self.timestamps[0 if self.count < self.capacity else self.head]
+
+    def segments(self):
+        # The filled parts of the buffer, oldest first
+        if self.count < self.capacity:
+            return [(0, self.count)]
+
+        return [(self.head, self.capacity), (0, self.head)]
+
+    def read(self, start, end):
+        # Returns copies of the timestamps and values in [start, end)
+        timestamps = []
+        values = []
+
+        with self.lock:
+            for first,last in self.segments():
+                segment = self.timestamp_view[first:last]
+                lo = first + int(np.searchsorted(segment, start, 'left'))
+                hi = first + int(np.searchsorted(segment, end, 'left'))
+
+                timestamps.append(self.timestamp_view[lo:hi].astype(np.int64))
+                values.append(self.value_view[lo:hi].copy())
+
+        return np.concatenate(timestamps), np.concatenate(values)
+
+def load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise Exception('The hot tier requires NumPy, install it with "pip install numpy"')
+
+    return numpy
+
+def capacity():
+    return (hours * 3600 + headroom) // interval
+
+def get_series(meter_id, table):
+    key = (meter_id, table)
+
+    if key not in series:
+        with series_lock:
+            if key not in series:
+                series[key] = RingBuffer(capacity())
+
+    return series[key]
+
+def covers(table, meter_id, start):
+    # Returns True if the hot tier holds all data for the table from start
+    if not active or (meter_id, table) not in series:
+        return False
+
+    first = series[(meter_id, table)].first()
+
+    return first is not None and first <= start
+
+def read_range(table, meter_id, start, end, resolution=1, aggregate='AVG'):
+    # Returns (timestamp, value) rows like query.query_range; with a
+    # resolution above 1s, values are averaged per bucket (or the maximum
+    # is taken, for cumulative counters)
+    timestamps,values = series[(meter_id, table)].read(start, end)
+
+    if resolution > 1 and len(timestamps) > 0:
+        buckets = (timestamps // resolution) * resolution
+        starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+
+        if aggregate == 'AVG':
+            values = np.add.reduceat(values, starts) / np.diff(np.append(starts, len(values)))
+        else:
+            values = np.maximum.reduceat(values, starts)
+
+        timestamps = buckets[starts]
+
+    return list(zip(timestamps.tolist(), values.tolist()))
+
+def process_telegram(timestamp, telegram, meter_id=None):
+    if not active:
+        return
+
+    for attr,value in telegram:
+        if attr in kept:
+            get_series(meter_id, kept[attr]).append(timestamp, float(value.value))
+
+def enabled_fields():
+    return list(kept.keys())
+
+def flush():
+    pass
+
+def close_sink():
+    global active
+
+    if not active:
+        return
+
+    logger.info('Closing hot tier sink')
+
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+    active = False
+
+def init_sink(in_config, in_logger):
+    global logger
+    global hours
+    global interval
+    global server
+    global np
+    global active
+
+    config = in_config
+    logger = in_logger
+
+    logger.info('Initialising hot tier sink')
+
+    if 'hot_tier' not in config:
+        logger.info('No configuration for hot tier sink found, disabling it')
+        return
+
+    try:
+        np = load_numpy()
+    except Exception as e:
+        logger.error('{}, disabling the hot tier'.format(e))
+        return
+
+    hours = config['hot_tier'].get('hours', hours)
+    interval = config['hot_tier'].get('interval', interval)
+
+    # By default, all counters are kept
+    counters = config['hot_tier'].get('counters', None)
+
+    for key,(counter,table,unit) in schema.dsmr_map.items():
+        if counters is None or counter in counters:
+            kept[key] = table
+
+    logger.info('Keeping the last {}h of {} counters in memory (about {:.2f}MB per counter)'.format(hours, len(kept), capacity() * 12 / 1048576))
+
+    active = True
+
+    if 'port' in config['hot_tier']:
+        # Imported here, as query.py imports this module
+        import query
+
+        query.init_query(config, logger)
+        server = query.make_server(config['hot_tier'].get('listen', '127.0.0.1'), config['hot_tier']['port'])
+
+        threading.Thread(target=server.serve_forever, name='query', daemon=True).start()
+
+        logger.info('Serving queries on http://{}:{}/range'.format(*server.server_address[:2]))
+
+    logger.info('Initialisation of hot tier sink complete')
@@ -5,7 +5,11 @@ import sys
 import logging
 import influxdb_client
 from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import ASYNCHRONOUS
+from influxdb_client.client.write_api import WriteOptions, SYNCHRONOUS
+import influxspool
+import time
+import metrics
+import compression
 
 logger = None
 
@@ -15,6 +19,27 @@ org = None
 url = None
 bucket = None
 
+# Batching configuration; points are flushed when either the batch is
+# full or the flush interval (in milliseconds) has passed
+batch_size = 500
+flush_interval = 10000
+
+# Long-lived client and write API, and a synchronous write API used to
+# drain the spool
+influx_client = None
+write_api = None
+drain_api = None
+
+# In bulk mode (used when replaying captures) points are collected and
+# written synchronously in large batches, so that a slow server slows
+# down the replay instead of buffering without bound
+bulk_mode = False
+bulk_batch_size = 5000
+bulk_points = []
+
+# Labels for the metrics of this sink
+metric_labels = (('sink', 'influx'),)
+
 active = False
 
 # Mapping of DSMR field names to InfluxDB           = (field, tags+values)
@@ -49,30 +74,155 @@ dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L1_NEGATIVE']  = ('power_neg', [('phase', '
 dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L2_NEGATIVE']  = ('power_neg', [('phase', 'l2')])
 dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L3_NEGATIVE']  = ('power_neg', [('phase', 'l3')])
 
-def process_telegram(timestamp, telegram):
+def make_point(tags, timestamp, meter_id=None):
+    point = Point("smart_meter")
+
+    for tag,val in tags:
+        point = point.tag(tag, val)
+
+    if meter_id is not None:
+        point = point.tag('meter', meter_id)
+
+    return point.time(timestamp * 1000000000)
+
+def process_telegram(timestamp, telegram, meter_id=None):
     if not active:
         return
 
     try:
-        influx_writer = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
-        write_api = influx_writer.write_api(write_options=ASYNCHRONOUS)
+        # Group all fields that share the same tag set into a single point
+        points = dict()
+        held_back = []
 
         for attr,value in telegram:
             if attr in dsmr_map:
                 field,tags = dsmr_map[attr]
 
-                point = Point("smart_meter")
-                point = point.field(field, value.value)
-                
-                for tag,val in tags:
-                    point = point.tag(tag, val)
+                tag_key = tuple(tags)
 
-                point = point.time(timestamp * 1000000000)
+                for field_timestamp,field_value in compression.filter_value('influx', meter_id, attr, timestamp, value.value):
+                    # Swinging door compression stores earlier values
+                    if field_timestamp != timestamp:
+                        held_back.append(make_point(tags, field_timestamp, meter_id).field(field, field_value))
+                        continue
 
-                write_api.write(bucket=bucket, org=org, record=point)
+                    if tag_key not in points:
+                        points[tag_key] = make_point(tags, timestamp, meter_id)
+
+                    points[tag_key].field(field, field_value)
+
+        if len(points) > 0 or len(held_back) > 0:
+            write_points(held_back + list(points.values()))
     except Exception as e:
         logger.error('Failed to send data to InfluxDB ({})'.format(e))
 
+def write_points(points):
+    if not bulk_mode:
+        write_api.write(bucket=bucket, org=org, record=points)
+        return
+
+    bulk_points.extend(points)
+
+    if len(bulk_points) >= bulk_batch_size:
+        flush_bulk()
+
+def flush_bulk():
+    if len(bulk_points) == 0:
+        return
+
+    mark = time.perf_counter()
+
+    try:
+        drain_api.write(bucket=bucket, org=org, record=bulk_points)
+        metrics.inc('pymeter_sink_rows_written_total', len(bulk_points), metric_labels)
+        metrics.observe('pymeter_sink_commit_seconds', time.perf_counter() - mark, metric_labels)
+    except Exception as e:
+        write_error(None, '\n'.join([point.to_line_protocol() for point in bulk_points]), e)
+
+    bulk_points.clear()
+
+def make_write_api():
+    return influx_client.write_api(write_options=WriteOptions(batch_size=batch_size, flush_interval=flush_interval), success_callback=write_success, error_callback=write_error)
+
+def flush():
+    global write_api
+
+    if not active:
+        return
+
+    flush_bulk()
+
+    # WriteApi.flush() does not write anything; closing the write API
+    # writes the pending batches, after which a new one is started
+    write_api.close()
+    write_api = make_write_api()
+
+def enabled_fields():
+    return list(dsmr_map.keys())
+
+def enable_bulk_mode():
+    global bulk_mode
+
+    if not active:
+        return
+
+    logger.info('InfluxDB sink in bulk mode, writing batches of {} points'.format(bulk_batch_size))
+
+    bulk_mode = True
+
+def write_success(conf, data):
+    metrics.inc('pymeter_sink_rows_written_total', data.count(b'\n' if isinstance(data, bytes) else '\n') + 1, metric_labels)
+
+def write_error(conf, data, exception):
+    metrics.inc('pymeter_sink_errors_total', labels=metric_labels)
+
+    if not influxspool.is_rejected(exception) and influxspool.append(data):
+        logger.warning('Failed to send data to InfluxDB, spooled it for later ({})'.format(exception))
+    else:
+        logger.error('Failed to send data to InfluxDB ({})'.format(exception))
+
+def write_spooled(lines):
+    drain_api.write(bucket=bucket, org=org, record=lines)
+
+def close_sink():
+    global write_api
+    global drain_api
+    global influx_client
+    global active
+
+    if not active:
+        return
+
+    active = False
+
+    logger.info('Flushing and closing InfluxDB sink')
+
+    try:
+        # Write values that compression still holds back
+        held_back = []
+
+        for meter_id,attr,timestamp,value in compression.flush('influx'):
+            field,tags = dsmr_map[attr]
+
+            held_back.append(make_point(tags, timestamp, meter_id).field(field, value))
+
+        if len(held_back) > 0:
+            write_points(held_back)
+
+        # Closing the write API flushes any pending batches, failures are
+        # still spooled so the spool is closed last
+        flush_bulk()
+        write_api.close()
+        influxspool.close_spool()
+        drain_api.close()
+        influx_client.close()
+    except Exception as e:
+        logger.error('Failed to cleanly close InfluxDB client ({})'.format(e))
+
+    write_api = None
+    drain_api = None
+    influx_client = None
+
 def init_sink(in_config, in_logger):
     global logger 
     global token
@@ -80,6 +230,11 @@ def init_sink(in_config, in_logger):
     global url
     global active
     global bucket
+    global batch_size
+    global flush_interval
+    global influx_client
+    global write_api
+    global drain_api
 
     config = in_config
     logger = in_logger
@@ -110,8 +265,26 @@ def init_sink(in_config, in_logger):
 
     if 'bucket' not in config['influx']:
         logger.error('Missing mandatory "bucket" field in InfluxDB configuration section')
+        return
 
     bucket = config['influx']['bucket']
 
+    if 'batch_size' in config['influx']:
+        batch_size = config['influx']['batch_size']
+
+    if 'flush_interval' in config['influx']:
+        flush_interval = config['influx']['flush_interval']
+
+    logger.info('Writing to InfluxDB in batches of up to {} points, flushed at least every {}ms'.format(batch_size, flush_interval))
+
+    influx_client = InfluxDBClient(url=url, token=token, org=org)
+    write_api = make_write_api()
+    drain_api = influx_client.write_api(write_options=SYNCHRONOUS)
+
+    if 'spool_dir' in config['influx']:
+        influxspool.init_spool(config['influx'], logger, write_spooled)
+    else:
+        logger.info('No spool directory configured, data that cannot be sent to InfluxDB will be discarded')
+
     active = True
     logger.info('Initialisation of InfluxDB sink complete')
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import logging
+import threading
+import time
+
+logger = None
+
+# Spool configuration
+spool_dir = None
+max_size = 256 * 1024 * 1024
+segment_size = 4 * 1024 * 1024
+drain_batch = 5000
+
+# Backoff (in seconds) between failed drain attempts
+min_backoff = 5
+max_backoff = 300
+
+# How often to report on the spool (in seconds)
+report_interval = 60
+
+# Function that writes a list of line protocol records to InfluxDB
+write_fn = None
+
+# Spool state; segments are numbered files in the spool directory, the
+# read cursor points at the oldest unsent record
+spool_lock = threading.Lock()
+segments = []
+cursor_segment = 0
+cursor_offset = 0
+
+# Drain state
+drain_thread = None
+stop_event = threading.Event()
+drained = 0
+spooled = 0
+last_report = 0
+
+active = False
+
+def segment_name(segment):
+    return os.path.join(spool_dir, '{:08d}.lp'.format(segment))
+
+def cursor_name():
+    return os.path.join(spool_dir, 'cursor')
+
+def save_cursor():
+    tmp_name = cursor_name() + '.tmp'
+
+    with open(tmp_name, 'w') as cursor_fd:
+        cursor_fd.write('{} {}\n'.format(cursor_segment, cursor_offset))
+
+    os.replace(tmp_name, cursor_name())
+
+def load_cursor():
+    global cursor_segment
+    global cursor_offset
+
+    try:
+        with open(cursor_name(), 'r') as cursor_fd:
+            segment,offset = cursor_fd.read().split()
+
+        cursor_segment = int(segment)
+        cursor_offset = int(offset)
+    except FileNotFoundError:
+        cursor_segment = segments[0] if len(segments) > 0 else 0
+        cursor_offset = 0
+
+    # Skip cursor past segments that no longer exist
+    if len(segments) > 0 and cursor_segment < segments[0]:
+        cursor_segment = segments[0]
+        cursor_offset = 0
+
+def depth():
+    total = 0
+
+    for segment in segments:
+        try:
+            total += os.path.getsize(segment_name(segment))
+        except OSError:
+            pass
+
+    if len(segments) > 0 and segments[0] == cursor_segment:
+        total -= cursor_offset
+
+    return max(total, 0)
+
+def enforce_cap():
+    global cursor_segment
+    global cursor_offset
+
+    # Drop the oldest segments (but never the one being written) once the
+    # spool exceeds its maximum size
+    while len(segments) > 1 and depth() > max_size:
+        oldest = segments.pop(0)
+        dropped = os.path.getsize(segment_name(oldest))
+
+        os.remove(segment_name(oldest))
+
+        logger.warning('InfluxDB spool exceeds {} bytes, discarded oldest segment ({} bytes)'.format(max_size, dropped))
+
+        if cursor_segment <= oldest:
+            cursor_segment = segments[0]
+            cursor_offset = 0
+            save_cursor()
+
+def is_rejected(exception):
+    # Client errors (other than rate limiting) mean the server rejected the
+    # data itself; retrying those would block the spool forever
+    status = getattr(exception, 'status', None)
+
+    return status is not None and 400 <= status < 500 and status != 429
+
+def trim_segment(segment):
+    # An interrupted append can leave a partial line at the end of the last
+    # segment; cut it off, so that the next append does not continue it
+    with open(segment_name(segment), 'r+b') as segment_fd:
+        size = segment_fd.seek(0, os.SEEK_END)
+        end = size
+
+        while end > 0:
+            start = max(0, end - 65536)
+            segment_fd.seek(start)
+            pos = segment_fd.read(end - start).rfind(b'\n')
+
+            if pos >= 0:
+                end = start + pos + 1
+                break
+
+            end = start
+
+        if end < size:
+            logger.warning('Removing a partly written point from the end of {}'.format(segment_name(segment)))
+            segment_fd.truncate(end)
+
+def append(data):
+    global spooled
+
+    if not active:
+        return False
+
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+
+    lines = [line for line in data.split('\n') if len(line) > 0]
+
+    if len(lines) == 0:
+        return True
+
+    with spool_lock:
+        try:
+            if len(segments) == 0:
+                segments.append(cursor_segment)
+
+            current = segments[-1]
+
+            if os.path.exists(segment_name(current)) and os.path.getsize(segment_name(current)) >= segment_size:
+                current += 1
+                segments.append(current)
+
+            with open(segment_name(current), 'a') as segment_fd:
+                segment_fd.write('\n'.join(lines))
+                segment_fd.write('\n')
+
+            spooled += len(lines)
+
+            enforce_cap()
+        except Exception as e:
+            logger.error('Failed to spool {} point(s) for InfluxDB ({})'.format(len(lines), e))
+            return False
+
+    return True
+
+def read_batch():
+    global cursor_segment
+    global cursor_offset
+
+    with spool_lock:
+        while len(segments) > 0:
+            segment = segments[0]
+
+            if cursor_segment != segment:
+                cursor_segment = segment
+                cursor_offset = 0
+
+            lines = []
+            offset = cursor_offset
+
+            with open(segment_name(segment), 'r') as segment_fd:
+                segment_fd.seek(offset)
+
+                while len(lines) < drain_batch:
+                    line = segment_fd.readline()
+
+                    # Only whole lines count; a partial line can only be at
+                    # the end of an interrupted write
+                    if len(line) == 0 or not line.endswith('\n'):
+                        break
+
+                    lines.append(line[:-1])
+
+                offset = segment_fd.tell() if len(lines) > 0 else offset
+
+            if len(lines) > 0:
+                return lines, (segment, offset)
+
+            # This segment is exhausted; remove it unless it is still being written
+            if len(segments) == 1:
+                return [], None
+
+            segments.pop(0)
+            os.remove(segment_name(segment))
+
+            cursor_segment = segments[0]
+            cursor_offset = 0
+            save_cursor()
+
+    return [], None
+
+def commit(position):
+    global cursor_segment
+    global cursor_offset
+
+    with spool_lock:
+        cursor_segment,cursor_offset = position
+        save_cursor()
+
+def report():
+    global drained
+    global spooled
+    global last_report
+
+    now = time.time()
+    elapsed = now - last_report
+
+    if elapsed < report_interval:
+        return
+
+    with spool_lock:
+        spool_depth = depth()
+        segment_count = len(segments)
+
+    if spool_depth > 0 or drained > 0 or spooled > 0:
+        logger.info('InfluxDB spool holds {} bytes in {} segment(s); spooled {} point(s), drained {} point(s) ({:.1f} points/s) in the last {:.0f}s'.format(spool_depth, segment_count, spooled, drained, drained / elapsed, elapsed))
+
+    drained = 0
+    spooled = 0
+    last_report = now
+
+def write_lines(lines):
+    # Writes the lines to InfluxDB. If the server rejects the batch, it is
+    # split in halves until the rejected lines are found, and only those are
+    # discarded; returns the number of discarded lines. Other errors are
+    # raised, so the batch is retried (points that were already written are
+    # simply overwritten)
+    try:
+        write_fn(lines)
+        return 0
+    except Exception as e:
+        if not is_rejected(e):
+            raise
+
+        if len(lines) == 1:
+            logger.error('InfluxDB rejected a spooled point, discarding it ({}): {}'.format(e, lines[0]))
+            return 1
+
+    half = len(lines) // 2
+
+    return write_lines(lines[:half]) + write_lines(lines[half:])
+
+def drain_loop():
+    global drained
+
+    backoff = min_backoff
+
+    while not stop_event.is_set():
+        report()
+
+        try:
+            lines,position = read_batch()
+        except Exception as e:
+            logger.error('Failed to read from InfluxDB spool ({})'.format(e))
+            stop_event.wait(backoff)
+            continue
+
+        if len(lines) == 0:
+            stop_event.wait(min_backoff)
+            continue
+
+        try:
+            rejected = write_lines(lines)
+        except Exception as e:
+            logger.warning('Failed to drain InfluxDB spool, retrying in {}s ({})'.format(backoff, e))
+            stop_event.wait(backoff)
+            backoff = min(backoff * 2, max_backoff)
+            continue
+
+        commit(position)
+
+        drained += len(lines) - rejected
+        backoff = min_backoff
+
+def close_spool():
+    global active
+
+    if not active:
+        return
+
+    stop_event.set()
+    drain_thread.join()
+
+    with spool_lock:
+        save_cursor()
+
+    active = False
+
+def init_spool(in_config, in_logger, in_write_fn):
+    global logger
+    global spool_dir
+    global max_size
+    global segment_size
+    global drain_batch
+    global write_fn
+    global drain_thread
+    global last_report
+    global active
+
+    config = in_config
+    logger = in_logger
+    write_fn = in_write_fn
+
+    spool_dir = config['spool_dir']
+
+    if 'spool_max_size' in config:
+        max_size = config['spool_max_size'] * 1024 * 1024
+
+    if 'spool_segment_size' in config:
+        segment_size = config['spool_segment_size'] * 1024 * 1024
+
+    if 'spool_drain_batch' in config:
+        drain_batch = config['spool_drain_batch']
+
+    os.makedirs(spool_dir, exist_ok=True)
+
+    for name in sorted(os.listdir(spool_dir)):
+        if name.endswith('.lp'):
+            segments.append(int(name[:-3]))
+
+    if len(segments) > 0:
+        trim_segment(segments[-1])
+
+    load_cursor()
+
+    with spool_lock:
+        spool_depth = depth()
+
+    logger.info('Spooling failed InfluxDB writes to {} (max {} bytes, {} bytes pending)'.format(spool_dir, max_size, spool_depth))
+
+    active = True
+    last_report = time.time()
+
+    stop_event.clear()
+    drain_thread = threading.Thread(target=drain_loop, name='influx-spool', daemon=True)
+    drain_thread.start()
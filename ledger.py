@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import logging
+import time
+import schema
+
+# Consumption/production ledger. For every consumption and production
+# counter, the amount used or produced per day and per month (in local
+# time) is kept up to date as readings arrive, so that period totals are
+# a single row lookup. The last reading of each counter is stored with the
+# ledger, so that updates continue where they left off after a restart.
+
+logger = None
+
+# Database handle
+db = None
+
+# Counters in the ledger                            = {counter: (description, kind)}
+counters = dict()
+
+# Last committed reading per counter                = {(description, meter): (value, timestamp)}
+state = dict()
+
+# Changes since the last flush                      = {(period, start, description, meter): [delta, first, last, counter, kind, unit, updated]}
+pending = dict()
+
+# Last reading per counter since the last flush     = {(description, meter): (value, timestamp)}
+pending_state = dict()
+
+# Largest plausible increase of a counter per hour; larger increases (and
+# any decrease) mean that the meter was reset or replaced
+max_rate = 50.0
+
+# Periods kept in the ledger, with the format of their start
+periods = [('day', '%Y-%m-%d'), ('month', '%Y-%m')]
+
+upsert_query = '''INSERT INTO ledger (period, start, description, meter, counter, kind, delta, first, last, unit, updated) VALUES (?,?,?,?,?,?,?,?,?,?,?)
+                  ON CONFLICT (period, start, description, meter) DO UPDATE SET delta = delta + excluded.delta, last = excluded.last, updated = excluded.updated;'''
+
+# A stored reading is never replaced by an older one, so that replaying a
+# capture does not move the live starting point back
+state_query = '''INSERT INTO ledger_state (description, meter, value, timestamp) VALUES (?,?,?,?)
+                 ON CONFLICT (description, meter) DO UPDATE SET value = excluded.value, timestamp = excluded.timestamp
+                 WHERE excluded.timestamp > ledger_state.timestamp;'''
+
+def add_counter(counter, description, kind):
+    if db is None:
+        return
+
+    counters[counter] = (description, kind)
+
+    logger.info('Keeping daily and monthly {} totals for counter {} ({})'.format(kind, counter, description))
+
+def period_starts(timestamp):
+    local = time.localtime(timestamp)
+
+    return [(period, time.strftime(fmt, local)) for period,fmt in periods]
+
+def add_delta(timestamp, counter, description, kind, meter, delta, value, unit):
+    for period,start in period_starts(timestamp):
+        key = (period, start, description, meter)
+
+        if key in pending:
+            entry = pending[key]
+            entry[0] += delta
+            entry[2] = value
+            entry[6] = timestamp
+        else:
+            pending[key] = [delta, value - delta, value, counter, kind, unit, timestamp]
+
+def update(timestamp, counter, value, unit, meter_id=None):
+    if db is None or counter not in counters:
+        return
+
+    description,kind = counters[counter]
+    meter = meter_id if meter_id is not None else ''
+    key = (description, meter)
+    value = float(value)
+
+    last = pending_state.get(key, state.get(key, None))
+
+    if last is None:
+        delta = 0.0
+    else:
+        last_value,last_timestamp = last
+
+        # Duplicate and older readings (e.g. read back from a spill file, or
+        # from a meter whose clock went backwards) are ignored
+        if timestamp <= last_timestamp:
+            return
+
+        delta = value - last_value
+
+        # Readings arrive every few seconds, so treating the reading after a
+        # reset or replacement as the new starting point loses next to nothing
+        if delta < 0 or delta > max_rate * max(1.0, (timestamp - last_timestamp) / 3600.0):
+            logger.warning('Counter {} ({}) jumped from {} to {}, assuming the meter was reset or replaced'.format(counter, description, last_value, value))
+            delta = 0.0
+
+    pending_state[key] = (value, timestamp)
+
+    add_delta(timestamp, counter, description, kind, meter, delta, value, unit)
+
+def flush():
+    # Writes the changes in one transaction, so that the totals and the
+    # last readings always match
+    if db is None or (len(pending) == 0 and len(pending_state) == 0):
+        return
+
+    rows = [(period, start, description, meter, counter, kind, delta, first, last, unit, updated) for (period,start,description,meter),(delta,first,last,counter,kind,unit,updated) in pending.items()]
+    state_rows = [(description, meter, value, timestamp) for (description,meter),(value,timestamp) in pending_state.items()]
+
+    try:
+        db.executemany(upsert_query, rows)
+        db.executemany(state_query, state_rows)
+        db.commit()
+
+        # Only readings that were committed become the new starting point;
+        # after a failed commit, the next reading books the whole change
+        # since the last committed reading
+        state.update(pending_state)
+    except Exception as e:
+        db.rollback()
+        logger.error('Failed to update the ledger ({})'.format(e))
+
+    pending.clear()
+    pending_state.clear()
+
+def clear_state():
+    # Forgets the last readings (when replaying a capture), so that older
+    # readings are not ignored
+    state.clear()
+    pending_state.clear()
+
+def load_state():
+    for description,meter,value,timestamp in db.execute('SELECT description, meter, value, timestamp FROM ledger_state;'):
+        state[(description, meter)] = (value, timestamp)
+
+def total(ledger_db, period, start, description, meter=None):
+    # Returns the amount used or produced in a period, or None if there
+    # is no data for it
+    row = ledger_db.execute('SELECT delta FROM ledger WHERE period = ? AND start = ? AND description = ? AND meter = ?;', (period, start, description, meter if meter is not None else '')).fetchone()
+
+    return row[0] if row is not None else None
+
+def init_ledger(ledger_db, in_logger, rate=None):
+    global db
+    global logger
+    global max_rate
+
+    db = ledger_db
+    logger = in_logger
+
+    if rate is not None:
+        max_rate = float(rate)
+
+    schema.ensure_ledger_tables(db)
+    db.commit()
+
+    load_state()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import logging
+import threading
+import bisect
+import http.server
+
+logger = None
+
+# Is the metrics endpoint enabled? If not, all updates are no-ops
+active = False
+
+# HTTP server for the endpoint
+server = None
+server_thread = None
+
+# Default histogram buckets (in seconds)
+latency_buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+delay_buckets = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+# Known metrics                                     = (type, help, buckets)
+definitions = dict()
+
+definitions['pymeter_telegrams_received_total']     = ('counter', 'Telegrams received from the meter', None)
+definitions['pymeter_telegrams_parsed_total']       = ('counter', 'Telegrams parsed successfully', None)
+definitions['pymeter_telegrams_crc_failed_total']   = ('counter', 'Telegrams that failed CRC validation', None)
+definitions['pymeter_telegrams_invalid_total']      = ('counter', 'Telegrams that could not be parsed', None)
+definitions['pymeter_telegrams_duplicate_total']    = ('counter', 'Telegrams read from a file that were already processed', None)
+definitions['pymeter_telegrams_fallback_total']     = ('counter', 'Telegrams handed from the fast-path parser to the full parser', None)
+definitions['pymeter_serial_reconnects_total']      = ('counter', 'Reconnects to the serial device', None)
+definitions['pymeter_parse_seconds']                = ('histogram', 'Time taken to parse a telegram', latency_buckets)
+definitions['pymeter_sink_dropped_total']           = ('counter', 'Telegrams dropped because a sink queue was full', None)
+definitions['pymeter_sink_spilled_total']           = ('counter', 'Telegrams spilled to disk because a sink queue was full', None)
+definitions['pymeter_sink_errors_total']            = ('counter', 'Errors while writing to a sink', None)
+definitions['pymeter_sink_rows_written_total']      = ('counter', 'Rows or points written by a sink', None)
+definitions['pymeter_sink_compressed_total']        = ('counter', 'Raw values not written by a sink because of compression', None)
+definitions['pymeter_sink_process_seconds']         = ('histogram', 'Time taken by a sink to process a telegram', latency_buckets)
+definitions['pymeter_sink_commit_seconds']          = ('histogram', 'Time taken by a sink to commit or flush buffered data', latency_buckets)
+definitions['pymeter_sink_delay_seconds']           = ('histogram', 'Delay between the telegram timestamp and completion by a sink', delay_buckets)
+definitions['pymeter_sink_queue_depth']             = ('gauge', 'Telegrams waiting in a sink queue', None)
+definitions['pymeter_broadcast_subscribers']         = ('gauge', 'Subscribers connected to the broadcast socket', None)
+definitions['pymeter_broadcast_disconnected_total'] = ('counter', 'Broadcast subscribers disconnected for falling too far behind', None)
+
+# Metric values, keyed by metric name and then by label values
+values = dict()
+
+# Guards updates to values, since meter and sink worker threads update the same series
+values_lock = threading.Lock()
+
+# Gauges are computed when the endpoint is scraped         = [(labels, fn)]
+gauges = dict()
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def inc(name, amount=1, labels=()):
+    if not active:
+        return
+
+    series = values[name]
+
+    with values_lock:
+        series[labels] = series.get(labels, 0) + amount
+
+def observe(name, value, labels=()):
+    if not active:
+        return
+
+    series = values[name]
+
+    with values_lock:
+        histogram = series.get(labels, None)
+
+        if histogram is None:
+            histogram = Histogram(definitions[name][2])
+            series[labels] = histogram
+
+        histogram.observe(value)
+
+def add_gauge(name, fn, labels=()):
+    if name not in gauges:
+        gauges[name] = []
+
+    gauges[name].append((labels, fn))
+
+def remove_gauge(name, labels=()):
+    gauges[name] = [(gauge_labels, fn) for gauge_labels,fn in gauges.get(name, []) if gauge_labels != labels]
+
+def format_labels(labels, extra=None):
+    pairs = list(labels)
+
+    if extra is not None:
+        pairs.append(extra)
+
+    if len(pairs) == 0:
+        return ''
+
+    return '{' + ','.join(['{}="{}"'.format(key, val) for key,val in pairs]) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render():
+    lines = []
+
+    for name,(metric_type,help_text,buckets) in definitions.items():
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        if metric_type == 'gauge':
+            for labels,fn in gauges.get(name, []):
+                try:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), format_value(fn())))
+                except Exception as e:
+                    logger.debug('Failed to compute gauge {} ({})'.format(name, e))
+        elif metric_type == 'counter':
+            with values_lock:
+                counters = list(values[name].items())
+
+            for labels,value in counters:
+                lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+        else:
+            # Copy the histograms under the lock, so that buckets, sum and count are consistent
+            with values_lock:
+                histograms = [(labels, histogram.buckets, list(histogram.counts), histogram.sum, histogram.count) for labels,histogram in values[name].items()]
+
+            for labels,bounds,counts,total,count in histograms:
+                cumulative = 0
+
+                for bound,bucket_count in zip(bounds + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels, ('le', format_value(bound))), cumulative))
+
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(total)))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        body = render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics request from {}: {}'.format(self.client_address[0], format % args))
+
+def close_metrics():
+    global server
+    global active
+
+    if server is None:
+        return
+
+    server.shutdown()
+    server.server_close()
+    server = None
+    active = False
+
+def init_metrics(in_config, in_logger):
+    global logger
+    global server
+    global server_thread
+    global active
+
+    config = in_config
+    logger = in_logger
+
+    for name in definitions.keys():
+        values[name] = dict()
+
+    if 'metrics' not in config:
+        logger.info('No configuration for the metrics endpoint found, disabling it')
+        return
+
+    listen = config['metrics'].get('listen', '127.0.0.1')
+    port = config['metrics'].get('port', 9464)
+
+    server = http.server.ThreadingHTTPServer((listen, port), MetricsHandler)
+    server.daemon_threads = True
+
+    server_thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    server_thread.start()
+
+    active = True
+
+    logger.info('Serving metrics on http://{}:{}/metrics'.format(listen, port))
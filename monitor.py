@@ -4,102 +4,159 @@ import os
 import sys
 import logging
 import time
-import pause
-import sqlitesink
-import influxsink
+import dispatch
+import metrics
+import fastparser
+import serialreader
+import filereader
 import datetime
-import serial
-from dsmr_parser import telegram_specifications
-from dsmr_parser.parsers import TelegramParser
-from dsmr_parser.clients import SerialReader
+import threading
+from dsmr_parser.exceptions import InvalidChecksumError, ParseError
 
 config = None
 logger = None
 
-def process_telegram(telegram):
-    timestamp = None
+# Incremented when the parsers need to be recreated, e.g. because the
+# counters the sinks use have changed
+parser_generation = 0
 
+def telegram_timestamp(telegram):
     for attr,value in telegram:
         if attr == 'P1_MESSAGE_TIMESTAMP':
-            timestamp = int(value.value.timestamp())
+            return int(value.value.timestamp())
+
+    return None
+
+def process_telegram(telegram, meter_id=None):
+    timestamp = telegram_timestamp(telegram)
 
     if timestamp is None:
         timestamp = time.time()
 
-    # Call the sinks
-    sqlitesink.process_telegram(timestamp, telegram)
-    influxsink.process_telegram(timestamp, telegram)
+    # Hand the telegram to the sink workers
+    dispatch.dispatch(timestamp, telegram, meter_id)
 
-def file_loop():
-    if 'meter' not in config:
-        raise Exception('Missing "meter" section in the configuration')
+def parse_telegram(parser, telegram_str, meter_id, labels):
+    # Returns the parsed telegram, or None if it is discarded
+    metrics.inc('pymeter_telegrams_received_total', labels=labels)
 
-    if 'p1_file' not in config['meter']:
-        raise Exception('Missing "p1_file" item in the "meter" section of the configuration')
+    mark = time.perf_counter()
 
-    p1_file = config['meter']['p1_file']
+    try:
+        telegram = parser.parse(telegram_str)
+    except InvalidChecksumError as e:
+        metrics.inc('pymeter_telegrams_crc_failed_total', labels=labels)
+        logger.warning('Discarding telegram from meter {} with invalid CRC ({})'.format(meter_desc(meter_id), e))
+        return None
+    except ParseError as e:
+        metrics.inc('pymeter_telegrams_invalid_total', labels=labels)
+        logger.error('Failed to parse telegram from meter {} ({})'.format(meter_desc(meter_id), e))
+        return None
 
-    while True:
-        telegram_txt = ''
+    metrics.inc('pymeter_telegrams_parsed_total', labels=labels)
+    metrics.observe('pymeter_parse_seconds', time.perf_counter() - mark, labels)
 
-        with open(p1_file, 'r') as p1_fd:
-            for line in p1_fd:
-                line = line.strip()
-                line += '\r\n'
-                telegram_txt += line
+    return telegram
 
-        telegram_str = (telegram_txt)
-        parser = TelegramParser(telegram_specifications.V5, False)
-        telegram = parser.parse(telegram_str)
+def file_loop(meter_config, meter_id=None):
+    p1_file = meter_config['p1_file']
+    mode = meter_config.get('file_mode', 'snapshot')
+
+    logger.info('Reading telegrams for meter {} from {} ({})'.format(meter_desc(meter_id), p1_file, 'FIFO' if filereader.is_fifo(p1_file) else mode))
+
+    # Metrics are labelled with the meter ID if there is more than one meter
+    labels = (('meter', meter_id),) if meter_id is not None else ()
+
+    # Files are often written by other tools that do not keep the CRC
+    # intact, so it is not checked
+    parser = make_parser(meter_config, meter_id, labels, False)
+    generation = parser_generation
+    last_timestamp = None
+
+    for telegram_str in filereader.file_telegrams(p1_file, mode, logger):
+        if generation != parser_generation:
+            parser = make_parser(meter_config, meter_id, labels, False)
+            generation = parser_generation
+
+        telegram = parse_telegram(parser, telegram_str, meter_id, labels)
+
+        if telegram is None:
+            continue
 
-        mark = datetime.datetime.now()
+        # Skip telegrams that have already been processed
+        timestamp = telegram_timestamp(telegram)
 
-        process_telegram(telegram)
+        if timestamp is not None and last_timestamp is not None and timestamp <= last_timestamp:
+            metrics.inc('pymeter_telegrams_duplicate_total', labels=labels)
+            logger.debug('Skipping telegram from meter {} with timestamp {} that was already processed'.format(meter_desc(meter_id), timestamp))
+            continue
 
-        elapsed = datetime.datetime.now() - mark
+        if timestamp is not None:
+            last_timestamp = timestamp
 
-        logger.debug('Telegram processing took {}'.format(elapsed))
+        mark = time.perf_counter()
 
-        pause.until(time.time() + 1)
+        process_telegram(telegram, meter_id)
 
-def serial_loop():
-    if 'meter' not in config:
-        raise Exception('Missing "meter" section in the configuration')
+        logger.debug('Telegram processing took {:.6f}s'.format(time.perf_counter() - mark))
+
+def make_parser(meter_config, meter_id, labels, apply_checksum=True):
+    parser_mode = meter_config.get('parser', 'full')
+
+    if parser_mode == 'full':
+        from dsmr_parser import telegram_specifications
+        from dsmr_parser.parsers import TelegramParser
+
+        return TelegramParser(telegram_specifications.V5, apply_checksum)
+
+    if parser_mode != 'fast':
+        raise Exception('Unsupported parser "{}" specified in the configuration of meter {}'.format(parser_mode, meter_desc(meter_id)))
+
+    # The fast-path parser only extracts the counters the active sinks use
+    parser = fastparser.FastParser(fastparser.enabled_names(), labels, apply_checksum)
+
+    logger.info('Using the fast-path parser for meter {}, extracting {}'.format(meter_desc(meter_id), ', '.join(parser.names)))
+
+    return parser
+
+def serial_loop(meter_config, meter_id=None):
+    # pyserial is only needed when reading from a serial port
+    import serial
 
     serial_settings = dict()
 
     for setting in ['port', 'speed', 'bits', 'parity', 'rts_cts', 'xon_xoff']:
-        if setting not in config['meter']:
-            raise Exception('Missing "{}" value in "meter" section of the configuration'.format(setting))
+        if setting not in meter_config:
+            raise Exception('Missing "{}" value in configuration of meter {}'.format(setting, meter_desc(meter_id)))
 
-    port = config['meter']['port']
+    port = meter_config['port']
 
-    serial_settings['baudrate'] = config['meter']['speed']
+    serial_settings['baudrate'] = meter_config['speed']
   
-    if config['meter']['bits'] == 7:
+    if meter_config['bits'] == 7:
         serial_settings['bytesize'] = serial.SEVENBITS
-    elif config['meter']['bits'] == 8:
+    elif meter_config['bits'] == 8:
         serial_settings['bytesize'] = serial.EIGHTBITS
     else:
-        raise Exception('Unsupport byte size of {} bits specified in the configuration'.format(config['meter']['bits']))
+        raise Exception('Unsupport byte size of {} bits specified in the configuration'.format(meter_config['bits']))
 
-    if config['meter']['parity'] == 'none':
+    if meter_config['parity'] == 'none':
         serial_settings['parity'] = serial.PARITY_NONE
-    elif config['meter']['parity'] == 'odd':
+    elif meter_config['parity'] == 'odd':
         serial_settings['parity'] = serial.PARITY_ODD
-    elif config['meter']['parity'] == 'even':
+    elif meter_config['parity'] == 'even':
         serial_settings['parity'] = serial.PARITY_EVEN
     else:
-        raise Exception('Unsupported parity setting "{}" specified in the configuration'.format(config['meter']['parity']))
+        raise Exception('Unsupported parity setting "{}" specified in the configuration'.format(meter_config['parity']))
 
-    if config['meter']['rts_cts']:
+    if meter_config['rts_cts']:
         serial_settings['rtscts'] = 1
         rts_cts = 'on'
     else:
         serial_settings['rtscts'] = 0
         rts_cts = 'off'
 
-    if config['meter']['xon_xoff']:
+    if meter_config['xon_xoff']:
         serial_settings['xonxoff'] = 1
         xon_xoff = 'on'
     else:
@@ -110,29 +167,119 @@ def serial_loop():
     serial_settings['stopbits'] = serial.STOPBITS_ONE
     serial_settings['timeout'] = 20
 
-    logger.info('Reading telegrams from serial port {} at {}bps (parity {}, {} bits/byte, RTS/CTS {}, XON/XOFF {})'.format(port, serial_settings['baudrate'], config['meter']['parity'], serial_settings['bytesize'], rts_cts, xon_xoff))
+    logger.info('Reading telegrams for meter {} from serial port {} at {}bps (parity {}, {} bits/byte, RTS/CTS {}, XON/XOFF {})'.format(meter_desc(meter_id), port, serial_settings['baudrate'], meter_config['parity'], serial_settings['bytesize'], rts_cts, xon_xoff))
+
+    # Metrics are labelled with the meter ID if there is more than one meter
+    labels = (('meter', meter_id),) if meter_id is not None else ()
+
+    parser = make_parser(meter_config, meter_id, labels)
+    generation = parser_generation
+    backoff = serialreader.Backoff()
+    connected_before = False
 
     # Run the loop
     while True:
-        serial_reader = SerialReader(device=port, serial_settings=serial_settings, telegram_specification=telegram_specifications.V5)
+        if connected_before:
+            metrics.inc('pymeter_serial_reconnects_total', labels=labels)
+
+            # Back off before reconnecting, or wait for the device to
+            # reappear if it was unplugged
+            serialreader.wait_for_port(port, backoff.delay(), logger, meter_desc(meter_id))
+
+        connected_before = True
 
         try:
-            for telegram in serial_reader.read():
-                mark = datetime.datetime.now()
+            with serial.Serial(port=port, **serial_settings) as serial_handle:
+                reader = serialreader.SerialReader(serial_handle, serial_settings['timeout'])
 
-                process_telegram(telegram)
+                for telegram_str in reader.telegrams():
+                    if telegram_str is None:
+                        continue
 
-                elapsed = datetime.datetime.now() - mark
+                    if generation != parser_generation:
+                        parser = make_parser(meter_config, meter_id, labels)
+                        generation = parser_generation
 
-                logger.debug('Telegram processing took {}'.format(elapsed))
+                    telegram = parse_telegram(parser, telegram_str, meter_id, labels)
+
+                    if telegram is None:
+                        continue
+
+                    # The connection works, so the next reconnect is quick
+                    backoff.reset()
+
+                    mark = time.perf_counter()
+
+                    process_telegram(telegram, meter_id)
+
+                    logger.debug('Telegram processing took {:.6f}s'.format(time.perf_counter() - mark))
         except Exception as e:
-            logger.error('Exception while accessing serial device ({})'.format(e))
+            logger.error('Exception while accessing serial device for meter {} ({})'.format(meter_desc(meter_id), e))
+
+def reload_parsers():
+    global parser_generation
+
+    parser_generation += 1
+
+def meter_desc(meter_id):
+    return meter_id if meter_id is not None else 'default'
+
+def get_meters():
+    meters = []
+
+    if 'meters' in config:
+        for meter_config in config['meters']:
+            if 'id' not in meter_config:
+                raise Exception('Missing "id" value for a meter in the "meters" list in the configuration')
+
+            if meter_config['id'] in [meter_id for meter_id,_ in meters]:
+                raise Exception('Duplicate meter ID "{}" in the "meters" list in the configuration'.format(meter_config['id']))
+
+            meters.append((meter_config['id'], meter_config))
+    elif 'meter' in config:
+        meters.append((None, config['meter']))
+    else:
+        raise Exception('Missing "meter" section or "meters" list in the configuration')
+
+    return meters
+
+def meter_loop(meter_config, meter_id):
+    # Meters are read from a file or FIFO if one is configured, and from a
+    # serial port otherwise
+    if 'p1_file' in meter_config:
+        file_loop(meter_config, meter_id)
+    else:
+        serial_loop(meter_config, meter_id)
+
+def meter_thread(meter_config, meter_id):
+    try:
+        meter_loop(meter_config, meter_id)
+    except Exception as e:
+        logger.error('Monitor loop for meter {} exited with an exception ({})'.format(meter_desc(meter_id), e))
 
 def run_monitor():
     logger.info('Monitor loop starting')
 
     try:
-        serial_loop()
+        meters = get_meters()
+
+        if len(meters) == 1:
+            meter_id,meter_config = meters[0]
+            meter_loop(meter_config, meter_id)
+        else:
+            # Read each meter from its own thread; the threads all feed
+            # the same sink instances
+            logger.info('Monitoring {} meters'.format(len(meters)))
+
+            threads = []
+
+            for meter_id,meter_config in meters:
+                thread = threading.Thread(target=meter_thread, args=(meter_config, meter_id), name='meter-{}'.format(meter_id), daemon=True)
+                thread.start()
+                threads.append(thread)
+
+            for thread in threads:
+                thread.join()
     except Exception as e:
         logger.error('Monitor loop exited with an exception ({})'.format(e))
     finally:
@@ -5,29 +5,45 @@ import sys
 import libconf
 import logging
 import argparse
+import signal
+import threading
 import monitor
-import sqlitesink
-import influxsink
+import dispatch
+import metrics
+import compression
+import sinks
 
 # Default configuration
 default_config = '/etc/pymeter.conf'
 
+# Configuration sections that cannot be changed without a restart
+restart_sections = ['meter', 'meters', 'metrics', 'compression']
+
+# Serialises configuration reloads
+reload_lock = threading.Lock()
+
+def log_level(config):
+    loglevel = int(config['logging'].get('loglevel', 3))
+
+    pylevel = logging.INFO
+
+    if loglevel == 1:
+        pylevel = logging.ERROR
+    elif loglevel == 2:
+        pylevel = logging.WARNING
+    elif loglevel == 3:
+        pylevel = logging.INFO
+    elif loglevel == 4:
+        pylevel = logging.DEBUG
+
+    return pylevel
+
 # Configure logging
 def configure_log(config):
     if 'logging' in config:
-        loglevel = int(config['logging'].get('loglevel', 3))
         filelog = config['logging'].get('filelog', None)
 
-        pylevel = logging.INFO
-
-        if loglevel == 1:
-            pylevel = logging.ERROR
-        elif loglevel == 2:
-            pylevel = logging.WARNING
-        elif loglevel == 3:
-            pylevel = logging.INFO
-        elif loglevel == 4:
-            pylevel = logging.DEBUG
+        pylevel = log_level(config)
 
         logfmt = '%(asctime)s [%(levelname)s] %(message)s'
         datefmt = '%Y-%m-%d %H:%M:%S'
@@ -39,12 +55,62 @@ def configure_log(config):
 
     return logging.getLogger('pymeter')
 
+def reload_config(config_file, config, logger):
+    # Applies changes to the log level and to the sinks and their counters;
+    # sinks keep their connections and buffered data
+    with reload_lock:
+        logger.info('Reloading configuration from {}'.format(config_file))
+
+        try:
+            with open(config_file, 'r') as cfg_fd:
+                new_config = libconf.load(cfg_fd)
+        except Exception as e:
+            logger.error('Failed to load configuration from {}, keeping the current configuration ({})'.format(config_file, e))
+            return
+
+        for section in restart_sections:
+            if new_config.get(section, None) != config.get(section, None):
+                logger.warning('Changes to the {} section of the configuration take effect after a restart'.format(section))
+
+        if 'logging' in new_config:
+            logging.getLogger().setLevel(log_level(new_config))
+
+        try:
+            added,removed,kept = sinks.reload_sinks(new_config)
+
+            for name in removed:
+                dispatch.remove_sink(name)
+                sinks.close_sink(name)
+
+            for name in kept:
+                dispatch.reload_sink(name, new_config)
+
+            for name in added:
+                dispatch.add_sink(name, sinks.get(name), new_config[sinks.registry[name][1]])
+        except Exception as e:
+            logger.error('Failed to apply the new configuration to the sinks ({})'.format(e))
+
+        # The counters to parse may have changed
+        monitor.reload_parsers()
+
+        logger.info('Reloaded configuration, active sinks: {}'.format(', '.join([name for name,sink,section in sinks.active_sinks()])))
+
+def stop(signum, frame):
+    # systemd stops the service with SIGTERM; stop the same way as on
+    # Ctrl-C, so that the sinks flush and close. A second SIGTERM must not
+    # interrupt the shutdown
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    raise SystemExit(0)
+
 def main():
     # Process command-line arguments
     argparser = argparse.ArgumentParser(description = 'Python smart meter monitoring daemon')
 
     argparser.add_argument('-c, --config', nargs=1, help='configuration file to use', type=str, metavar='config_file', dest='config_file', required=False, default=[default_config])
 
+    argparser.add_argument('--replay', nargs=1, help='replay telegrams from a capture file instead of reading the meter', type=str, metavar='capture_file', dest='capture_file', required=False, default=None)
+
     args = argparser.parse_args()
 
     # Load configuration
@@ -59,12 +125,35 @@ def main():
 
     logger.info('Starting the Python smart meter monitoring tool')
 
+    signal.signal(signal.SIGTERM, stop)
+
     try:
+        metrics.init_metrics(config, logger)
         monitor.init_monitor(config, logger)
-        sqlitesink.init_sink(config, logger)
-        influxsink.init_sink(config, logger)
+        compression.init_compression(config, logger)
+        sinks.init_sinks(config, logger)
+
+        # Each active sink gets its own queue and worker thread
+        dispatch.init_dispatch(config, logger)
+
+        if args.capture_file is not None:
+            import replay
+
+            replay.run_replay(config, logger, args.capture_file[0])
+            return
+
+        for name,sink,section in sinks.active_sinks():
+            dispatch.add_sink(name, sink, config[section])
+
+        # Reload the configuration on SIGHUP; the reload runs in its own
+        # thread so that reading the meter carries on meanwhile
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=reload_config, args=(args.config_file[0], config, logger), name='reload', daemon=True).start())
+
         monitor.run_monitor()
     finally:
+        dispatch.close_dispatch()
+        sinks.close_sinks()
+        metrics.close_metrics()
         logger.info('Exiting the Python smart meter monitoring tool')
 
 if __name__ == "__main__":
@@ -1,3 +1,3 @@
 #!/usr/bin/env bash
 cd /usr/local/bin
-./pymeter.py
+exec ./pymeter.py
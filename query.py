@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import libconf
+import logging
+import sqlite3
+import argparse
+import datetime
+import threading
+import http.server
+import urllib.parse
+import schema
+import rollup
+import ledger
+import export
+import hotsink
+
+# Default configuration
+default_config = '/etc/pymeter.conf'
+
+logger = None
+config = None
+
+# Number of rows fetched from a cursor at a time
+chunk_size = 1000
+
+# Databases with raw measurements and averages  = (config key, granularity)
+average_dbs = [('raw_db', 1), ('fivemin_avg', 300), ('hourly_avg', 3600)]
+
+def db_config():
+    if 'legacy_database' not in config:
+        raise Exception('Missing "legacy_database" section in the configuration')
+
+    return config['legacy_database']
+
+def open_ro(filename):
+    return sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(filename)), uri=True, check_same_thread=False)
+
+def resolve_counter(counter):
+    # Counters can be given by identifier (1.7.0), table (RAW_1_7_0) or DSMR name
+    for key,(counter_id,table,unit) in schema.dsmr_map.items():
+        if counter in [key, counter_id, table]:
+            return table, unit
+
+    raise Exception('Unknown counter "{}"'.format(counter))
+
+def table_exists(db, table):
+    return len(schema.table_columns(db, table)) > 0
+
+def sources(table):
+    # Returns the tables that hold data for a counter as a list of
+    # (granularity, filename, table, value column), finest first
+    found = []
+    cfg = db_config()
+
+    if not table.startswith('RAW_'):
+        if 'total_consumed' in cfg:
+            found.append((cfg.get('total_interval', 300), cfg['total_consumed'], table, 'value'))
+
+        return found
+
+    for key,granularity in average_dbs:
+        if key in cfg:
+            found.append((granularity, cfg[key], table, 'value'))
+
+    if 'rollup_db' in cfg and os.path.exists(cfg['rollup_db']):
+        db = open_ro(cfg['rollup_db'])
+
+        try:
+            prefix = table + '_'
+
+            for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?;", (prefix + '%',)):
+                try:
+                    granularity = rollup.parse_tier(name[len(prefix):])
+                except Exception:
+                    continue
+
+                if granularity not in [source[0] for source in found]:
+                    found.append((granularity, cfg['rollup_db'], name, 'avg'))
+        finally:
+            db.close()
+
+    found.sort(key=lambda source: source[0])
+
+    return found
+
+def select_source(table, resolution):
+    found = sources(table)
+
+    if len(found) == 0:
+        raise Exception('No database configured that holds data for table {}'.format(table))
+
+    # Use the coarsest table that still satisfies the requested resolution
+    selected = found[0]
+
+    for source in found:
+        if source[0] <= resolution:
+            selected = source
+
+    return selected
+
+def query_range(counter, start, end, resolution=1, meter=None):
+    table,unit = resolve_counter(counter)
+
+    # Consumption/production counters are cumulative, so the last value
+    # in a bucket is used rather than the average
+    aggregate = 'AVG' if table.startswith('RAW_') else 'MAX'
+
+    # When queries are served by pymeter itself, recent data comes from
+    # the hot tier in memory
+    if hotsink.covers(table, meter, start):
+        logger.debug('Answering query for {} at {}s resolution from the hot tier'.format(table, resolution))
+
+        yield from hotsink.read_range(table, meter, start, end, resolution, aggregate)
+        return
+
+    granularity,filename,source_table,column = select_source(table, resolution)
+
+    logger.debug('Answering query for {} at {}s resolution from table {} in {} ({}s granularity)'.format(table, resolution, source_table, filename, granularity))
+
+    # Averages and rollups are stored with the end of their window; they are
+    # shifted to the start of the window, like buckets of raw values
+    offset = granularity if table.startswith('RAW_') and granularity > 1 else 0
+
+    where = 'timestamp >= ? AND timestamp < ?'
+    params = [start + offset, end + offset]
+
+    if meter is not None:
+        where += ' AND meter = ?'
+        params.append(meter)
+
+    # Timestamps may be stored as REAL, so they are truncated before bucketing
+    if resolution > granularity:
+        query = 'SELECT (CAST(timestamp - ? AS INTEGER) / ?) * ? AS bucket, {}({}) FROM {} WHERE {} GROUP BY bucket ORDER BY bucket;'.format(aggregate, column, source_table, where)
+        params = [offset, resolution, resolution] + params
+    else:
+        query = 'SELECT timestamp - ?, {} FROM {} WHERE {} ORDER BY timestamp;'.format(column, source_table, where)
+        params = [offset] + params
+
+    db = open_ro(filename)
+
+    try:
+        cur = db.execute(query, params)
+
+        while True:
+            rows = cur.fetchmany(chunk_size)
+
+            if len(rows) == 0:
+                break
+
+            for row in rows:
+                yield row
+    finally:
+        db.close()
+
+def period_start(period, value):
+    # Returns the start of the day or month as stored in the ledger
+    fmt = dict(ledger.periods)[period]
+
+    if value is None:
+        return time.strftime(fmt)
+
+    return time.strftime(fmt, time.localtime(parse_time(value)))
+
+def query_ledger(period, start=None, description=None, meter=None):
+    # Returns the ledger rows for a period as a list of (start, description,
+    # meter, kind, delta, unit)
+    cfg = db_config()
+
+    if 'ledger_db' not in cfg:
+        raise Exception('No ledger database configured')
+
+    if period not in dict(ledger.periods):
+        raise Exception('Unknown period "{}", use one of {}'.format(period, ', '.join(dict(ledger.periods).keys())))
+
+    where = 'period = ? AND start = ?'
+    params = [period, period_start(period, start)]
+
+    if description is not None:
+        where += ' AND description = ?'
+        params.append(description)
+
+    if meter is not None:
+        where += ' AND meter = ?'
+        params.append(meter)
+
+    db = open_ro(cfg['ledger_db'])
+
+    try:
+        return db.execute('SELECT start, description, meter, kind, delta, unit FROM ledger WHERE {} ORDER BY kind, description, meter;'.format(where), params).fetchall()
+    finally:
+        db.close()
+
+def export_source(database, counters, start, end, meter):
+    # Returns the rows to export from a database, for all counters or the
+    # given ones
+    cfg = db_config()
+
+    if database not in cfg:
+        raise Exception('No {} database configured'.format(database))
+
+    tables = None if len(counters) == 0 else [resolve_counter(counter)[0] for counter in counters]
+
+    return export.export_rows(cfg[database], tables, None if start is None else parse_time(start), None if end is None else parse_time(end), meter)
+
+def migrate():
+    cfg = db_config()
+
+    for key,granularity in average_dbs + [('total_consumed', None), ('rollup_db', None), ('ledger_db', None)]:
+        if key not in cfg:
+            continue
+
+        db = sqlite3.connect(cfg[key])
+
+        logger.info('Migrating schema of {}'.format(cfg[key]))
+
+        # Enabling incremental vacuuming on an existing database needs a full
+        # VACUUM, which can take a while on large databases
+        if db.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+            logger.info('Enabling incremental vacuum for {}, this may take a while'.format(cfg[key]))
+
+            db.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+            db.execute('VACUUM;')
+
+        if key == 'ledger_db':
+            schema.ensure_ledger_tables(db)
+
+        # Rollup tables are created by the sink when they are needed
+        if key not in ['rollup_db', 'ledger_db']:
+            for counter_id,table,unit in schema.dsmr_map.values():
+                if table.startswith('RAW_') == (key != 'total_consumed'):
+                    schema.ensure_table(db, table, logger)
+
+        db.commit()
+        db.close()
+
+def parse_time(value):
+    if value == 'now':
+        return int(time.time())
+
+    if value.startswith('-'):
+        return int(time.time()) - rollup.parse_tier(value[1:])
+
+    try:
+        return int(value)
+    except ValueError:
+        pass
+
+    return int(datetime.datetime.fromisoformat(value).timestamp())
+
+def parse_resolution(value):
+    try:
+        return int(value)
+    except ValueError:
+        return rollup.parse_tier(value)
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_chunk(self, data):
+        self.wfile.write('{:X}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        args = dict(urllib.parse.parse_qsl(url.query))
+
+        if url.path == '/counters':
+            self.send_json(200, [dict(name=key, id=counter_id, table=table, unit=unit) for key,(counter_id,table,unit) in schema.dsmr_map.items()])
+            return
+
+        if url.path == '/ledger':
+            try:
+                rows = query_ledger(args.get('period', 'day'), args.get('start', None), args.get('description', None), args.get('meter', None))
+            except Exception as e:
+                self.send_json(400, dict(error=str(e)))
+                return
+
+            self.send_json(200, [dict(start=start, description=description, meter=meter, kind=kind, total=delta, unit=unit) for start,description,meter,kind,delta,unit in rows])
+            return
+
+        if url.path != '/range':
+            self.send_json(404, dict(error='Unknown path {}'.format(url.path)))
+            return
+
+        try:
+            counter = args['counter']
+            start = parse_time(args.get('start', '-1d'))
+            end = parse_time(args.get('end', 'now'))
+            resolution = parse_resolution(args.get('resolution', '1'))
+            rows = query_range(counter, start, end, resolution, args.get('meter', None))
+            first = next(rows, None)
+        except Exception as e:
+            self.send_json(400, dict(error=str(e)))
+            return
+
+        # Stream the results as a JSON array of [timestamp, value] pairs
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        buf = [b'[']
+
+        if first is not None:
+            buf.append(json.dumps(first).encode('ascii'))
+
+            for row in rows:
+                buf.append(b',' + json.dumps(row).encode('ascii'))
+
+                if len(buf) >= chunk_size:
+                    self.send_chunk(b''.join(buf))
+                    buf = []
+
+        buf.append(b']')
+        self.send_chunk(b''.join(buf))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        logger.debug('Query request from {}: {}'.format(self.client_address[0], format % args))
+
+def make_server(listen, port):
+    server = http.server.ThreadingHTTPServer((listen, port), QueryHandler)
+    server.daemon_threads = True
+
+    return server
+
+def serve(listen, port):
+    server = make_server(listen, port)
+
+    logger.info('Serving queries on http://{}:{}/range'.format(listen, port))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def init_query(in_config, in_logger):
+    global config
+    global logger
+
+    config = in_config
+    logger = in_logger
+
+def main():
+    argparser = argparse.ArgumentParser(description = 'Query the pymeter sqlite3 databases')
+
+    argparser.add_argument('-c, --config', nargs=1, help='configuration file to use', type=str, metavar='config_file', dest='config_file', required=False, default=[default_config])
+    argparser.add_argument('-v, --verbose', help='log the selected tables', action='store_true', dest='verbose')
+
+    commands = argparser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('migrate', help='create missing tables and indexes, and update older tables')
+
+    range_parser = commands.add_parser('range', help='output values for a counter in a time range as CSV')
+    range_parser.add_argument('counter', help='counter identifier (e.g. 1.7.0), table or DSMR name')
+    range_parser.add_argument('--start', help='start of the range (epoch, ISO date, or e.g. -1d)', default='-1d')
+    range_parser.add_argument('--end', help='end of the range (epoch, ISO date, or now)', default='now')
+    range_parser.add_argument('--resolution', help='resolution in seconds, or e.g. 5m, 1h', default='1')
+    range_parser.add_argument('--meter', help='only return values for this meter', default=None)
+
+    ledger_parser = commands.add_parser('ledger', help='output consumption/production totals for a day or month as CSV')
+    ledger_parser.add_argument('period', help='period to output totals for', choices=[period for period,fmt in ledger.periods])
+    ledger_parser.add_argument('--start', help='a time in the period (epoch, ISO date, or e.g. -1d), default is the current period', default=None)
+    ledger_parser.add_argument('--description', help='only output the totals for this counter description', default=None)
+    ledger_parser.add_argument('--meter', help='only output the totals for this meter', default=None)
+
+    export_databases = [key for key,granularity in average_dbs] + ['total_consumed']
+
+    export_parser = commands.add_parser('export', help='export a database, or part of it, as CSV, Parquet or InfluxDB line protocol')
+    export_parser.add_argument('database', help='database to export', choices=export_databases)
+    export_parser.add_argument('counters', nargs='*', help='counters to export (default is all counters)')
+    export_parser.add_argument('--start', help='start of the range (epoch, ISO date, or e.g. -1d)', default=None)
+    export_parser.add_argument('--end', help='end of the range (epoch, ISO date, or now)', default=None)
+    export_parser.add_argument('--meter', help='only export values for this meter', default=None)
+    export_parser.add_argument('--format', help='output format', choices=['csv', 'parquet', 'line'], default='csv')
+    export_parser.add_argument('--output', help='file to write to (default is standard output, required for Parquet)', default=None)
+
+    backfill_parser = commands.add_parser('backfill', help='write the values in a database, or part of it, to InfluxDB')
+    backfill_parser.add_argument('database', help='database to read from', nargs='?', choices=export.line_databases, default='raw_db')
+    backfill_parser.add_argument('counters', nargs='*', help='counters to write (default is all counters)')
+    backfill_parser.add_argument('--start', help='start of the range (epoch, ISO date, or e.g. -1d)', default=None)
+    backfill_parser.add_argument('--end', help='end of the range (epoch, ISO date, or now)', default=None)
+    backfill_parser.add_argument('--meter', help='only write values for this meter', default=None)
+    backfill_parser.add_argument('--batch-size', help='number of points per write', type=int, dest='batch_size', default=export.backfill_batch_size)
+
+    serve_parser = commands.add_parser('serve', help='serve range queries over HTTP')
+    serve_parser.add_argument('--listen', help='address to listen on', default='127.0.0.1')
+    serve_parser.add_argument('--port', help='port to listen on', type=int, default=8464)
+
+    args = argparser.parse_args()
+
+    with open(args.config_file[0], 'r') as cfg_fd:
+        in_config = libconf.load(cfg_fd)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S', stream=sys.stderr)
+
+    init_query(in_config, logging.getLogger('pymeter'))
+
+    if args.command == 'migrate':
+        migrate()
+    elif args.command == 'range':
+        for timestamp,value in query_range(args.counter, parse_time(args.start), parse_time(args.end), parse_resolution(args.resolution), args.meter):
+            sys.stdout.write('{},{}\n'.format(timestamp, value))
+    elif args.command == 'ledger':
+        for start,description,meter,kind,delta,unit in query_ledger(args.period, args.start, args.description, args.meter):
+            sys.stdout.write('{},{},{},{},{},{}\n'.format(start, description, meter, kind, delta, unit))
+    elif args.command == 'export':
+        rows = export_source(args.database, args.counters, args.start, args.end, args.meter)
+
+        if args.format == 'parquet':
+            if args.output is None:
+                argparser.error('exporting to Parquet requires an output file')
+
+            count = export.write_parquet(rows, args.output)
+        else:
+            if args.format == 'line' and args.database not in export.line_databases:
+                argparser.error('only the {} databases can be exported as line protocol'.format(' and '.join(export.line_databases)))
+
+            write = export.write_csv if args.format == 'csv' else export.write_lines
+
+            if args.output is None:
+                count = write(rows, sys.stdout)
+            else:
+                with open(args.output, 'w', newline='') as out_fd:
+                    count = write(rows, out_fd)
+
+        logger.info('Exported {} rows from the {} database'.format(count, args.database))
+    elif args.command == 'backfill':
+        if 'influx' not in config:
+            raise Exception('Missing "influx" section in the configuration')
+
+        rows = export_source(args.database, args.counters, args.start, args.end, args.meter)
+        count = export.backfill(rows, config['influx'], logger, args.batch_size)
+
+        logger.info('Wrote {} values from the {} database to InfluxDB'.format(count, args.database))
+    elif args.command == 'serve':
+        serve(args.listen, args.port)
+
+if __name__ == "__main__":
+    main()
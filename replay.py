@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import logging
+import time
+import re
+import heapq
+import itertools
+import multiprocessing
+import dispatch
+import sinks
+from dsmr_parser import telegram_specifications
+from dsmr_parser.parsers import TelegramParser
+
+logger = None
+
+# Size of the chunks in which the capture file is read
+read_size = 1024 * 1024
+
+# Number of telegrams handed to a parser process at a time
+parse_chunk = 64
+
+# Number of telegrams submitted to the parser processes at a time; at most
+# two windows are in flight, so memory use does not grow with the size of
+# the capture when the sinks fall behind
+parse_window = 8192
+
+# Number of telegrams to hold back to restore timestamp order
+reorder_window = 256
+
+# How often to report progress (in seconds)
+progress_interval = 10
+
+# End of a telegram: '!' followed by the CRC and the line ending
+telegram_end = re.compile(rb'!([0-9A-Fa-f]{4})?\r?\n')
+
+# Per-process parser, created once in each worker
+parser = None
+
+def init_parser():
+    global parser
+
+    parser = TelegramParser(telegram_specifications.V5, True)
+
+def parse_telegram(telegram_bytes):
+    # Captures are sometimes stored with plain newlines, the CRC is computed
+    # over the telegram with CR/LF line endings
+    if b'\r\n' not in telegram_bytes:
+        telegram_bytes = telegram_bytes.replace(b'\n', b'\r\n')
+
+    try:
+        telegram = parser.parse(telegram_bytes.decode('ascii'))
+    except Exception as e:
+        return None, str(e)
+
+    timestamp = None
+
+    for attr,value in telegram:
+        if attr == 'P1_MESSAGE_TIMESTAMP':
+            timestamp = int(value.value.timestamp())
+
+    if timestamp is None:
+        return None, 'telegram has no timestamp'
+
+    return timestamp, telegram
+
+def split_telegrams(capture, progress):
+    buf = b''
+
+    while True:
+        data = capture.read(read_size)
+
+        if len(data) == 0:
+            break
+
+        progress['bytes'] += len(data)
+
+        buf += data
+        pos = 0
+
+        for match in telegram_end.finditer(buf):
+            start = buf.find(b'/', pos, match.start())
+
+            if start >= 0:
+                yield buf[start:match.end()]
+
+            pos = match.end()
+
+        buf = buf[pos:]
+
+def parse_bounded(pool, telegrams):
+    # Yields parsed telegrams in order. Pool.imap reads its input as fast as
+    # it can, so it is only given one window at a time; the next window is
+    # parsed while the results of the current one are dispatched
+    windows = iter(lambda: list(itertools.islice(telegrams, parse_window)), [])
+    current = None
+
+    for window in windows:
+        upcoming = pool.imap(parse_telegram, window, chunksize=parse_chunk)
+
+        if current is not None:
+            yield from current
+
+        current = upcoming
+
+    if current is not None:
+        yield from current
+
+def report(progress, total_bytes, start_time, final=False):
+    now = time.time()
+
+    if not final and now - progress['last_report'] < progress_interval:
+        return
+
+    elapsed = now - start_time
+    rate = progress['telegrams'] / elapsed if elapsed > 0 else 0
+    percent = 100.0 * progress['bytes'] / total_bytes if total_bytes > 0 else 100.0
+
+    logger.info('Replayed {} telegrams ({:.1f}% of capture, {} failed to parse) at {:.0f} telegrams/s'.format(progress['telegrams'], percent, progress['failed'], rate))
+
+    progress['last_report'] = now
+
+def run_replay(config, in_logger, capture_file):
+    global logger
+
+    logger = in_logger
+
+    processes = None
+
+    if 'replay' in config:
+        processes = config['replay'].get('processes', None)
+
+    total_bytes = os.path.getsize(capture_file)
+
+    logger.info('Replaying telegrams from {} ({} bytes)'.format(capture_file, total_bytes))
+
+    # Replay as fast as the sinks allow; sinks run in bulk mode and the
+    # dispatcher blocks rather than drops when a sink falls behind
+    sinks.enable_bulk_mode()
+
+    for name,sink,section in sinks.active_sinks():
+        dispatch.add_sink(name, sink, {'overflow': 'block'})
+
+    progress = dict(bytes=0, telegrams=0, failed=0, last_report=time.time())
+    start_time = time.time()
+    pending = []
+    seq = 0
+
+    with open(capture_file, 'rb') as capture, multiprocessing.Pool(processes=processes, initializer=init_parser) as pool:
+        for timestamp,telegram in parse_bounded(pool, split_telegrams(capture, progress)):
+            if timestamp is None:
+                progress['failed'] += 1
+                logger.debug('Skipping telegram in capture ({})'.format(telegram))
+                continue
+
+            # Keep a small window of telegrams to restore timestamp order
+            heapq.heappush(pending, (timestamp, seq, telegram))
+            seq += 1
+
+            if len(pending) > reorder_window:
+                timestamp,_,telegram = heapq.heappop(pending)
+                dispatch.dispatch(timestamp, telegram)
+                progress['telegrams'] += 1
+
+            report(progress, total_bytes, start_time)
+
+    while len(pending) > 0:
+        timestamp,_,telegram = heapq.heappop(pending)
+        dispatch.dispatch(timestamp, telegram)
+        progress['telegrams'] += 1
+
+    report(progress, total_bytes, start_time, True)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import logging
+import time
+
+logger = None
+
+# Retention policies; each is a dict with the database handle, a
+# description, a function returning the tables to prune and the
+# retention period in seconds
+policies = []
+
+# Maximum number of rows to delete from a table in one go, and the
+# maximum time to spend on deletions per idle slot (in seconds)
+batch_size = 500
+time_budget = 0.05
+
+# Number of free pages to reclaim after deleting rows
+vacuum_pages = 200
+
+# How long to wait before checking a table again once it has been pruned
+check_interval = 3600
+
+# Tables that are fully pruned, with the time at which to check them again
+next_check = dict()
+
+# Rows deleted since the last report
+deleted = 0
+last_report = 0
+report_interval = 3600
+
+active = False
+
+def add_policy(db, db_desc, tables_fn, days):
+    if db is None or days <= 0:
+        return
+
+    policies.append(dict(db=db, desc=db_desc, tables=tables_fn, retention=days * 86400))
+
+    logger.info('Keeping {} days of data in the {} database'.format(days, db_desc))
+
+def prune_table(db, table, cutoff):
+    cur = db.execute('DELETE FROM {} WHERE rowid IN (SELECT rowid FROM {} WHERE timestamp < ? LIMIT ?);'.format(table, table), (cutoff, batch_size))
+
+    return cur.rowcount
+
+def run_batch():
+    global deleted
+    global last_report
+
+    if not active:
+        return
+
+    now = time.time()
+    deadline = time.perf_counter() + time_budget
+
+    for policy in policies:
+        db = policy['db']
+        cutoff = int(now - policy['retention'])
+        pruned = 0
+
+        for table in list(policy['tables']()):
+            key = (policy['desc'], table)
+
+            if next_check.get(key, 0) > now:
+                continue
+
+            try:
+                count = prune_table(db, table, cutoff)
+            except Exception as e:
+                logger.error('Failed to remove old data from table {} in the {} database ({})'.format(table, policy['desc'], e))
+                count = 0
+
+            pruned += count
+
+            if count < batch_size:
+                next_check[key] = now + check_interval
+
+            if time.perf_counter() > deadline:
+                break
+
+        if pruned > 0:
+            deleted += pruned
+
+            # Return free pages to the file system without a blocking VACUUM.
+            # execute() only steps the pragma once, freeing a single page;
+            # executescript() commits the deletions and runs it to completion
+            try:
+                db.executescript('PRAGMA incremental_vacuum({});'.format(vacuum_pages))
+            except Exception as e:
+                logger.error('Failed to run incremental vacuum on the {} database ({})'.format(policy['desc'], e))
+
+        if time.perf_counter() > deadline:
+            break
+
+    if now - last_report >= report_interval:
+        if deleted > 0:
+            logger.info('Removed {} rows that exceeded their retention period'.format(deleted))
+
+        deleted = 0
+        last_report = now
+
+def init_retention(in_logger):
+    global logger
+    global active
+    global last_report
+
+    logger = in_logger
+
+    policies.clear()
+    next_check.clear()
+
+    last_report = time.time()
+    active = True
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import logging
+
+# Rollup tiers                                      = (name, seconds)
+tiers = []
+
+# Running aggregates per (meter, table, tier seconds)
+aggregates = dict()
+
+# Supported tier units
+tier_units = dict(s=1, m=60, h=3600, d=86400)
+
+class Aggregate:
+    __slots__ = ('start', 'count', 'sum', 'min', 'max', 'last')
+
+    def __init__(self, start, value):
+        self.start = start
+        self.count = 1
+        self.sum = value
+        self.min = value
+        self.max = value
+        self.last = value
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+
+        if value < self.min:
+            self.min = value
+
+        if value > self.max:
+            self.max = value
+
+        self.last = value
+
+    def avg(self):
+        return self.sum / self.count
+
+def parse_tier(tier):
+    try:
+        seconds = int(tier[:-1]) * tier_units[tier[-1]]
+    except Exception:
+        raise Exception('Invalid rollup tier "{}" specified in the configuration (use e.g. "5m", "1h" or "1d")'.format(tier))
+
+    if seconds <= 0 or (86400 % seconds != 0 and seconds % 86400 != 0):
+        raise Exception('Rollup tier "{}" does not divide a day evenly'.format(tier))
+
+    return seconds
+
+def set_tiers(tier_names):
+    tiers.clear()
+
+    for name in tier_names:
+        seconds = parse_tier(name)
+
+        if seconds not in [tier_seconds for _,tier_seconds in tiers]:
+            tiers.append((name, seconds))
+
+    tiers.sort(key=lambda tier: tier[1])
+
+def add(timestamp, meter_id, table, value):
+    # Windows are aligned on (UTC) bucket boundaries and close as soon as a
+    # sample for a later bucket arrives, whichever timestamps are present;
+    # closed windows are returned as (tier name, seconds, end, aggregate)
+    closed = []
+    value = float(value)
+
+    for name,seconds in tiers:
+        start = timestamp - timestamp % seconds
+        key = (meter_id, table, seconds)
+        aggregate = aggregates.get(key, None)
+
+        if aggregate is None:
+            aggregates[key] = Aggregate(start, value)
+        elif aggregate.start == start:
+            aggregate.add(value)
+        elif start > aggregate.start:
+            closed.append((name, seconds, aggregate.start + seconds, aggregate))
+            aggregates[key] = Aggregate(start, value)
+        # Samples for windows that have already closed are ignored
+
+    return closed
+
+def save_state():
+    # Returns the open windows as a list of (meter, table, seconds, start,
+    # count, sum, min, max, last)
+    return [(meter_id, table, seconds, aggregate.start, aggregate.count, aggregate.sum, aggregate.min, aggregate.max, aggregate.last) for (meter_id,table,seconds),aggregate in aggregates.items()]
+
+def restore_state(state, tables):
+    # Restores open windows for the configured tiers and the given tables;
+    # returns the number of windows restored
+    tier_seconds = [seconds for _,seconds in tiers]
+    restored = 0
+
+    for meter_id,table,seconds,start,count,total,minimum,maximum,last in state:
+        if seconds not in tier_seconds or table not in tables or (meter_id, table, seconds) in aggregates:
+            continue
+
+        aggregate = Aggregate(start, last)
+        aggregate.count = count
+        aggregate.sum = total
+        aggregate.min = minimum
+        aggregate.max = maximum
+
+        aggregates[(meter_id, table, seconds)] = aggregate
+        restored += 1
+
+    return restored
+
+def discard(tables):
+    # Forgets the open windows of tables that are no longer rolled up
+    for key in [key for key in aggregates.keys() if key[1] not in tables]:
+        del aggregates[key]
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import logging
+
+# Mapping of DSMR field names to counters; kept here rather than in the
+# sqlite3 sink, so that other modules can use it without loading the sink
+#                                                   = (counter, sqlite3_table, unit)
+dsmr_map = dict()
+
+# Consumption counters
+dsmr_map['ELECTRICITY_USED_TARIFF_1']               = ('1.8.1', 'CONSUMED_1_8_1', 'kWh')
+dsmr_map['ELECTRICITY_USED_TARIFF_2']               = ('1.8.2', 'CONSUMED_1_8_2', 'kWh')
+dsmr_map['ELECTRICITY_USED_TARIFF_3']               = ('1.8.3', 'CONSUMED_1_8_3', 'kWh')
+dsmr_map['ELECTRICITY_USED_TARIFF_4']               = ('1.8.4', 'CONSUMED_1_8_4', 'kWh')
+dsmr_map['HOURLY_GAS_METER_READING']                = ('24.2.1', 'CONSUMED_24_2_1', 'm3')
+
+# Production counters
+dsmr_map['ELECTRICITY_DELIVERED_TARIFF_1']          = ('2.8.1', 'PRODUCED_2_8_1', 'kWh')
+dsmr_map['ELECTRICITY_DELIVERED_TARIFF_2']          = ('2.8.2', 'PRODUCED_2_8_2', 'kWh')
+dsmr_map['ELECTRICITY_DELIVERED_TARIFF_3']          = ('2.8.3', 'PRODUCED_2_8_3', 'kWh')
+dsmr_map['ELECTRICITY_DELIVERED_TARIFF_4']          = ('2.8.4', 'PRODUCED_2_8_4', 'kWh')
+
+# Raw counters
+dsmr_map['CURRENT_ELECTRICITY_USAGE']               = ('1.7.0', 'RAW_1_7_0', 'kW')
+dsmr_map['CURRENT_ELECTRICITY_DELIVERY']            = ('2.7.0', 'RAW_2_7_0', 'kW')
+dsmr_map['INSTANTANEOUS_VOLTAGE_L1']                = ('32.7.0', 'RAW_32_7_0', 'V')
+dsmr_map['INSTANTANEOUS_VOLTAGE_L2']                = ('52.7.0', 'RAW_52_7_0', 'V')
+dsmr_map['INSTANTANEOUS_VOLTAGE_L3']                = ('72.7.0', 'RAW_72_7_0', 'V')
+dsmr_map['INSTANTANEOUS_CURRENT_L1']                = ('31.7.0', 'RAW_31_7_0', 'A')
+dsmr_map['INSTANTANEOUS_CURRENT_L2']                = ('51.7.0', 'RAW_51_7_0', 'A')
+dsmr_map['INSTANTANEOUS_CURRENT_L3']                = ('71.7.0', 'RAW_71_7_0', 'A')
+dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L1_POSITIVE']  = ('21.7.0', 'RAW_21_7_0', 'kW')
+dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L2_POSITIVE']  = ('41.7.0', 'RAW_41_7_0', 'kW')
+dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L3_POSITIVE']  = ('61.7.0', 'RAW_61_7_0', 'kW')
+dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L1_NEGATIVE']  = ('22.7.0', 'RAW_22_7_0', 'kW')
+dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L2_NEGATIVE']  = ('42.7.0', 'RAW_42_7_0', 'kW')
+dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L3_NEGATIVE']  = ('62.7.0', 'RAW_62_7_0', 'kW')
+
+def table_columns(db, table):
+    return [row[1] for row in db.execute('PRAGMA table_info({});'.format(table))]
+
+def ensure_index(db, table):
+    db.execute('CREATE INDEX IF NOT EXISTS {}_timestamp ON {} (timestamp);'.format(table, table))
+
+def ensure_table(db, table, logger=None):
+    columns = table_columns(db, table)
+
+    if len(columns) == 0:
+        if logger is not None:
+            logger.info('Creating table {}'.format(table))
+
+        db.execute('CREATE TABLE {} (timestamp INTEGER, value REAL, unit TEXT, meter TEXT);'.format(table))
+    elif 'meter' not in columns:
+        # Older databases do not have a column for the meter ID
+        if logger is not None:
+            logger.info('Adding meter column to table {}'.format(table))
+
+        db.execute('ALTER TABLE {} ADD COLUMN meter TEXT;'.format(table))
+
+    ensure_index(db, table)
+
+def ensure_rollup_table(db, table):
+    db.execute('CREATE TABLE IF NOT EXISTS {} (timestamp INTEGER, meter TEXT, avg REAL, min REAL, max REAL, count INTEGER, last REAL, unit TEXT);'.format(table))
+
+    ensure_index(db, table)
+
+def ensure_ledger_tables(db):
+    db.execute('CREATE TABLE IF NOT EXISTS ledger (period TEXT, start TEXT, description TEXT, meter TEXT, counter TEXT, kind TEXT, delta REAL, first REAL, last REAL, unit TEXT, updated INTEGER, PRIMARY KEY (period, start, description, meter));')
+    db.execute('CREATE TABLE IF NOT EXISTS ledger_state (description TEXT, meter TEXT, value REAL, timestamp INTEGER, PRIMARY KEY (description, meter));')
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import io
+import time
+import codecs
+import random
+import select
+
+# Serial acquisition for the monitor loop. Data is read straight into a
+# preallocated buffer and telegrams are framed from '/' up to and
+# including the line with '!' and the CRC, using memoryview slicing so
+# that the only copy made is the final decode into a string.
+
+# Size of the read buffer; telegrams are around 1kB
+buffer_size = 65536
+
+# Reconnect backoff (in seconds); the delay doubles after each failed
+# attempt, up to the maximum, with random jitter
+backoff_min = 1.0
+backoff_max = 60.0
+
+# How often to check whether a missing port has reappeared (in seconds),
+# and how long to give the system to set it up before opening it
+port_poll_interval = 0.5
+port_settle_time = 0.5
+
+class Backoff:
+    def __init__(self, minimum=backoff_min, maximum=backoff_max):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.attempts = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def delay(self):
+        # Use between half and all of the exponential delay, so that
+        # several meters do not retry in lockstep
+        delay = min(self.maximum, self.minimum * (2 ** self.attempts))
+        self.attempts += 1
+
+        return random.uniform(delay / 2, delay)
+
+class TelegramFramer:
+    def __init__(self, size=buffer_size):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.fill = 0
+        self.discarded = 0
+
+    def free(self):
+        # Returns the free part of the buffer to read into
+        if self.fill == len(self.buf):
+            # No complete telegram fits in the buffer, start over
+            self.discarded += self.fill
+            self.fill = 0
+
+        return self.view[self.fill:]
+
+    def commit(self, count):
+        self.fill += count
+
+    def telegrams(self):
+        # Yields the complete telegrams in the buffer, and moves what is
+        # left of an incomplete one to the start of the buffer
+        pos = 0
+
+        while True:
+            start = self.buf.find(b'/', pos, self.fill)
+
+            if start < 0:
+                # Nothing that looks like the start of a telegram
+                self.discarded += self.fill - pos
+                pos = self.fill
+                break
+
+            self.discarded += start - pos
+
+            end = self.buf.find(b'!', start, self.fill)
+
+            if end < 0:
+                pos = start
+                break
+
+            eol = self.buf.find(b'\n', end, self.fill)
+
+            if eol < 0:
+                pos = start
+                break
+
+            # A telegram that was cut off is followed by a new one
+            restart = self.buf.rfind(b'/', start + 1, end)
+
+            if restart > 0:
+                self.discarded += restart - start
+                start = restart
+
+            yield codecs.ascii_decode(self.view[start:eol + 1], 'replace')[0]
+
+            pos = eol + 1
+
+        remaining = self.fill - pos
+
+        if remaining > 0 and pos > 0:
+            self.view[:remaining] = self.view[pos:self.fill]
+
+        self.fill = remaining
+
+class SerialReader:
+    def __init__(self, serial_handle, timeout, size=buffer_size):
+        self.serial_handle = serial_handle
+        self.timeout = timeout
+        self.framer = TelegramFramer(size)
+        self.raw = None
+
+        # On POSIX systems, reads bypass pyserial and go straight from the
+        # file descriptor into the buffer
+        if os.name == 'posix':
+            self.raw = io.FileIO(serial_handle.fileno(), 'rb', closefd=False)
+
+    def read(self):
+        # Reads what is available into the buffer; returns the number of
+        # bytes read, or 0 on a timeout
+        free = self.framer.free()
+
+        if self.raw is None:
+            count = self.serial_handle.readinto(free)
+        else:
+            ready,_,_ = select.select([self.raw], [], [], self.timeout)
+
+            if len(ready) == 0:
+                return 0
+
+            count = self.raw.readinto(free)
+
+            if count is None:
+                return 0
+
+            if count == 0:
+                raise OSError('device reports readiness to read but returned no data (device disconnected?)')
+
+        free.release()
+        self.framer.commit(count)
+
+        return count
+
+    def telegrams(self):
+        # Yields telegrams as they are received
+        while True:
+            if self.read() > 0:
+                yield from self.framer.telegrams()
+            else:
+                yield None
+
+def wait_for_port(port, delay, logger, desc):
+    # Waits for the backoff delay; if the port has disappeared (e.g. a USB
+    # adapter was unplugged), waits until it reappears instead
+    if os.path.exists(port):
+        time.sleep(delay)
+        return
+
+    logger.warning('Serial port {} for meter {} has disappeared, waiting for it to reappear'.format(port, desc))
+
+    while not os.path.exists(port):
+        time.sleep(port_poll_interval)
+
+    logger.info('Serial port {} for meter {} has reappeared'.format(port, desc))
+
+    time.sleep(port_settle_time)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import logging
+import importlib
+
+# Registry of sinks. Sink modules are only imported when their section is
+# present in the configuration, so that unused sinks (and the libraries
+# they depend on) cost no startup time or memory.
+#
+# A sink is a module (or any object) with the following functions:
+#
+#   init_sink(config, logger)                     - set up the sink; sets
+#                                                   active if it is usable
+#   process_telegram(timestamp, telegram, meter)  - store a telegram
+#   flush()                                       - write buffered data
+#   close_sink()                                  - flush and release
+#
+# and optionally idle() (called when there is nothing to do),
+# enable_bulk_mode() (used when replaying captures), enabled_fields()
+# (the DSMR names of the values the sink uses) and reload_sink(config)
+# (apply a changed configuration without closing the sink; called from
+# the thread that processes the sink's telegrams).
+#
+# Other packages can add sinks through the "pymeter.sinks" entry point
+# group; the entry point name is the name of the configuration section
+# and the entry point refers to the sink module.
+
+logger = None
+
+entry_point_group = 'pymeter.sinks'
+
+# Known sinks                                       = (module, configuration section)
+registry = dict()
+
+registry['sqlite3']                                 = ('sqlitesink', 'legacy_database')
+registry['influx']                                  = ('influxsink', 'influx')
+registry['archive']                                 = ('archivesink', 'archive')
+registry['broadcast']                               = ('broadcastsink', 'broadcast')
+registry['hot']                                     = ('hotsink', 'hot_tier')
+
+# Entry points of third-party sinks, loaded on demand
+entry_points = dict()
+
+# Active sinks, in registration order               = {name: (sink, configuration section)}
+active = dict()
+
+def register(name, module, section):
+    registry[name] = (module, section)
+
+def find_entry_points():
+    try:
+        from importlib.metadata import entry_points as find
+    except ImportError:
+        return
+
+    try:
+        found = find(group=entry_point_group)
+    except TypeError:
+        # Before Python 3.10, entry points are returned per group
+        found = find().get(entry_point_group, [])
+
+    for entry_point in found:
+        if entry_point.name in registry:
+            logger.warning('Ignoring sink {} from entry point {}, a sink with that name already exists'.format(entry_point.name, entry_point.value))
+            continue
+
+        entry_points[entry_point.name] = entry_point
+        registry[entry_point.name] = (None, entry_point.name)
+
+def load(name):
+    module,section = registry[name]
+
+    if module is None:
+        return entry_points[name].load()
+
+    return importlib.import_module(module)
+
+def get(name):
+    # Returns the sink if it is active, None otherwise
+    if name in active:
+        return active[name][0]
+
+    return None
+
+def active_sinks():
+    return [(name, sink, section) for name,(sink,section) in active.items()]
+
+def enabled_fields():
+    # Returns the DSMR names of the values the active sinks use, or None if
+    # a sink does not say which values it uses
+    names = set()
+
+    for name,sink,section in active_sinks():
+        if not hasattr(sink, 'enabled_fields'):
+            return None
+
+        names.update(sink.enabled_fields())
+
+    return names
+
+def enable_bulk_mode():
+    for name,sink,section in active_sinks():
+        if hasattr(sink, 'enable_bulk_mode'):
+            sink.enable_bulk_mode()
+
+def close_sink(name):
+    sink,section = active.pop(name)
+
+    try:
+        sink.close_sink()
+    except Exception as e:
+        logger.error('Failed to close sink {} ({})'.format(name, e))
+
+def reload_sinks(config):
+    # Starts sinks that were added to the configuration; returns the names
+    # of the new sinks, of the sinks that were removed from the
+    # configuration (which the caller stops and closes) and of the sinks
+    # that remain
+    added = []
+    removed = []
+    kept = []
+
+    for name,(module,section) in registry.items():
+        if name in active:
+            if section in config:
+                kept.append(name)
+            else:
+                removed.append(name)
+        elif section in config:
+            sink = load(name)
+            sink.init_sink(config, logger)
+
+            if getattr(sink, 'active', True):
+                active[name] = (sink, section)
+                added.append(name)
+
+    return added, removed, kept
+
+def close_sinks():
+    for name,sink,section in active_sinks():
+        try:
+            sink.close_sink()
+        except Exception as e:
+            logger.error('Failed to close sink {} ({})'.format(name, e))
+
+    active.clear()
+
+def init_sinks(config, in_logger):
+    global logger
+
+    logger = in_logger
+
+    find_entry_points()
+
+    for name,(module,section) in registry.items():
+        if section not in config:
+            logger.info('No configuration for {} sink found, not loading it'.format(name))
+            continue
+
+        sink = load(name)
+        sink.init_sink(config, logger)
+
+        if getattr(sink, 'active', True):
+            active[name] = (sink, section)
+
+    logger.info('Active sinks: {}'.format(', '.join(active.keys()) if len(active) > 0 else 'none'))
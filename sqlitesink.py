@@ -4,6 +4,14 @@ import os
 import sys
 import logging
 import sqlite3
+import time
+import metrics
+import rollup
+import schema
+import retention
+import compression
+import ledger
+import checkpoint
 
 logger = None
 
@@ -12,10 +20,48 @@ raw_db = None
 fivemin_db = None
 hourly_db = None
 consumed_db = None
+rollup_db = None
+ledger_db = None
 
 # How often do we store total consumed counters?
 total_interval = 300
 
+# How often do we commit to the databases (in seconds), and after how many
+# buffered rows do we commit regardless of the interval?
+commit_interval = 60
+commit_rows = 1000
+
+# Commit settings used in bulk mode (when replaying captures)
+bulk_commit_interval = 600
+bulk_commit_rows = 200000
+
+# Synchronisation level for the databases (off, normal, full or extra)
+synchronous = 'normal'
+
+# Rows waiting to be written, per database and table
+pending = dict()
+pending_count = 0
+last_commit = 0
+
+# Cached parameterised insert statements per table
+insert_queries = dict()
+
+# Checkpoint of the open rollup windows and the last telegram processed per
+# meter, so that a restart continues where the previous run stopped
+checkpoint_file = None
+
+# Timestamp of the last telegram processed per meter, and of the last one
+# processed before the restart
+last_timestamps = dict()
+resume_after = dict()
+
+# Settings that cannot be changed without a restart
+restart_settings = ['raw_db', 'fivemin_avg', 'hourly_avg', 'total_consumed', 'rollup_db', 'rollup_tiers', 'ledger_db', 'synchronous', 'checkpoint_file']
+startup_config = dict()
+
+# Labels for the metrics of this sink
+metric_labels = (('sink', 'sqlite3'),)
+
 # Is this sink active?
 active = False
 
@@ -23,119 +69,278 @@ active = False
 raw_counters = []
 consumed_counters = []
 
-# Averages for raw counters
-averages_fivemin = dict()
-averages_hourly = dict()
+# Rollup tiers for raw counters; the 5-minute and hourly tiers are always
+# computed for the legacy average databases
+rollup_tiers = ['5m', '1h']
+
+# Rollup tables that have been created
+rollup_tables = set()
 
 # Mapping of DSMR field names to counters           = (counter, sqlite3_table, unit)
-dsmr_map = dict()
-
-# Consumption counters
-dsmr_map['ELECTRICITY_USED_TARIFF_1']               = ('1.8.1', 'CONSUMED_1_8_1', 'kWh')
-dsmr_map['ELECTRICITY_USED_TARIFF_2']               = ('1.8.2', 'CONSUMED_1_8_2', 'kWh')
-dsmr_map['ELECTRICITY_USED_TARIFF_3']               = ('1.8.3', 'CONSUMED_1_8_3', 'kWh')
-dsmr_map['ELECTRICITY_USED_TARIFF_4']               = ('1.8.4', 'CONSUMED_1_8_4', 'kWh')
-dsmr_map['HOURLY_GAS_METER_READING']                = ('24.2.1', 'CONSUMED_24_2_1', 'm3')
-
-# Production counters
-dsmr_map['ELECTRICITY_DELIVERED_TARIFF_1']          = ('2.8.1', 'PRODUCED_2_8_1', 'kWh')
-dsmr_map['ELECTRICITY_DELIVERED_TARIFF_2']          = ('2.8.2', 'PRODUCED_2_8_2', 'kWh')
-dsmr_map['ELECTRICITY_DELIVERED_TARIFF_3']          = ('2.8.3', 'PRODUCED_2_8_3', 'kWh')
-dsmr_map['ELECTRICITY_DELIVERED_TARIFF_4']          = ('2.8.4', 'PRODUCED_2_8_4', 'kWh')
-
-# Raw counters
-dsmr_map['CURRENT_ELECTRICITY_USAGE']               = ('1.7.0', 'RAW_1_7_0', 'kW')
-dsmr_map['CURRENT_ELECTRICITY_DELIVERY']            = ('2.7.0', 'RAW_2_7_0', 'kW')
-dsmr_map['INSTANTANEOUS_VOLTAGE_L1']                = ('32.7.0', 'RAW_32_7_0', 'V')
-dsmr_map['INSTANTANEOUS_VOLTAGE_L2']                = ('52.7.0', 'RAW_52_7_0', 'V')
-dsmr_map['INSTANTANEOUS_VOLTAGE_L3']                = ('72.7.0', 'RAW_72_7_0', 'V')
-dsmr_map['INSTANTANEOUS_CURRENT_L1']                = ('31.7.0', 'RAW_31_7_0', 'A')
-dsmr_map['INSTANTANEOUS_CURRENT_L2']                = ('51.7.0', 'RAW_51_7_0', 'A')
-dsmr_map['INSTANTANEOUS_CURRENT_L3']                = ('71.7.0', 'RAW_71_7_0', 'A')
-dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L1_POSITIVE']  = ('21.7.0', 'RAW_21_7_0', 'kW')
-dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L2_POSITIVE']  = ('41.7.0', 'RAW_41_7_0', 'kW')
-dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L3_POSITIVE']  = ('61.7.0', 'RAW_61_7_0', 'kW')
-dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L1_NEGATIVE']  = ('22.7.0', 'RAW_22_7_0', 'kW')
-dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L2_NEGATIVE']  = ('42.7.0', 'RAW_42_7_0', 'kW')
-dsmr_map['INSTANTANEOUS_ACTIVE_POWER_L3_NEGATIVE']  = ('62.7.0', 'RAW_62_7_0', 'kW')
-
-def process_insert(timestamp, table, value, unit, db, db_desc):
+dsmr_map = schema.dsmr_map
+
+def process_insert(timestamp, table, value, unit, db, db_desc, meter_id=None):
+    global pending_count
+
     if db is None:
         return
 
-    try:
-        cur = db.cursor()
+    if db_desc not in pending:
+        pending[db_desc] = (db, dict())
+
+    tables = pending[db_desc][1]
+
+    if table not in tables:
+        tables[table] = []
+
+    tables[table].append((timestamp, float(value), unit, meter_id))
+    pending_count += 1
+
+def insert_query(table):
+    if table not in insert_queries:
+        insert_queries[table] = 'INSERT INTO {} (timestamp, value, unit, meter) VALUES (?,?,?,?);'.format(table)
+
+    return insert_queries[table]
+
+def flush():
+    global pending_count
+    global last_commit
+
+    mark = time.perf_counter()
+
+    for db_desc,(db,tables) in pending.items():
+        for table,rows in tables.items():
+            if len(rows) == 0:
+                continue
+
+            try:
+                db.executemany(insert_query(table), rows)
+                metrics.inc('pymeter_sink_rows_written_total', len(rows), metric_labels)
+            except Exception as e:
+                metrics.inc('pymeter_sink_errors_total', labels=metric_labels)
+                logger.error('Failed to insert {} values into table {} in the {} database ({})'.format(len(rows), table, db_desc, e))
+
+            rows.clear()
+
+        try:
+            db.commit()
+        except Exception as e:
+            metrics.inc('pymeter_sink_errors_total', labels=metric_labels)
+            logger.error('Failed to commit to the {} database ({})'.format(db_desc, e))
+
+    ledger.flush()
+
+    # The checkpoint matches what has been committed
+    save_checkpoint()
+
+    metrics.observe('pymeter_sink_commit_seconds', time.perf_counter() - mark, metric_labels)
+
+    pending_count = 0
+    last_commit = time.time()
 
-        query = "INSERT INTO {} (timestamp, value, unit) VALUES ({},{},'{}');".format(table, timestamp, value, unit)
+def save_checkpoint():
+    if checkpoint_file is None:
+        return
+
+    state = dict(rollups=rollup.save_state(), last_timestamps=[[meter_id, timestamp] for meter_id,timestamp in last_timestamps.items()])
 
-        cur.execute(query)
+    try:
+        checkpoint.save(checkpoint_file, state)
     except Exception as e:
-        logger.error('Failed to insert value into table {} in the {} database ({})'.format(table, db_desc, e))
+        logger.error('Failed to write checkpoint to {} ({})'.format(checkpoint_file, e))
+
+def restore_checkpoint():
+    try:
+        state,written = checkpoint.load(checkpoint_file)
+    except Exception as e:
+        logger.error('Failed to read checkpoint from {}, starting without it ({})'.format(checkpoint_file, e))
+        return
+
+    if state is None:
+        logger.info('No checkpoint found in {}'.format(checkpoint_file))
+        return
+
+    restored = rollup.restore_state(state['rollups'], raw_tables())
+
+    for meter_id,timestamp in state['last_timestamps']:
+        resume_after[meter_id] = timestamp
+        last_timestamps[meter_id] = timestamp
+
+    logger.info('Restored {} open rollup windows from the checkpoint written {}s ago'.format(restored, int(time.time()) - written))
+
+def rollup_table(table, tier):
+    name = '{}_{}'.format(table, tier)
+
+    if name not in rollup_tables:
+        schema.ensure_rollup_table(rollup_db, name)
 
-def process_raw_counter(timestamp, table, value, unit):
-    process_insert(timestamp, table, value, unit, raw_db, 'raw')
+        insert_queries[name] = 'INSERT INTO {} (timestamp, meter, avg, min, max, count, last, unit) VALUES (?,?,?,?,?,?,?,?);'.format(name)
+        rollup_tables.add(name)
 
-    # Process 5-minute average
-    if timestamp % 300 == 0:
-        acc,count = averages_fivemin[table]
+    return name
 
-        avg = float(acc/count)
+def process_rollup(end, table, tier, aggregate, unit, meter_id):
+    global pending_count
 
-        averages_fivemin[table] = (0, 0)
+    if 'rollup' not in pending:
+        pending['rollup'] = (rollup_db, dict())
 
-        process_insert(timestamp, table, avg, unit, fivemin_db, '5-minute average')
+    tables = pending['rollup'][1]
+    name = rollup_table(table, tier)
 
-    acc,count = averages_fivemin[table]
-    acc += value
-    count += 1
-    averages_fivemin[table] = (acc, count)
+    if name not in tables:
+        tables[name] = []
 
-    # Process hourly average
-    if timestamp % 3600 == 0:
-        acc,count = averages_hourly[table]
+    tables[name].append((end, meter_id, aggregate.avg(), aggregate.min, aggregate.max, aggregate.count, aggregate.last, unit))
+    pending_count += 1
 
-        avg = float(acc/count)
+def process_raw_counter(timestamp, attr, table, value, unit, meter_id=None):
+    # Averages are computed over all values, only the raw values are
+    # compressed
+    for raw_timestamp,raw_value in compression.filter_value('sqlite3', meter_id, attr, timestamp, value):
+        process_insert(raw_timestamp, table, raw_value, unit, raw_db, 'raw', meter_id)
 
-        averages_hourly[table] = (0, 0)
+    # Windows that close are written with the next group commit
+    for tier,seconds,end,aggregate in rollup.add(timestamp, meter_id, table, value):
+        if seconds == 300:
+            process_insert(end, table, aggregate.avg(), unit, fivemin_db, '5-minute average', meter_id)
+        elif seconds == 3600:
+            process_insert(end, table, aggregate.avg(), unit, hourly_db, 'hourly average', meter_id)
 
-        process_insert(timestamp, table, avg, unit, hourly_db, 'hourly average')
+        if rollup_db is not None:
+            process_rollup(end, table, tier, aggregate, unit, meter_id)
 
-    acc,count = averages_hourly[table]
-    acc += value
-    count += 1
-    averages_hourly[table] = (acc, count)
+def process_consumed_counter(timestamp, counter, table, value, unit, meter_id=None):
+    # The ledger is updated with every reading, the readings themselves are
+    # only stored every total_interval seconds
+    ledger.update(timestamp, counter, value, unit, meter_id)
 
-def process_consumed_counter(timestamp, table, value, unit):
     if timestamp % total_interval != 0 or consumed_db is None:
         return
 
-    process_insert(timestamp, table, value, unit, consumed_db, 'consumption/production')
+    process_insert(timestamp, table, value, unit, consumed_db, 'consumption/production', meter_id)
 
-def process_telegram(timestamp, telegram):
+def process_telegram(timestamp, telegram, meter_id=None):
     if not active:
         return
 
+    # Telegrams that were processed before a restart (e.g. read back from a
+    # spill file) are skipped
+    if meter_id in resume_after and timestamp <= resume_after[meter_id]:
+        return
+
+    last_timestamps[meter_id] = timestamp
+
     for attr,value in telegram:
         if attr in dsmr_map:
             counter,table,unit = dsmr_map[attr]
 
             if counter in raw_counters:
-                process_raw_counter(timestamp, table, value.value, unit)
+                process_raw_counter(timestamp, attr, table, value.value, unit, meter_id)
             elif counter in consumed_counters:
-                process_consumed_counter(timestamp, table, value.value, unit)
+                process_consumed_counter(timestamp, counter, table, value.value, unit, meter_id)
 
-    # For efficiency reasons, commit to the databases only once
-    if raw_db is not None:
-        raw_db.commit()
+    # Group commits; on a crash at most one commit window is lost
+    if pending_count >= commit_rows or time.time() - last_commit >= commit_interval:
+        flush()
 
-    if fivemin_db is not None:
-        fivemin_db.commit()
+def idle():
+    # Commit buffered rows on time when the meter stops sending
+    if active and (pending_count > 0 or len(ledger.pending) > 0) and time.time() - last_commit >= commit_interval:
+        flush()
 
-    if hourly_db is not None:
-        hourly_db.commit()
+    retention.run_batch()
 
-    if consumed_db is not None:
-        consumed_db.commit()
+def enabled_fields():
+    return [key for key,(counter,table,unit) in dsmr_map.items() if counter in raw_counters or counter in consumed_counters]
+
+def raw_tables():
+    return [counter_table(counter) for counter in raw_counters]
+
+def consumed_tables():
+    return [counter_table(counter) for counter in consumed_counters]
+
+def init_retention(config):
+    if 'retention' not in config['legacy_database']:
+        return
+
+    retention_config = config['legacy_database']['retention']
+
+    retention.init_retention(logger)
+
+    retention.add_policy(raw_db, 'raw', raw_tables, retention_config.get('raw_db', 0))
+    retention.add_policy(fivemin_db, '5-minute average', raw_tables, retention_config.get('fivemin_avg', 0))
+    retention.add_policy(hourly_db, 'hourly average', raw_tables, retention_config.get('hourly_avg', 0))
+    retention.add_policy(consumed_db, 'consumption/production', consumed_tables, retention_config.get('total_consumed', 0))
+    retention.add_policy(rollup_db, 'rollup', lambda: list(rollup_tables), retention_config.get('rollup_db', 0))
+
+def close_sink():
+    global active
+
+    if not active:
+        return
+
+    logger.info('Flushing and closing sqlite3 sink')
+
+    # Write raw values that compression still holds back
+    for meter_id,attr,timestamp,value in compression.flush('sqlite3'):
+        counter,table,unit = dsmr_map[attr]
+
+        process_insert(timestamp, table, value, unit, raw_db, 'raw', meter_id)
+
+    flush()
+
+    for db in [raw_db, fivemin_db, hourly_db, consumed_db, rollup_db, ledger_db]:
+        if db is not None:
+            db.close()
+
+    active = False
+
+def enable_bulk_mode():
+    global commit_interval
+    global commit_rows
+    global checkpoint_file
+
+    if not active:
+        return
+
+    commit_interval = bulk_commit_interval
+    commit_rows = bulk_commit_rows
+
+    # A replay starts with empty rollup windows and does not skip telegrams
+    # the live daemon already processed; the checkpoint belongs to the live
+    # daemon, so it is not written either
+    if checkpoint_file is not None:
+        logger.info('Ignoring the checkpoint in {} while replaying'.format(checkpoint_file))
+
+    checkpoint_file = None
+    resume_after.clear()
+    last_timestamps.clear()
+    rollup.discard([])
+    ledger.clear_state()
+
+    # A replay can simply be run again, so there is no need to sync to disk
+    for db in [raw_db, fivemin_db, hourly_db, consumed_db, rollup_db, ledger_db]:
+        if db is not None:
+            db.execute('PRAGMA synchronous=OFF;')
+
+    logger.info('sqlite3 sink in bulk mode, committing every {}s or {} rows'.format(commit_interval, commit_rows))
+
+def open_db(filename):
+    # The database is used from the sink worker thread
+    db = sqlite3.connect(filename, check_same_thread=False)
+
+    # Incremental vacuuming can only be enabled on a new database, existing
+    # databases can be converted with "query.py migrate"
+    if db.execute('PRAGMA page_count;').fetchone()[0] == 0:
+        db.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+    elif db.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+        logger.warning('Incremental vacuum is not enabled for {}, removing old data will not shrink it'.format(filename))
+
+    db.execute('PRAGMA journal_mode=WAL;')
+    db.execute('PRAGMA synchronous={};'.format(synchronous))
+
+    return db
 
 def add_raw_counter(counter):
     counter_found = False
@@ -155,10 +360,30 @@ def add_raw_counter(counter):
         return
 
     raw_counters.append(counter)
-    averages_fivemin[table] = (0,0)
-    averages_hourly[table] = (0,0)
 
-def add_consumed_counter(counter):
+def counter_table(counter):
+    for key,val in dsmr_map.items():
+        if val[0] == counter:
+            return val[1]
+
+    return None
+
+def migrate_tables():
+    # Create missing tables, and bring older ones up to date
+    for db in [raw_db, fivemin_db, hourly_db]:
+        if db is not None:
+            for counter in raw_counters:
+                schema.ensure_table(db, counter_table(counter), logger)
+
+    if consumed_db is not None:
+        for counter in consumed_counters:
+            schema.ensure_table(consumed_db, counter_table(counter), logger)
+
+    for db in [raw_db, fivemin_db, hourly_db, consumed_db]:
+        if db is not None:
+            db.commit()
+
+def add_consumed_counter(counter, description, kind):
     counter_found = False
 
     for key,val in zip(dsmr_map.keys(), dsmr_map.values()):
@@ -173,6 +398,63 @@ def add_consumed_counter(counter):
         return
 
     consumed_counters.append(counter)
+    ledger.add_counter(counter, description, kind)
+
+def configure(db_config):
+    # Applies the settings that can be changed while running
+    global total_interval
+    global commit_interval
+    global commit_rows
+
+    commit_interval = db_config.get('commit_interval', commit_interval)
+    commit_rows = db_config.get('commit_rows', commit_rows)
+    total_interval = db_config.get('total_interval', total_interval)
+
+    raw_counters.clear()
+    consumed_counters.clear()
+    ledger.counters.clear()
+
+    if 'current_consumption_id' in db_config:
+        add_raw_counter(db_config['current_consumption_id'])
+
+    if 'current_production_id' in db_config:
+        add_raw_counter(db_config['current_production_id'])
+
+    if 'other_raw_counters' in db_config:
+        for counter in db_config['other_raw_counters']:
+            add_raw_counter(counter)
+
+    if 'consumption' in db_config:
+        for key,counter_config in db_config['consumption'].items():
+            if 'id' in counter_config:
+                add_consumed_counter(counter_config['id'], counter_config.get('description', key), 'consumption')
+
+    if 'production' in db_config:
+        for key,counter_config in db_config['production'].items():
+            if 'id' in counter_config:
+                add_consumed_counter(counter_config['id'], counter_config.get('description', key), 'production')
+
+    logger.info('Inserting consumption/production values into sqlite3 database every {}s'.format(total_interval))
+    migrate_tables()
+
+    logger.info('Committing to sqlite3 databases every {}s or {} rows (synchronous={})'.format(commit_interval, commit_rows, synchronous))
+
+def reload_sink(in_config):
+    # Counters and commit settings are changed in place, the databases
+    # stay open and buffered rows are kept
+    if not active:
+        return
+
+    logger.info('Reloading configuration of sqlite3 sink')
+
+    for key in restart_settings:
+        if in_config['legacy_database'].get(key, None) != startup_config[key]:
+            logger.warning('Changing {} in the legacy_database section requires a restart, keeping the current setting'.format(key))
+
+    configure(in_config['legacy_database'])
+
+    # Open windows of counters that were removed are not written
+    rollup.discard(raw_tables())
 
 def init_sink(in_config, in_logger):
     global logger 
@@ -180,7 +462,11 @@ def init_sink(in_config, in_logger):
     global fivemin_db
     global hourly_db
     global consumed_db
-    global total_interval
+    global rollup_db
+    global ledger_db
+    global synchronous
+    global checkpoint_file
+    global last_commit
     global active
 
     config = in_config
@@ -192,59 +478,69 @@ def init_sink(in_config, in_logger):
         logger.info('No configuration for sqlite3 sink found, disabling it')
         return
 
+    if 'synchronous' in config['legacy_database']:
+        synchronous = config['legacy_database']['synchronous'].lower()
+
+        if synchronous not in ['off', 'normal', 'full', 'extra']:
+            raise Exception('Invalid synchronous setting "{}" in the legacy_database section of the configuration'.format(synchronous))
+
     if 'raw_db' not in config['legacy_database']:
         logger.warning('No raw measurement database configured for the sqlite3 sink')
     else:
-        raw_db = sqlite3.connect(config['legacy_database']['raw_db'])
+        raw_db = open_db(config['legacy_database']['raw_db'])
         logger.info('Opened {} as sqlite3 database for raw measurement data'.format(config['legacy_database']['raw_db']))
         active = True
 
     if 'fivemin_avg' not in config['legacy_database']:
         logger.info('No 5-minute average database configured for the sqlite3 sink')
     else:
-        fivemin_db = sqlite3.connect(config['legacy_database']['fivemin_avg'])
+        fivemin_db = open_db(config['legacy_database']['fivemin_avg'])
         logger.info('Opened {} as sqlite3 database for 5-minute averages of raw measurement data'.format(config['legacy_database']['fivemin_avg']))
 
     if 'hourly_avg' not in config['legacy_database']:
         logger.info('No hourly average database configured for the sqlite3 sink')
     else:
-        hourly_db = sqlite3.connect(config['legacy_database']['hourly_avg'])
+        hourly_db = open_db(config['legacy_database']['hourly_avg'])
         logger.info('Opened {} as sqlite3 database for hourly averages of raw measurement data'.format(config['legacy_database']['hourly_avg']))
 
     if 'total_consumed' not in config['legacy_database']:
         logger.warning('No total consumed database configured for the sqlite3 sink')
     else:
-        consumed_db = sqlite3.connect(config['legacy_database']['total_consumed'])
+        consumed_db = open_db(config['legacy_database']['total_consumed'])
         logger.info('Opened {} as sqlite3 database for total consumed data'.format(config['legacy_database']['total_consumed']))
         active = True
 
-    if active:
-        logger.info('At least one raw or total consumed database open, sqlite3 sink is now active')
+    if 'rollup_db' in config['legacy_database']:
+        rollup_db = open_db(config['legacy_database']['rollup_db'])
+        logger.info('Opened {} as sqlite3 database for rollups of raw measurement data'.format(config['legacy_database']['rollup_db']))
+
+        if 'rollup_tiers' in config['legacy_database']:
+            rollup_tiers.extend(config['legacy_database']['rollup_tiers'])
+
+    rollup.set_tiers(rollup_tiers)
 
-        # Add counters
-        if 'current_consumption_id' in config['legacy_database']:
-            add_raw_counter(config['legacy_database']['current_consumption_id'])
+    if 'ledger_db' in config['legacy_database']:
+        ledger_db = open_db(config['legacy_database']['ledger_db'])
+        logger.info('Opened {} as sqlite3 database for the daily and monthly consumption/production ledger'.format(config['legacy_database']['ledger_db']))
+        active = True
+
+        ledger.init_ledger(ledger_db, logger, config['legacy_database'].get('ledger_max_rate', None))
 
-        if 'current_production_id' in config['legacy_database']:
-            add_raw_counter(config['legacy_database']['current_production_id'])
+    if active:
+        logger.info('At least one raw, total consumed or ledger database open, sqlite3 sink is now active')
 
-        if 'other_raw_counters' in config['legacy_database']:
-            for counter in config['legacy_database']['other_raw_counters']:
-                add_raw_counter(counter)
+        configure(config['legacy_database'])
+        init_retention(config)
 
-        if 'consumption' in config['legacy_database']:
-            for key in config['legacy_database']['consumption'].keys():
-                if 'id' in config['legacy_database']['consumption'][key]:
-                    add_consumed_counter(config['legacy_database']['consumption'][key]['id'])
+        logger.info('Computing rollups of raw counters for tiers {}'.format(', '.join([tier for tier,_ in rollup.tiers])))
 
-        if 'production' in config['legacy_database']:
-            for key in config['legacy_database']['production'].keys():
-                if 'id' in config['legacy_database']['production'][key]:
-                    add_consumed_counter(config['legacy_database']['production'][key]['id'])
+        if 'checkpoint_file' in config['legacy_database']:
+            checkpoint_file = config['legacy_database']['checkpoint_file']
+            restore_checkpoint()
 
-        if 'total_interval' in config['legacy_database']:
-            total_interval = config['legacy_database']['total_interval']
+        for key in restart_settings:
+            startup_config[key] = config['legacy_database'].get(key, None)
 
-        logger.info('Inserting consumption/production values into sqlite3 database every {}s'.format(total_interval))
+        last_commit = time.time()
 
     logger.info('Initialisation of sqlite3 sink complete')